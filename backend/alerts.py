@@ -0,0 +1,285 @@
+# ======== 價格警示 ========
+# 倉位變更時，由分段線性損益結構一次算出所有警示的觸發指數，
+# 合併為排序後的邊界陣列；每筆報價只需一次二分搜尋 (O(log n)) 即可得知哪些警示成立。
+# 報價恰好落在邊界上時改用邊界點本身的判斷結果 (如 x <= level 在 level 即成立)。
+#
+# 常駐模式 (於 backend 目錄):
+#     python alerts.py --threshold -50000 --approach 100 --sink file:alerts.log
+#     python alerts.py --portfolio ../hedge_positions.json --sink http://localhost:9000/hook
+
+import argparse
+import json
+import os
+import sys
+import time
+from bisect import bisect_left
+from datetime import datetime
+
+from hedge_core import (
+    is_futures_position,
+    normalize_portfolio,
+    portfolio_hash,
+    build_payoff_profile,
+    profile_pnl_at,
+)
+
+ALERT_POLL_INTERVAL = 30.0  # 常駐模式報價輪詢間隔 (秒)
+
+
+# ======== 觸發價位計算 ========
+def pnl_crossings(profile, threshold):
+    """組合損益恰好等於 threshold 的所有指數 (含轉折點外的兩端)"""
+    strikes = profile["strikes"]
+    slopes = profile["slopes"]
+    if not strikes:
+        anchor_x, anchor_y = profile["anchor"]
+        if slopes[0] == 0:
+            return []
+        return [anchor_x + (threshold - anchor_y) / slopes[0]]
+
+    values = profile["values"]
+    crossings = []
+    # 最左段 (-∞, strikes[0]]
+    if slopes[0] != 0:
+        x = strikes[0] + (threshold - values[0]) / slopes[0]
+        if x < strikes[0]:
+            crossings.append(x)
+    # 中間各段
+    for i in range(len(strikes) - 1):
+        y0, y1 = values[i] - threshold, values[i + 1] - threshold
+        if y0 == 0:
+            crossings.append(strikes[i])
+        elif y0 * y1 < 0:
+            crossings.append(strikes[i] - y0 * (strikes[i + 1] - strikes[i]) / (y1 - y0))
+    if values[-1] == threshold:
+        crossings.append(strikes[-1])
+    # 最右段 [strikes[-1], +∞)
+    if slopes[-1] != 0:
+        x = strikes[-1] + (threshold - values[-1]) / slopes[-1]
+        if x > strikes[-1]:
+            crossings.append(x)
+    return crossings
+
+
+def build_alert_levels(portfolio, base_index, pnl_threshold=None, approach_points=0.0):
+    """建立警示邊界
+
+    回傳 {"boundaries": 排序後邊界, "active": 每個區間成立的警示 id,
+          "at_boundary": 恰好在各邊界上成立的警示 id, "alerts": id -> 說明}。
+    警示 id 以倉位內容命名 (不用列表索引)，倉位增刪後同一條件的 id 不變。
+    """
+    portfolio = normalize_portfolio(portfolio)
+    rules = []  # (id, 說明, 邊界列表, 判斷函式)
+
+    if pnl_threshold is not None:
+        profile = build_payoff_profile(
+            portfolio["option_positions"], base_index,
+            portfolio["etf_lots"], portfolio["etf_cost"], portfolio["etf_current_price"] or 0.0,
+            holdings=portfolio["holdings"],
+        )
+        rules.append((
+            "pnl",
+            f"組合損益低於 {pnl_threshold:,.0f} 元",
+            pnl_crossings(profile, pnl_threshold),
+            lambda x, profile=profile: profile_pnl_at(profile, x) < pnl_threshold,
+        ))
+
+    # 賣出的選擇權：接近或進入價內
+    for pos in portfolio["option_positions"]:
+        if is_futures_position(pos) or pos.get("direction") != "賣出" or not pos.get("lots"):
+            continue
+        strike = float(pos["strike"])
+        if pos["type"] == "Call":
+            level = strike - approach_points
+            predicate = lambda x, level=level: x >= level
+        else:
+            level = strike + approach_points
+            predicate = lambda x, level=level: x <= level
+        label = "接近價內" if approach_points else "進入價內"
+        rules.append((
+            f"short_{pos['type']}_{strike:g}",
+            f"賣出 {pos['type']} {strike:,.0f} {label}",
+            [level],
+            predicate,
+        ))
+
+    boundaries = sorted({b for _, _, levels, _ in rules for b in levels})
+    # 每個區間取一個代表點判斷哪些警示成立
+    if boundaries:
+        samples = [boundaries[0] - 1.0]
+        samples += [(a + b) / 2 for a, b in zip(boundaries, boundaries[1:])]
+        samples.append(boundaries[-1] + 1.0)
+    else:
+        samples = [float(base_index)]
+    active = [frozenset(rule_id for rule_id, _, _, predicate in rules if predicate(x)) for x in samples]
+    at_boundary = [frozenset(rule_id for rule_id, _, _, predicate in rules if predicate(x)) for x in boundaries]
+
+    return {
+        "boundaries": boundaries,
+        "active": active,
+        "at_boundary": at_boundary,
+        "alerts": {rule_id: message for rule_id, message, _, _ in rules},
+    }
+
+
+class AlertEngine:
+    """比對報價與預先計算的警示邊界，只在警示由不成立變為成立時通知"""
+
+    def __init__(self, pnl_threshold=None, approach_points=0.0, sinks=()):
+        self.pnl_threshold = pnl_threshold
+        self.approach_points = approach_points
+        self.sinks = list(sinks)
+        self.levels = None
+        self._key = None
+        self._fired = frozenset()
+
+    def update_book(self, portfolio, base_index):
+        """倉位或基準指數變更時才重新計算邊界"""
+        key = (portfolio_hash(normalize_portfolio(portfolio)), base_index)
+        if key != self._key:
+            self.levels = build_alert_levels(portfolio, base_index, self.pnl_threshold, self.approach_points)
+            self._key = key
+            # 保留仍存在的已觸發警示，倉位變更不會重複通知
+            self._fired = self._fired & frozenset(self.levels["alerts"])
+
+    def active_at(self, index_price):
+        """此報價成立的警示 id"""
+        boundaries = self.levels["boundaries"]
+        i = bisect_left(boundaries, index_price)
+        if i < len(boundaries) and boundaries[i] == index_price:
+            return self.levels["at_boundary"][i]
+        return self.levels["active"][i]
+
+    def check(self, index_price):
+        """回傳此報價新觸發的警示並送出通知"""
+        active = self.active_at(index_price)
+        new = active - self._fired
+        self._fired = active
+        notifications = [
+            {
+                "ts": datetime.now().isoformat(timespec="seconds"),
+                "alert": rule_id,
+                "message": self.levels["alerts"][rule_id],
+                "index": index_price,
+            }
+            for rule_id in sorted(new)
+        ]
+        for notification in notifications:
+            for sink in self.sinks:
+                sink.send(notification)
+        return notifications
+
+
+# ======== 通知輸出 ========
+class FileSink:
+    """將通知以 JSON lines 附加到本地檔案"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, notification):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(notification, ensure_ascii=False) + "\n")
+
+
+class WebhookSink:
+    """以 HTTP POST 送出通知 (失敗時只記錄到 stderr)"""
+
+    def __init__(self, url, timeout=5):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, notification):
+        import requests
+        try:
+            requests.post(self.url, json=notification, timeout=self.timeout)
+        except Exception as e:
+            print(f"通知送出失敗: {e}", file=sys.stderr)
+
+
+class StdoutSink:
+    def send(self, notification):
+        print(f"[{notification['ts']}] {notification['message']} (指數 {notification['index']:,.0f})", flush=True)
+
+
+def open_sink(spec):
+    """file:<路徑> / http(s)://... / stdout"""
+    if spec.startswith("file:"):
+        return FileSink(spec[len("file:"):])
+    if spec.startswith(("http://", "https://")):
+        return WebhookSink(spec)
+    if spec == "stdout":
+        return StdoutSink()
+    raise ValueError(f"不支援的通知輸出: {spec}")
+
+
+# ======== 常駐模式 ========
+def anchor_book(book, etf_price):
+    """以與基準指數同時取得的 00631L 報價取代倉位中儲存的現價 (None 時沿用倉位中的值)"""
+    if not etf_price:
+        return book
+    return {**(book or {}), "etf_current_price": float(etf_price)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="00631L 避險組合價格警示常駐程式")
+    parser.add_argument("--portfolio", help="倉位檔 (未指定時從 Firebase 即時同步)")
+    parser.add_argument("--threshold", type=float, help="組合損益低於此金額時警示 (元)")
+    parser.add_argument("--approach", type=float, default=0.0, help="賣出履約價前多少點開始警示")
+    parser.add_argument("--base-index", type=float, help="計算 ETF 損益的基準指數 (預設為每日第一筆指數，並同時取得 00631L 現價)")
+    parser.add_argument("--sink", action="append", default=[], help="通知輸出 file:<路徑> / http(s)://... / stdout，可重複")
+    parser.add_argument("--interval", type=float, default=ALERT_POLL_INTERVAL, help="報價輪詢間隔 (秒)")
+    args = parser.parse_args(argv)
+
+    from quotes import ETF_TICKER, TSE_INDEX_TICKER, fetch_intraday_price
+
+    sinks = [open_sink(spec) for spec in (args.sink or ["stdout"])]
+    engine = AlertEngine(args.threshold, args.approach, sinks)
+
+    if args.portfolio:
+        def load_book():
+            with open(args.portfolio, encoding="utf-8") as f:
+                return json.load(f)
+        book_version = lambda: os.path.getmtime(args.portfolio)
+    else:
+        import storage
+        storage.init_firebase()
+        listener = storage.PortfolioListener().start()
+        load_book = storage.load_portfolio
+        book_version = lambda: listener.version
+
+    # 基準指數與 00631L 現價須為同一時間的報價 (倉位中儲存的 ETF 價格可能是數天前的)，
+    # 每日重新錨定；指定 --base-index 時固定基準指數，ETF 價格沿用倉位中的值
+    base_index = args.base_index
+    etf_price = None
+    anchored_on = None
+    book = None
+    loaded_version = None
+    while True:
+        try:
+            index_price = fetch_intraday_price(TSE_INDEX_TICKER)
+            if index_price:
+                today = datetime.now().date()
+                if args.base_index is None and anchored_on != today:
+                    quote = fetch_intraday_price(ETF_TICKER)
+                    if quote:
+                        base_index, etf_price, anchored_on = index_price, quote, today
+                    elif base_index is None:
+                        # 暫用倉位中的 ETF 價格，下一輪再重試錨定
+                        base_index = index_price
+                version = book_version()
+                if version != loaded_version:
+                    # 讀取失敗 (例如檔案寫到一半) 時沿用舊倉位，下一輪再重試
+                    book = load_book()
+                    loaded_version = version
+                if book is not None:
+                    engine.update_book(anchor_book(book, etf_price), base_index)
+                if engine.levels is not None:
+                    engine.check(index_price)
+        except Exception as e:
+            print(f"[{datetime.now().isoformat(timespec='seconds')}] 警示檢查失敗: {e}", file=sys.stderr, flush=True)
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
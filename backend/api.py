@@ -0,0 +1,272 @@
+# ======== 00631L 避險計算器 REST API ========
+# 與 app.py 共用 hedge_core / quotes / storage，供 PWA 與程式化存取
+#
+# 啟動方式 (於 backend 目錄):
+#     uvicorn api:app --host 0.0.0.0 --port 8000
+
+import logging
+import os
+import threading
+import time
+from typing import List, Literal, Optional
+
+from fastapi import FastAPI, HTTPException
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field
+
+import storage
+from hedge_core import (
+    PRICE_STEP,
+    COST_DEFAULTS,
+    normalize_portfolio,
+    portfolio_hash,
+    calc_pnl_grid,
+    price_grid,
+    build_payoff_profile,
+    analyze_risk,
+)
+from quotes import fetch_tse_index_price, fetch_00631L_price
+from cache import get_region, region_stats
+from journal import FirebaseJournal
+
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="00631L 避險計算器 API", default_response_class=ORJSONResponse)
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=os.environ.get("HEDGE_API_CORS", "*").split(","),
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+
+# ======== 請求格式 ========
+class Position(BaseModel):
+    product: str = "台指"
+    type: Literal["Call", "Put", "Futures"]
+    direction: Literal["買進", "賣出", "做空"]
+    strike: float
+    lots: int = Field(ge=0)
+    premium: float = 0.0
+
+
+class PortfolioUpdate(BaseModel):
+    etf_lots: Optional[float] = None
+    etf_cost: Optional[float] = None
+    etf_current_price: Optional[float] = None
+    hedge_ratio: Optional[float] = None
+    cash_cost: Optional[float] = None
+    cash_current: Optional[float] = None
+
+
+class LotsUpdate(BaseModel):
+    lots: int = Field(ge=0)
+
+
+class Holding(BaseModel):
+    symbol: str
+    lots: float = Field(ge=0)
+    cost: float = 0.0
+    price: float = Field(gt=0)  # 沒有現價時拒絕，不以 0 計價
+    beta: Optional[float] = None  # 未指定時取 INSTRUMENTS 的預設值 (如 00632R 為 -1)
+
+
+class PortfolioDocument(PortfolioUpdate):
+    option_positions: List[Position] = []
+    holdings: List[Holding] = []
+
+
+# ======== 記憶體狀態 ========
+_lock = threading.Lock()
+_portfolio = None
+_portfolio_etag = None
+_listener = None
+_listener_version = None
+_journal = None
+
+
+def _get_portfolio():
+    """取得目前倉位文件 (首次呼叫時從 Firebase 載入，之後由監聽器同步)"""
+    global _portfolio, _portfolio_etag, _listener, _listener_version
+    with _lock:
+        if _listener is None:
+            storage.init_firebase()
+            _listener = storage.PortfolioListener().start()
+        version = _listener.version
+        if _portfolio is None or version != _listener_version:
+            data, _portfolio_etag = storage.load_portfolio_with_etag()
+            _portfolio = normalize_portfolio(data)
+            _listener_version = version
+        return _portfolio
+
+
+def _record_event(portfolio, before, event):
+    """將已儲存的異動寫入與 app.py 共用的 Firebase 日誌 (日誌失敗不影響倉位儲存)"""
+    global _journal
+    try:
+        if _journal is None:
+            _journal = FirebaseJournal()
+        _journal.record(event["op"], portfolio, portfolio_before=before,
+                        **{k: v for k, v in event.items() if k != "op"})
+    except Exception:
+        logger.exception("倉位異動紀錄寫入失敗")
+
+
+def _save_portfolio(portfolio, event):
+    """以 ETag 條件寫入 Firebase 並記錄異動日誌，遠端已被修改時回傳 409
+
+    event 為日誌事件 (格式同 app.py，如 {"op": "delete_position", "index": 0})。
+    """
+    global _portfolio, _portfolio_etag
+    portfolio = normalize_portfolio(portfolio)
+    before = _portfolio
+    try:
+        ok, remote_data, etag = storage.save_portfolio_if_unchanged(portfolio, _portfolio_etag)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Firebase 儲存失敗: {e}")
+    with _lock:
+        _portfolio_etag = etag
+        _portfolio = normalize_portfolio(remote_data) if not ok else portfolio
+    if not ok:
+        raise HTTPException(status_code=409, detail="倉位已在其他裝置更新，請重新讀取後再操作")
+    _record_event(portfolio, before, event)
+    return portfolio
+
+
+def _get_quotes(force=False):
+    """取得報價快照 (quotes 區域 TTL 內共用同一份)"""
+    quotes_region = get_region("quotes")
+    quotes = None if force else quotes_region.get("api_snapshot")
+    if quotes is None:
+        quotes = {
+            "fetched_at": time.time(),
+            "tse_index_price": fetch_tse_index_price(),
+            "etf_current_price": fetch_00631L_price(),
+        }
+        quotes_region.set("api_snapshot", quotes)
+    return dict(quotes)
+
+
+def _resolve_market(portfolio, center):
+    """決定計算用的指數中心與 ETF 現價 (即時報價優先)"""
+    quotes = _get_quotes()
+    if center is None:
+        center = quotes["tse_index_price"] or 23000.0  # 備用值
+    etf_current = quotes["etf_current_price"] or portfolio["etf_current_price"] or 100.0
+    return center, etf_current
+
+
+# ======== 倉位 CRUD ========
+@app.get("/portfolio")
+def get_portfolio():
+    portfolio = _get_portfolio()
+    return {"hash": portfolio_hash(portfolio), **portfolio}
+
+
+@app.put("/portfolio")
+def replace_portfolio(body: PortfolioDocument):
+    # 只保留請求中有給的欄位，其餘由 normalize_portfolio 補預設值
+    portfolio = body.model_dump(exclude_unset=True)
+    portfolio = _save_portfolio(portfolio, {"op": "restore", "portfolio": normalize_portfolio(portfolio)})
+    return {"hash": portfolio_hash(portfolio), **portfolio}
+
+
+@app.patch("/portfolio")
+def update_portfolio(body: PortfolioUpdate):
+    portfolio = dict(_get_portfolio())
+    fields = body.model_dump(exclude_none=True)
+    portfolio.update(fields)
+    portfolio = _save_portfolio(portfolio, {"op": "update_settings", "fields": fields})
+    return {"hash": portfolio_hash(portfolio), **portfolio}
+
+
+@app.post("/portfolio/positions", status_code=201)
+def add_position(position: Position):
+    portfolio = dict(_get_portfolio())
+    new_position = position.model_dump()
+    portfolio["option_positions"] = portfolio["option_positions"] + [new_position]
+    portfolio = _save_portfolio(portfolio, {"op": "add_position", "position": new_position})
+    return {"hash": portfolio_hash(portfolio), **portfolio}
+
+
+@app.patch("/portfolio/positions/{index}")
+def update_position_lots(index: int, body: LotsUpdate):
+    portfolio = dict(_get_portfolio())
+    positions = [dict(pos) for pos in portfolio["option_positions"]]
+    if not 0 <= index < len(positions):
+        raise HTTPException(status_code=404, detail="找不到倉位")
+    delta = body.lots - positions[index]["lots"]
+    positions[index]["lots"] = body.lots
+    portfolio["option_positions"] = positions
+    portfolio = _save_portfolio(portfolio, {"op": "adjust_lots", "index": index, "delta": delta})
+    return {"hash": portfolio_hash(portfolio), **portfolio}
+
+
+@app.delete("/portfolio/positions/{index}")
+def delete_position(index: int):
+    portfolio = dict(_get_portfolio())
+    positions = list(portfolio["option_positions"])
+    if not 0 <= index < len(positions):
+        raise HTTPException(status_code=404, detail="找不到倉位")
+    positions.pop(index)
+    portfolio["option_positions"] = positions
+    portfolio = _save_portfolio(portfolio, {"op": "delete_position", "index": index})
+    return {"hash": portfolio_hash(portfolio), **portfolio}
+
+
+# ======== 報價 ========
+@app.get("/quotes")
+def get_quotes(refresh: bool = False):
+    return _get_quotes(force=refresh)
+
+
+# ======== 損益網格 ========
+@app.get("/pnl")
+def get_pnl(center: Optional[float] = None, price_range: float = 1500, step: float = PRICE_STEP,
+            costs: bool = False):
+    if price_range <= 0 or step <= 0 or price_range / step > 10000:
+        raise HTTPException(status_code=422, detail="模擬範圍或間距不合法")
+
+    portfolio = _get_portfolio()
+    center, etf_current = _resolve_market(portfolio, center)
+    key = ("api_pnl", portfolio_hash(portfolio), center, etf_current, price_range, step, costs)
+    payoff_region = get_region("payoff")
+    result = payoff_region.get(key)
+    if result is not None:
+        return ORJSONResponse(result)
+
+    cost_settings = COST_DEFAULTS if costs else None
+    prices = price_grid(center, price_range, step)
+    etf_profits, option_profits, combined_profits = calc_pnl_grid(
+        portfolio["option_positions"], prices, center,
+        portfolio["etf_lots"], portfolio["etf_cost"], etf_current,
+        holdings=portfolio["holdings"], costs=cost_settings,
+    )
+    profile = build_payoff_profile(
+        portfolio["option_positions"], center,
+        portfolio["etf_lots"], portfolio["etf_cost"], etf_current,
+        holdings=portfolio["holdings"], costs=cost_settings,
+    )
+    result = {
+        "hash": key[1],
+        "center": center,
+        "etf_current_price": etf_current,
+        "costs": cost_settings,
+        "prices": prices.tolist(),
+        "etf": etf_profits.tolist(),
+        "options": option_profits.tolist(),
+        "total": combined_profits.tolist(),
+        "risk": analyze_risk(profile, center, center - price_range, center + price_range),
+    }
+    payoff_region.set(key, result)
+    # 直接回傳 ORJSONResponse，略過 FastAPI 的 jsonable_encoder
+    return ORJSONResponse(result)
+
+
+# ======== 快取狀態 ========
+@app.get("/cache")
+def get_cache_stats():
+    return region_stats()
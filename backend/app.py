@@ -1,12 +1,14 @@
 ﻿import streamlit as st
 import pandas as pd
 import numpy as np
+import contextlib
+import io
 import json
 import os
+import weakref
 import matplotlib.pyplot as plt
 from matplotlib import rcParams
-import yfinance as yf
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
 
 # ======== 修正中文亂碼 (設置 Matplotlib 字體) ========
 # 雲端環境簡化設定，避免 findSystemFonts 卡住
@@ -279,96 +281,235 @@ st.markdown('''
 ''', unsafe_allow_html=True)
 
 # ======== 常數設定 ========
-OPTION_MULTIPLIER = 50.0  # 台指選擇權每點 50 元
-MICRO_OPTION_MULTIPLIER = 10.0  # 微台選擇權每點 10 元
-ETF_SHARES_PER_LOT = 1000  # 1張 = 1000股
-LEVERAGE_00631L = 2.0  # 00631L 為 2 倍槓桿 ETF
-PRICE_STEP = 100.0
+from hedge_core import (
+    OPTION_MULTIPLIER,
+    MICRO_OPTION_MULTIPLIER,
+    ETF_SHARES_PER_LOT,
+    LEVERAGE_00631L,
+    PRICE_STEP,
+    normalize_portfolio,
+    portfolio_hash,
+    calc_pnl_grid,
+    position_multiplier,
+    is_futures_position,
+    calc_leg_cost_grid,
+    calc_etf_cost_grid,
+    calc_holdings_cost_grid,
+    price_grid,
+    INSTRUMENTS,
+    COST_DEFAULTS,
+    make_holding,
+    holding_ticker,
+    apply_staged_changes,
+    staged_changes_realized,
+    staged_changes_delta,
+    offset_profile,
+    calc_stress_matrix,
+    build_payoff_profile,
+    analyze_risk,
+)
 
 # ======== 網路資料抓取函式 ========
-@st.cache_data(ttl=300)
+from quotes import fetch_tse_index_price, fetch_00631L_price, fetch_prices
+from cache import cached, clear_region, region_stats, process_rss, session_memory_report
+from snapshot import snapshot_bytes, save_snapshot, load_snapshot
+from strategies import (
+    TEMPLATES,
+    hedge_lots,
+    generate_variants,
+    price_variants,
+    evaluate_variants,
+    rank_variants,
+    describe_legs,
+)
+
+@cached("quotes")
 def get_tse_index_price(ticker="^TWII"):
     """從 Yahoo Finance 獲取加權指數的最新價格"""
-    try:
-        tse_ticker = yf.Ticker(ticker)
-        hist = tse_ticker.history(period="5d")
-        if not hist.empty:
-            price = float(hist['Close'].iloc[-1])
-            if price > 1000:
-                return price
-        return None
-    except Exception:
-        return None
+    return fetch_tse_index_price(ticker)
 
-@st.cache_data(ttl=300)
+@cached("quotes")
 def get_00631L_price():
     """從 Yahoo Finance 獲取 00631L 的最新價格"""
-    try:
-        etf_ticker = yf.Ticker("00631L.TW")
-        hist = etf_ticker.history(period="5d")
-        if not hist.empty:
-            price = float(hist['Close'].iloc[-1])
-            if price > 0:
-                return price
-        return None
-    except Exception:
-        return None
+    return fetch_00631L_price()
+
+@cached("quotes")
+def get_holding_prices(tickers):
+    """批次獲取其他持股的最新價格 (tickers 為 tuple)"""
+    return fetch_prices(tickers)
 
 # ======== Firebase 設定 ========
-FIREBASE_DATABASE_URL = "https://l-op-bf09b-default-rtdb.asia-southeast1.firebasedatabase.app/"
+import storage
+from journal import FirebaseJournal, LocalJournal
+from live import QuoteStreamer, LiveRevaluer, drain_latest
 
 # 初始化 Firebase (只執行一次)
-import firebase_admin
-from firebase_admin import credentials, db
-import os
-
 if "firebase_initialized" not in st.session_state:
     try:
-        # 優先嘗試本機開發：使用 JSON 檔案
-        if os.path.exists("firebase_key.json"):
-            cred = credentials.Certificate("firebase_key.json")
-        # Streamlit Cloud：從 secrets 取得憑證
-        elif hasattr(st, 'secrets') and 'firebase' in st.secrets:
+        # Streamlit Cloud：從 secrets 取得憑證 (本機則使用 firebase_key.json)
+        cred_dict = None
+        if not os.path.exists(storage.FIREBASE_KEY_FILE) and hasattr(st, 'secrets') and 'firebase' in st.secrets:
             cred_dict = dict(st.secrets["firebase"])
-            cred = credentials.Certificate(cred_dict)
-        else:
-            raise FileNotFoundError("找不到 Firebase 憑證")
-        
-        firebase_admin.initialize_app(cred, {
-            'databaseURL': FIREBASE_DATABASE_URL
-        })
-        st.session_state.firebase_initialized = True
-    except ValueError:
-        # 已經初始化過
+        storage.init_firebase(cred_dict)
         st.session_state.firebase_initialized = True
     except Exception as e:
         st.error(f"Firebase 初始化失敗: {e}")
         st.session_state.firebase_initialized = False
 
+REMOTE_SYNC_INTERVAL = 2  # 檢查其他裝置更新的間隔 (秒)
+
+# 倉位文件中會顯示在畫面上的欄位 (現價改用即時報價，不列入比較)
+BOOK_FIELDS = ["etf_lots", "etf_cost", "hedge_ratio", "cash_cost", "cash_current", "option_positions", "holdings"]
+
+@st.cache_resource
+def get_portfolio_listener():
+    """整個行程共用一個 Firebase 監聽器 (背景執行緒接收變更事件)"""
+    try:
+        return storage.PortfolioListener().start()
+    except Exception:
+        return None
+
+@st.cache_resource
+def get_quote_streamer():
+    """整個行程共用一個報價輪詢執行緒 (開啟即時損益時才啟動)"""
+    return QuoteStreamer().start()
+
+class SessionMarker:
+    """放在 session state 的標記，session 結束被回收後自動從登記表移除"""
+
+@st.cache_resource
+def get_session_registry():
+    """目前存活的 session (用於計算每位檢視者平均記憶體)"""
+    return weakref.WeakSet()
+
 # ======== 載入與儲存函式 (Firebase) ========
 def load_data():
-    """從 Firebase 載入倉位資料"""
+    """從 Firebase 載入倉位資料 (同時記錄 ETag 供寫入時比對)"""
     if not st.session_state.get("firebase_initialized", False):
         return None
     try:
-        ref = db.reference('hedge_positions')
-        data = ref.get()
+        data, etag = storage.load_portfolio_with_etag()
+        st.session_state.portfolio_etag = etag
+        st.session_state.persisted_book = normalize_portfolio(data)
         return data
     except Exception as e:
         st.error(f"Firebase 讀取失敗: {e}")
         return None
 
-def save_data(data):
-    """儲存倉位資料到 Firebase"""
-    if not st.session_state.get("firebase_initialized", False):
-        return False
+# 本地快照：Firebase 無法連線時的啟動來源 (每次成功載入 / 儲存後更新)
+LOCAL_SNAPSHOT_PATH = os.environ.get(
+    "HEDGE_SNAPSHOT_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshots", "hedge_positions.npz"),
+)
+
+def write_local_snapshot(data):
+    """更新本地快照 (失敗不影響主流程)"""
     try:
-        ref = db.reference('hedge_positions')
-        ref.set(data)
-        return True
+        os.makedirs(os.path.dirname(LOCAL_SNAPSHOT_PATH), exist_ok=True)
+        save_snapshot(LOCAL_SNAPSHOT_PATH, data)
+    except Exception:
+        pass
+
+def load_local_snapshot():
+    """讀取本地快照，不存在或損毀時回傳 None"""
+    try:
+        # 數值欄位以記憶體映射讀取；倉位解碼為 list 後映射即隨陣列釋放，不妨礙之後覆寫快照
+        return load_snapshot(LOCAL_SNAPSHOT_PATH)[0]
+    except Exception:
+        return None
+
+def apply_book_to_session(data):
+    """將倉位文件套用到 session state (現價不從檔案讀取，改用即時抓取)"""
+    data = normalize_portfolio(data)
+    for field in BOOK_FIELDS:
+        st.session_state[field] = data[field]
+
+def visible_book():
+    """目前畫面上的倉位內容，用於判斷遠端更新是否需要重新執行"""
+    return {field: st.session_state[field] for field in BOOK_FIELDS}
+
+LOCAL_JOURNAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "journal")
+
+@st.cache_resource
+def get_journal(use_firebase):
+    """倉位異動日誌 (Firebase 可用時寫入 Firebase，否則寫入本地 backend/journal/)"""
+    if use_firebase:
+        return FirebaseJournal()
+    return LocalJournal(LOCAL_JOURNAL_DIR)
+
+def journal_lock(use_firebase):
+    """日誌的寫入鎖 (同一行程的所有 session 共用同一份日誌)；日誌無法使用時不上鎖"""
+    try:
+        return get_journal(use_firebase).lock
+    except Exception:
+        return contextlib.nullcontext()
+
+def record_event(data, event, before=None, use_firebase=None):
+    """將已儲存的異動寫入日誌 (日誌失敗不影響倉位儲存)
+
+    event 為 None 時表示外部修改 (其他裝置 / PWA)，以整份文件記錄為 sync 事件。
+    before 為寫入前的文件，日誌尚無紀錄時作為起始快照。
+    use_firebase 未指定時依 Firebase 是否可用選擇日誌。
+    """
+    if use_firebase is None:
+        use_firebase = st.session_state.get("firebase_initialized", False)
+    try:
+        journal = get_journal(use_firebase)
+        if event is None:
+            journal.sync(data, portfolio_before=before)
+        else:
+            if before is not None and not use_firebase:
+                # 本地日誌可能漏記期間的 Firebase 寫入，先補記一筆 sync 讓重播與實際倉位一致
+                journal.sync(before)
+            journal.record(event["op"], data, portfolio_before=before,
+                           **{k: v for k, v in event.items() if k != "op"})
     except Exception as e:
-        st.error(f"Firebase 儲存失敗: {e}")
-        return False
+        st.toast(f"⚠️ 異動紀錄寫入失敗: {e}")
+
+def save_local(data, event, before):
+    """Firebase 無法寫入時：異動記入本地日誌並更新本地快照，下次從本地啟動仍保有此異動"""
+    if event is not None:
+        record_event(data, event, before, use_firebase=False)
+    write_local_snapshot(data)
+
+def save_data(data, event=None):
+    """儲存倉位資料到 Firebase (遠端已被其他裝置修改時不覆寫)
+
+    event 為此次異動的日誌事件 (如 {"op": "adjust_lots", "index": 0, "delta": 1})，
+    儲存成功後寫入倉位異動日誌。
+
+    Firebase 未初始化時改存本地日誌與本地快照 (視為儲存成功)；
+    Firebase 寫入失敗時同樣記入本地，但回傳 False。
+    """
+    # 其他持股不在各按鈕組成的文件中，沿用目前 session 的內容
+    data = {**data}
+    data.setdefault("holdings", st.session_state.holdings)
+    before = st.session_state.get("persisted_book")
+    if not st.session_state.get("firebase_initialized", False):
+        save_local(data, event, before)
+        st.session_state.persisted_book = normalize_portfolio(data)
+        return True
+    # 寫入與記錄期間持有日誌鎖：其他 session 的監聽器 sync 不會插在兩者之間而重複記錄此異動
+    with journal_lock(True):
+        try:
+            ok, remote_data, etag = storage.save_portfolio_if_unchanged(
+                data, st.session_state.get("portfolio_etag")
+            )
+            st.session_state.portfolio_etag = etag
+            if not ok:
+                st.session_state.persisted_book = normalize_portfolio(remote_data)
+                apply_book_to_session(remote_data)
+                st.toast("⚠️ 倉位已在其他裝置更新，已載入最新資料，請重新操作")
+                return False
+        except Exception as e:
+            st.error(f"Firebase 儲存失敗 (已記入本地紀錄): {e}")
+            save_local(data, event, before)
+            return False
+        st.session_state.persisted_book = normalize_portfolio(data)
+        if event is not None:
+            record_event(data, event, before)
+    write_local_snapshot(data)
+    return True
 
 # ======== 初始化 session state ========
 if "option_positions" not in st.session_state:
@@ -393,6 +534,15 @@ if "tse_index_price" not in st.session_state:
 if "hedge_ratio" not in st.session_state:
     st.session_state.hedge_ratio = 0.2  # 預設避險比例
 
+# 00631L 以外的持股 (0050、006208、00632R…)
+if "holdings" not in st.session_state:
+    st.session_state.holdings = []
+
+# session state 只保存倉位、設定與識別碼；網格、圖表與即時重算器皆放在共用快取
+if "session_marker" not in st.session_state:
+    st.session_state.session_marker = SessionMarker()
+    get_session_registry().add(st.session_state.session_marker)
+
 if "data_loaded" not in st.session_state:
     st.session_state.data_loaded = False
 
@@ -415,16 +565,53 @@ elif st.session_state.etf_current_price is None:
 if not st.session_state.data_loaded:
     saved_data = load_data()
     if saved_data:
-        st.session_state.etf_lots = float(saved_data.get("etf_lots", 0.0))
-        st.session_state.etf_cost = float(saved_data.get("etf_cost", 0.0))
-        st.session_state.hedge_ratio = float(saved_data.get("hedge_ratio", 0.2))
-        st.session_state.option_positions = saved_data.get("option_positions", [])
-        # 載入現金資料
-        st.session_state.cash_cost = float(saved_data.get("cash_cost", 0.0))
-        st.session_state.cash_current = float(saved_data.get("cash_current", 0.0))
-        # 現價不再從檔案讀取，改用 Yahoo Finance 即時價格
+        write_local_snapshot(saved_data)
+    else:
+        # Firebase 無法使用時改從本地快照啟動
+        saved_data = load_local_snapshot()
+        if saved_data and not st.session_state.get("firebase_initialized", False):
+            st.session_state.persisted_book = normalize_portfolio(saved_data)
+    if saved_data:
+        apply_book_to_session(saved_data)
     st.session_state.data_loaded = True
 
+# 其他持股現價：一次批次抓取 (抓不到時沿用上次儲存的價格)
+if st.session_state.holdings:
+    holding_prices = get_holding_prices(tuple(holding_ticker(h) for h in st.session_state.holdings))
+    st.session_state.holdings = [
+        dict(h, price=holding_prices.get(holding_ticker(h), h.get("price") or 0.0))
+        for h in st.session_state.holdings
+    ]
+
+# ********* 即時同步 (其他裝置 / PWA 的修改) *********
+if st.session_state.get("firebase_initialized", False):
+    portfolio_listener = get_portfolio_listener()
+    if "remote_version" not in st.session_state:
+        st.session_state.remote_version = portfolio_listener.version if portfolio_listener else 0
+
+    @st.fragment(run_every=REMOTE_SYNC_INTERVAL)
+    def watch_remote_changes():
+        """定期比對監聽器版本，只有畫面上的倉位真的改變時才重新執行整頁"""
+        if portfolio_listener is None:
+            return
+        version, remote_data = portfolio_listener.snapshot()
+        if version == st.session_state.remote_version:
+            return
+        st.session_state.remote_version = version
+        if remote_data is None:
+            return
+        # 未經本程式寫入的修改 (PWA 直接寫入 Firebase) 也記入日誌，重播才不會與實際倉位脫節
+        record_event(remote_data, None, st.session_state.get("persisted_book"))
+        # 任何遠端寫入 (包括只更新 ETF 現價的自動儲存) 都會改變 ETag，每次都重新取得，
+        # 避免下次儲存被誤判為衝突；倉位以同一次讀取的內容為準，與 ETag 一致
+        remote_data = load_data() or remote_data
+        remote_book = {field: normalize_portfolio(remote_data)[field] for field in BOOK_FIELDS}
+        if remote_book != visible_book():
+            apply_book_to_session(remote_data)
+            st.rerun(scope="app")
+
+    watch_remote_changes()
+
 # ======== 側邊欄設定 ========
 st.sidebar.markdown("## 📊 00631L 庫存設定")
 
@@ -463,6 +650,48 @@ etf_current = st.sidebar.number_input(
     help="00631L 的現價（自動抓取或手動輸入）"
 )
 
+st.sidebar.markdown("---")
+st.sidebar.markdown("## 📦 其他持股")
+
+old_holdings = st.session_state.holdings
+holdings_df = st.sidebar.data_editor(
+    pd.DataFrame(
+        [{k: h.get(k) for k in ("symbol", "lots", "cost", "beta")} for h in old_holdings],
+        columns=["symbol", "lots", "cost", "beta"],
+    ),
+    num_rows="dynamic",
+    hide_index=True,
+    column_config={
+        "symbol": st.column_config.SelectboxColumn("代號", options=[k for k in INSTRUMENTS if k != "00631L"], required=True),
+        "lots": st.column_config.NumberColumn("張數", min_value=0.0, step=0.1, format="%.2f"),
+        "cost": st.column_config.NumberColumn("成本", min_value=0.0, step=0.1, format="%.2f"),
+        "beta": st.column_config.NumberColumn("槓桿", step=0.1, format="%.1f", help="相對加權指數的倍數，空白則使用預設值 (反向 ETF 為負值)"),
+    },
+)
+old_prices = {h["symbol"]: h.get("price", 0.0) for h in old_holdings}
+# 新增列的空白儲存格為 NaN (不是 None)，一律以 pd.isna 判斷，避免 NaN 進入損益計算
+holdings = [
+    make_holding(
+        row["symbol"],
+        0.0 if pd.isna(row["lots"]) else row["lots"],
+        0.0 if pd.isna(row["cost"]) else row["cost"],
+        old_prices.get(row["symbol"]) or 0.0,
+        None if pd.isna(row["beta"]) else row["beta"],
+    )
+    for row in holdings_df.to_dict("records") if not pd.isna(row["symbol"])
+]
+if holdings != old_holdings and any(h["price"] == 0.0 for h in holdings):
+    # 新加入的代號立即批次抓價
+    holding_prices = get_holding_prices(tuple(holding_ticker(h) for h in holdings))
+    holdings = [dict(h, price=holding_prices.get(holding_ticker(h), h["price"])) for h in holdings]
+if holdings:
+    holdings_value = sum(h["price"] * h["lots"] * ETF_SHARES_PER_LOT for h in holdings)
+    holdings_pnl = sum((h["price"] - h["cost"]) * h["lots"] * ETF_SHARES_PER_LOT for h in holdings)
+    st.sidebar.caption(f"市值 {holdings_value:,.0f} 元 ｜ 未實現損益 {holdings_pnl:+,.0f} 元")
+    unpriced = [h["symbol"] for h in holdings if not h["price"] and h["lots"]]
+    if unpriced:
+        st.sidebar.warning(f"⚠️ 無法取得 {', '.join(unpriced)} 的現價，暫不計入損益")
+
 st.sidebar.markdown("---")
 st.sidebar.markdown("## 💰 現金設定")
 
@@ -518,6 +747,37 @@ PRICE_RANGE = st.sidebar.number_input(
     min_value=100,
 )
 
+st.sidebar.markdown("---")
+st.sidebar.markdown("## 💸 交易成本")
+
+include_costs = st.sidebar.toggle("計入手續費與交易稅", value=False, help="損益曲線、風險摘要與壓力測試皆改為扣除成本後的淨損益")
+if "cost_settings" not in st.session_state:
+    st.session_state.cost_settings = dict(COST_DEFAULTS)
+with st.sidebar.expander("費率設定", expanded=False):
+    cost_settings = st.session_state.cost_settings
+    cost_settings["option_fee"] = st.number_input("台指選擇權手續費 (元/口)", value=cost_settings["option_fee"], step=1.0, min_value=0.0)
+    cost_settings["micro_option_fee"] = st.number_input("微台選擇權手續費 (元/口)", value=cost_settings["micro_option_fee"], step=1.0, min_value=0.0)
+    cost_settings["futures_fee"] = st.number_input("微台期貨手續費 (元/口)", value=cost_settings["futures_fee"], step=1.0, min_value=0.0)
+    cost_settings["option_tax_rate"] = st.number_input("選擇權交易稅率", value=cost_settings["option_tax_rate"], step=0.0001, min_value=0.0, format="%.5f")
+    cost_settings["futures_tax_rate"] = st.number_input("期貨交易稅率", value=cost_settings["futures_tax_rate"], step=0.00001, min_value=0.0, format="%.5f")
+    cost_settings["etf_fee_rate"] = st.number_input("證券手續費率", value=cost_settings["etf_fee_rate"], step=0.0001, min_value=0.0, format="%.6f")
+    cost_settings["etf_tax_rate"] = st.number_input("ETF 證交稅率", value=cost_settings["etf_tax_rate"], step=0.0001, min_value=0.0, format="%.4f")
+    cost_settings["stock_tax_rate"] = st.number_input("個股證交稅率", value=cost_settings["stock_tax_rate"], step=0.0001, min_value=0.0, format="%.4f")
+costs = dict(st.session_state.cost_settings) if include_costs else None
+
+st.sidebar.markdown("---")
+st.sidebar.markdown("## 📡 即時損益")
+
+live_enabled = st.sidebar.toggle("盤中即時更新", value=False, help="背景輪詢報價，只更新目前價位的損益與 Delta")
+live_interval = st.sidebar.number_input(
+    "畫面更新間隔 (秒)",
+    value=5,
+    step=1,
+    min_value=1,
+    max_value=60,
+    disabled=not live_enabled,
+)
+
 # 更新 session state
 st.session_state.etf_lots = etf_lots
 st.session_state.etf_cost = etf_cost
@@ -525,6 +785,7 @@ st.session_state.etf_current_price = etf_current
 st.session_state.hedge_ratio = hedge_ratio
 st.session_state.cash_cost = cash_cost
 st.session_state.cash_current = cash_current
+st.session_state.holdings = holdings
 
 # 當前指數
 center = st.session_state.tse_index_price
@@ -535,13 +796,29 @@ st.sidebar.markdown(f"""
 </div>
 """, unsafe_allow_html=True)
 
+with st.sidebar.expander("🧮 快取狀態"):
+    cache_df = pd.DataFrame(region_stats())
+    st.dataframe(cache_df, hide_index=True, use_container_width=True)
+
+    rss = process_rss()
+    sessions = len(get_session_registry())
+    session_df = pd.DataFrame(session_memory_report(st.session_state))
+    col_rss, col_sessions, col_session = st.columns(3)
+    col_rss.metric("行程記憶體", f"{rss / 1024 ** 2:,.0f} MB" if rss else "-")
+    col_sessions.metric("存活 session", sessions)
+    col_session.metric("本 session", f"{session_df['bytes'].sum() / 1024:,.1f} KB" if not session_df.empty else "0 KB")
+    st.caption(f"共用快取 {cache_df['bytes'].sum() / 1024 ** 2:,.1f} MB")
+    if not session_df.empty:
+        st.dataframe(session_df.head(10), hide_index=True, use_container_width=True)
+
 # ********* 自動儲存 *********
 if (etf_lots != old_etf_lots or 
     etf_cost != old_etf_cost or 
     etf_current != old_etf_current or
     hedge_ratio != old_hedge_ratio or
     cash_cost != old_cash_cost or
-    cash_current != old_cash_current):
+    cash_current != old_cash_current or
+    holdings != old_holdings):
     save_data({
         "etf_lots": etf_lots,
         "etf_cost": etf_cost,
@@ -549,8 +826,17 @@ if (etf_lots != old_etf_lots or
         "hedge_ratio": hedge_ratio,
         "cash_cost": cash_cost,
         "cash_current": cash_current,
-        "option_positions": st.session_state.option_positions
-    })
+        "option_positions": st.session_state.option_positions,
+        "holdings": holdings,
+    }, event={"op": "update_settings", "fields": {
+        "etf_lots": etf_lots,
+        "etf_cost": etf_cost,
+        "etf_current_price": etf_current,
+        "hedge_ratio": hedge_ratio,
+        "cash_cost": cash_cost,
+        "cash_current": cash_current,
+        "holdings": holdings,
+    }})
     st.sidebar.success("✅ 已自動儲存", icon="💾")
 
 # ======== 主頁面 ========
@@ -559,8 +845,8 @@ if (etf_lots != old_etf_lots or
 col1, col2 = st.columns(2)
 with col1:
     if st.button("🔄 重新整理價格", use_container_width=True, help="重新抓取最新的 ETF 和指數價格"):
-        st.cache_data.clear()
-        st.success("✅ 已清除快取，將重新載入價格")
+        clear_region("quotes")
+        st.success("✅ 已清除報價快取，將重新載入價格")
         st.rerun()
 with col2:
     if st.button("🧹 清空所有倉位", use_container_width=True):
@@ -576,7 +862,7 @@ with col2:
             "cash_cost": st.session_state.cash_cost,
             "cash_current": st.session_state.cash_current,
             "option_positions": []
-        })
+        }, event={"op": "clear"})
         st.success("已清空所有資料")
         st.rerun()
 
@@ -684,7 +970,7 @@ if is_micro_futures:
             "cash_cost": st.session_state.cash_cost,
             "cash_current": st.session_state.cash_current,
             "option_positions": st.session_state.option_positions
-        })
+        }, event={"op": "add_position", "position": new_position})
         st.success("已新增微台期貨倉位")
         st.rerun()
 
@@ -725,7 +1011,7 @@ else:
             "cash_cost": st.session_state.cash_cost,
             "cash_current": st.session_state.cash_current,
             "option_positions": st.session_state.option_positions
-        })
+        }, event={"op": "add_position", "position": new_position})
         st.success("已新增選擇權倉位")
         st.rerun()
 
@@ -816,7 +1102,7 @@ if st.session_state.option_positions:
                         "cash_cost": st.session_state.cash_cost,
                         "cash_current": st.session_state.cash_current,
                         "option_positions": st.session_state.option_positions
-                    })
+                    }, event={"op": "adjust_lots", "index": i, "delta": -1})
                     st.rerun()
         
         with col_plus:
@@ -830,7 +1116,7 @@ if st.session_state.option_positions:
                     "cash_cost": st.session_state.cash_cost,
                     "cash_current": st.session_state.cash_current,
                     "option_positions": st.session_state.option_positions
-                })
+                }, event={"op": "adjust_lots", "index": i, "delta": 1})
                 st.rerun()
         
         with col_delete:
@@ -844,7 +1130,7 @@ if st.session_state.option_positions:
                     "cash_cost": st.session_state.cash_cost,
                     "cash_current": st.session_state.cash_current,
                     "option_positions": st.session_state.option_positions
-                })
+                }, event={"op": "delete_position", "index": i})
                 st.rerun()
         
         st.markdown("<hr style='margin: 5px 0;'>", unsafe_allow_html=True)
@@ -870,98 +1156,109 @@ if st.session_state.option_positions:
         </div>
     </div>
     """, unsafe_allow_html=True)
-    
+
+    st.markdown("</div>", unsafe_allow_html=True)
+
+# ======== 倉位異動紀錄 ========
+def describe_event(event):
+    """日誌事件的中文說明"""
+    op = event["op"]
+    if op == "add_position":
+        pos = event["position"]
+        if pos.get("type") == "Futures":
+            return f"新增 微台期貨 做空 {pos['strike']:,.0f} ×{pos['lots']} 口"
+        return f"新增 {pos['direction']} {pos['type']} {pos['strike']:,.0f} ×{pos['lots']} 口 @{pos.get('premium', 0):.0f}"
+    if op == "adjust_lots":
+        return f"倉位 #{event['index'] + 1} 口數 {event['delta']:+d}"
+    if op == "delete_position":
+        return f"刪除倉位 #{event['index'] + 1}"
+    if op == "update_settings":
+        return "更新庫存 / 現金 / 避險設定"
+    if op == "apply_changes":
+        return f"🔁 套用 {len(event['changes'])} 筆調整"
+    if op == "clear":
+        return "🧹 清空所有倉位"
+    if op == "restore":
+        return "↩️ 還原倉位"
+    if op == "sync":
+        return "🔄 其他裝置更新倉位"
+    return op
+
+if st.toggle("🕘 顯示倉位異動紀錄", key="show_journal"):
+    st.markdown("<div class='card'>", unsafe_allow_html=True)
+    st.markdown('<div class="section-title">🕘 倉位異動紀錄</div>', unsafe_allow_html=True)
+    try:
+        journal = get_journal(st.session_state.get("firebase_initialized", False))
+        journal_events = journal.recent_events(20)
+    except Exception as e:
+        st.error(f"異動紀錄讀取失敗: {e}")
+        journal_events = []
+
+    if not journal_events:
+        st.caption("尚無異動紀錄")
+    for event in reversed(journal_events):
+        col_desc, col_restore = st.columns([6, 1.3])
+        with col_desc:
+            st.markdown(f"`{event['ts']}` {describe_event(event)}")
+        with col_restore:
+            # 還原到此事件之前 (例如復原清空) 的狀態
+            if st.button("↩️ 還原至此前", key=f"restore_{event['id']}", use_container_width=True):
+                try:
+                    restored = journal.state_before(event["id"])
+                except Exception as e:
+                    st.error(f"無法重建此事件之前的倉位: {e}")
+                else:
+                    if restored is None:
+                        st.warning("此事件之前沒有可還原的紀錄")
+                    else:
+                        restored["etf_current_price"] = st.session_state.etf_current_price
+                        if save_data(restored, event={"op": "restore", "portfolio": restored}):
+                            apply_book_to_session(restored)
+                            st.rerun()
+
     st.markdown("</div>", unsafe_allow_html=True)
 
 # ======== 損益計算與圖表 ========
-if etf_lots > 0 or st.session_state.option_positions:
-    
-    # 計算損益函數
-    def calc_position_pnl(pos, settlement_price):
-        """計算單一倉位的損益（支援選擇權和期貨）"""
-        strike = pos["strike"]
-        lots = pos["lots"]
-        premium = pos.get("premium", 0)
-        
-        # 判斷產品類型
-        product_type = pos.get("product", "台指")
-        is_futures = product_type == "微台期貨" or pos.get("type") == "Futures"
-        
-        if is_futures:
-            # 微台期貨損益計算（做空）
-            # 做空損益 = (進場價 - 結算價) × 口數 × 10元
-            pnl = (strike - settlement_price) * lots * MICRO_OPTION_MULTIPLIER
-            return pnl
-        else:
-            # 選擇權損益計算
-            multiplier = MICRO_OPTION_MULTIPLIER if product_type == "微台" else OPTION_MULTIPLIER
-            
-            # 計算內含價值
-            if pos["type"] == "Call":
-                intrinsic = max(0.0, settlement_price - strike)
-            else:  # Put
-                intrinsic = max(0.0, strike - settlement_price)
-            
-            # 計算損益 = (內含價值 - 權利金) × 口數 × 乘數
-            if pos["direction"] == "買進":
-                pnl = (intrinsic - premium) * lots * multiplier
-            else:  # 賣出
-                pnl = (premium - intrinsic) * lots * multiplier
-            
-            return pnl
-    
-    def calc_etf_pnl(index_price, base_index, etf_lots, etf_cost, etf_current):
-        """計算 00631L 在不同指數價位下的損益"""
-        if etf_lots <= 0 or base_index <= 0:
-            return 0.0
-        
-        # 指數變動比例
-        index_change_pct = (index_price - base_index) / base_index
-        
-        # 00631L 是 2 倍槓桿，價格變動 = 指數變動 × 2
-        etf_price_change_pct = index_change_pct * LEVERAGE_00631L
-        
-        # 新的 ETF 價格
-        new_etf_price = etf_current * (1 + etf_price_change_pct)
-        
-        # 計算損益 = (新價格 - 成本) × 股數
-        shares = etf_lots * ETF_SHARES_PER_LOT
-        profit = (new_etf_price - etf_cost) * shares
-        
-        return profit
-    
+def costs_key(costs):
+    return None if costs is None else tuple(sorted(costs.items()))
+
+def book_cache_key(book, center, price_range, costs=None):
+    return (portfolio_hash(book), center, price_range, costs_key(costs))
+
+@cached("payoff", key=book_cache_key)
+def compute_payoff(book, center, price_range, costs=None):
+    """計算損益網格與風險摘要 (依倉位雜湊快取，所有 session 共用)"""
+    positions = book["option_positions"]
+    etf_args = (book["etf_lots"], book["etf_cost"], book["etf_current_price"])
+
     # 計算價格範圍
-    offsets = np.arange(-PRICE_RANGE, PRICE_RANGE + 1e-6, PRICE_STEP)
-    prices = [center + float(off) for off in offsets]
-    
-    # 計算各價位損益
-    etf_profits = []
-    option_profits = []
-    combined_profits = []
-    
-    for p in prices:
-        # ETF 損益
-        etf_pnl = calc_etf_pnl(p, center, etf_lots, etf_cost, etf_current)
-        etf_profits.append(etf_pnl)
-        
-        # 倉位組合損益（選擇權 + 期貨）
-        opt_pnl = sum(calc_position_pnl(pos, p) for pos in st.session_state.option_positions)
-        option_profits.append(opt_pnl)
-        
-        # 總損益
-        combined_profits.append(etf_pnl + opt_pnl)
-    
-    # ======== 損益曲線圖 ========
-    st.markdown("<div class='card'>", unsafe_allow_html=True)
-    st.markdown('<div class="section-title">📈 損益曲線</div>', unsafe_allow_html=True)
-    
+    prices = price_grid(center, price_range, PRICE_STEP)
+
+    # 計算各價位損益（ETF、倉位組合、總損益）
+    etf_profits, option_profits, combined_profits = calc_pnl_grid(
+        positions, prices, center, *etf_args, holdings=book["holdings"], costs=costs
+    )
+
+    payoff_profile = build_payoff_profile(positions, center, *etf_args, holdings=book["holdings"], costs=costs)
+    risk = analyze_risk(payoff_profile, center, center - price_range, center + price_range)
+    # 結果由所有 session 共用，設為唯讀避免被意外修改
+    for array in (prices, etf_profits, option_profits, combined_profits):
+        array.setflags(write=False)
+    return prices, etf_profits, option_profits, combined_profits, risk
+
+@cached("charts", key=book_cache_key)
+def render_pnl_chart(book, center, price_range, costs=None):
+    """繪製損益曲線並回傳 PNG (依倉位雜湊快取)"""
+    prices, etf_profits, option_profits, combined_profits, _ = compute_payoff(book, center, price_range, costs)
+
     fig, ax = plt.subplots(figsize=(12, 6))
     
     # 繪製各曲線
-    if etf_lots > 0:
-        ax.plot(prices, etf_profits, label="00631L", color="#3b82f6", linewidth=2, linestyle="--", alpha=0.7)
+    if book["etf_lots"] > 0 or book["holdings"]:
+        etf_label = "ETF / Stocks" if book["holdings"] else "00631L"
+        ax.plot(prices, etf_profits, label=etf_label, color="#3b82f6", linewidth=2, linestyle="--", alpha=0.7)
     
-    if st.session_state.option_positions:
+    if book["option_positions"]:
         ax.plot(prices, option_profits, label="Options", color="#f59e0b", linewidth=2, linestyle="--", alpha=0.7)
     
     ax.plot(prices, combined_profits, label="Total P/L", color="#10b981", linewidth=3)
@@ -972,7 +1269,7 @@ if etf_lots > 0 or st.session_state.option_positions:
     
     ax.set_xlabel("Settlement Index", fontsize=12)
     ax.set_ylabel("P/L (TWD)", fontsize=12)
-    ax.set_title("P/L Curve", fontsize=14, fontweight='bold')
+    ax.set_title("P/L Curve (net of costs)" if costs else "P/L Curve", fontsize=14, fontweight='bold')
     ax.legend(loc='best')
     ax.grid(True, alpha=0.3)
     
@@ -980,14 +1277,116 @@ if etf_lots > 0 or st.session_state.option_positions:
     ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda x, p: f'{x:,.0f}'))
     
     plt.tight_layout()
-    st.pyplot(fig)
-    plt.close()
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png")
+    plt.close(fig)
+    return buf.getvalue()
+
+def live_cache_key(book, center, costs=None):
+    return ("live", portfolio_hash(book), center, costs_key(costs))
+
+@cached("payoff", key=live_cache_key)
+def get_live_revaluer(book, center, costs=None):
+    """依倉位雜湊共用的即時重算器 (建立後唯讀，多個 session 可同時使用)"""
+    revaluer = LiveRevaluer()
+    revaluer.update_book(book, center, costs)
+    return revaluer
+
+# ======== 壓力測試設定 ========
+STRESS_INDEX_SHOCKS = [-0.15, -0.10, -0.07, -0.05, -0.03, -0.01, 0.0, 0.01, 0.03, 0.05, 0.07, 0.10, 0.15]
+STRESS_VOL_SHIFTS = [-0.05, 0.0, 0.05, 0.10, 0.20]
+STRESS_DAYS = [0, 1, 7, 14, 21, 30]
+STRESS_SCENARIO_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stress_scenarios.json")
+
+def stress_cache_key(book, center, days_to_expiry, base_vol, costs=None):
+    return ("stress", portfolio_hash(book), center, days_to_expiry, base_vol, costs_key(costs))
+
+@cached("payoff", key=stress_cache_key)
+def compute_stress(book, center, days_to_expiry, base_vol, costs=None):
+    """一次向量化計算整個壓力測試矩陣 (依倉位雜湊快取)"""
+    return calc_stress_matrix(
+        book, center, STRESS_INDEX_SHOCKS, STRESS_VOL_SHIFTS, STRESS_DAYS, days_to_expiry, base_vol,
+        costs=costs,
+    )
+
+@st.cache_data
+def load_stress_scenarios():
+    """讀取歷史情境設定檔"""
+    try:
+        with open(STRESS_SCENARIO_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+def compute_scenarios(book, center, days_to_expiry, base_vol, costs=None):
+    """各歷史情境的組合損益 (天數不超過到期日)"""
+    return [
+        float(calc_stress_matrix(
+            book, center, [sc["index_shock"]], [sc["vol_shift"]], [min(sc["days"], days_to_expiry)],
+            days_to_expiry, base_vol, costs=costs,
+        )[0, 0, 0])
+        for sc in load_stress_scenarios()
+    ]
+
+# ======== 策略範本 ========
+STRATEGY_TOP = 30  # 畫面上列出的組合數
+
+def strategy_cache_key(book, center, price_range, days_to_expiry, vol, templates, costs=None):
+    return ("strategies", portfolio_hash(book), center, price_range, days_to_expiry, vol, templates, costs_key(costs))
+
+@cached("payoff", key=strategy_cache_key)
+def compute_strategy_ranking(book, center, price_range, days_to_expiry, vol, templates, costs=None):
+    """產生所有範本組合並一次批次評估，回傳排序後的表格列 (依倉位雜湊快取)"""
+    lots = hedge_lots(book["etf_lots"], book["hedge_ratio"])
+    variants = price_variants(generate_variants(center, lots, templates), center, days_to_expiry, vol)
+    results = evaluate_variants(variants, book, center, price_range, PRICE_STEP, costs)
+    return rank_variants(variants, results)
+
+# ======== 快照匯出 / 匯入 ========
+with st.sidebar.expander("💾 快照匯出 / 匯入"):
+    export_book = normalize_portfolio({**visible_book(), "etf_current_price": etf_current})
+    export_prices, export_etf, export_options, export_total, _ = compute_payoff(export_book, center, PRICE_RANGE, costs)
+    st.download_button(
+        "⬇️ 匯出快照 (.npz)",
+        data=snapshot_bytes(export_book, {
+            "prices": export_prices, "etf": export_etf, "options": export_options, "total": export_total,
+        }),
+        file_name=f"hedge_snapshot_{datetime.now():%Y%m%d_%H%M}.npz",
+        mime="application/octet-stream",
+        use_container_width=True,
+    )
+    uploaded_snapshot = st.file_uploader("匯入快照", type=["npz"], key="snapshot_upload")
+    if uploaded_snapshot is not None:
+        try:
+            imported, _ = load_snapshot(uploaded_snapshot)
+        except Exception as e:
+            st.error(f"快照讀取失敗: {e}")
+        else:
+            st.caption(f"選擇權 {len(imported['option_positions'])} 筆 ｜ 00631L {imported['etf_lots']:.2f} 張 ｜ 其他持股 {len(imported['holdings'])} 檔")
+            if st.button("📥 以此快照取代目前倉位", use_container_width=True):
+                imported["etf_current_price"] = st.session_state.etf_current_price
+                if save_data(imported, event={"op": "restore", "portfolio": imported}):
+                    apply_book_to_session(imported)
+                    st.rerun()
+
+if etf_lots > 0 or holdings or st.session_state.option_positions:
+    
+    book = normalize_portfolio({**visible_book(), "etf_current_price": etf_current})
+    # 沒有現價的持股 (抓價失敗) 不以 0 計價，暫時排除
+    book["holdings"] = [h for h in book["holdings"] if h["price"]]
+    prices, etf_profits, option_profits, combined_profits, risk = compute_payoff(book, center, PRICE_RANGE, costs)
+    
+    # ======== 損益曲線圖 ========
+    st.markdown("<div class='card'>", unsafe_allow_html=True)
+    st.markdown('<div class="section-title">📈 損益曲線</div>', unsafe_allow_html=True)
+    
+    st.image(render_pnl_chart(book, center, PRICE_RANGE, costs), use_container_width=True)
     
     # 中文圖例說明
     st.markdown("""
     <div style='font-size: 13px; color: #64748b; margin-top: -10px; padding: 8px 15px; background-color: #f8fafc; border-radius: 6px;'>
         📊 <b>圖例說明：</b>
-        <span style='color: #3b82f6;'>00631L</span> = ETF損益 | 
+        <span style='color: #3b82f6;'>00631L / ETF / Stocks</span> = ETF 與持股損益 | 
         <span style='color: #f59e0b;'>Options</span> = 選擇權組合 | 
         <span style='color: #10b981;'>Total P/L</span> = 組合總損益 | 
         <span style='color: red;'>Current</span> = 現價
@@ -995,7 +1394,370 @@ if etf_lots > 0 or st.session_state.option_positions:
     """, unsafe_allow_html=True)
     
     st.markdown("</div>", unsafe_allow_html=True)
-    
+
+    # ======== 風險摘要 ========
+    if risk["breakevens"]:
+        breakeven_display = "<br>".join(f"{x:,.0f}" for x in risk["breakevens"])
+    else:
+        breakeven_display = "區間內無"
+    hedge_trigger_display = f"{risk['hedge_trigger']:,.0f}" if risk["hedge_trigger"] is not None else "未設定保護"
+    max_loss_class = "profit" if risk["max_loss"] >= 0 else "loss"
+    max_profit_class = "profit" if risk["max_profit"] >= 0 else "loss"
+
+    tail_warnings = []
+    if risk["downside_slope"] > 0:
+        tail_warnings.append(f"跌破 {center - PRICE_RANGE:,.0f} 後每跌 1 點虧損 {risk['downside_slope']:,.0f} 元")
+    if risk["upside_slope"] < 0:
+        tail_warnings.append(f"漲破 {center + PRICE_RANGE:,.0f} 後每漲 1 點虧損 {-risk['upside_slope']:,.0f} 元")
+    tail_display = "；".join(tail_warnings) if tail_warnings else "區間外無額外虧損擴大"
+
+    st.markdown(f"""
+    <div class='card'>
+        <div class="section-title">🎯 風險摘要</div>
+        <div style='display: grid; grid-template-columns: repeat(4, 1fr); gap: 12px;'>
+            <div style='background: var(--glass-bg); padding: 10px; border-radius: 10px; border: 1px solid var(--border-color);'>
+                <div style='font-size: 11px; color: var(--text-secondary); margin-bottom: 4px;'>損益兩平指數</div>
+                <div style='font-size: 16px; font-weight: 700; color: var(--text-primary);'>{breakeven_display}</div>
+            </div>
+            <div style='background: var(--glass-bg); padding: 10px; border-radius: 10px; border: 1px solid var(--border-color);'>
+                <div style='font-size: 11px; color: var(--text-secondary); margin-bottom: 4px;'>區間最大虧損</div>
+                <div style='font-size: 16px; font-weight: 700;' class='{max_loss_class}'>{risk['max_loss']:+,.0f} 元</div>
+                <div style='font-size: 10px; color: var(--text-secondary);'>@ {risk['max_loss_index']:,.0f}</div>
+            </div>
+            <div style='background: var(--glass-bg); padding: 10px; border-radius: 10px; border: 1px solid var(--border-color);'>
+                <div style='font-size: 11px; color: var(--text-secondary); margin-bottom: 4px;'>區間最大獲利</div>
+                <div style='font-size: 16px; font-weight: 700;' class='{max_profit_class}'>{risk['max_profit']:+,.0f} 元</div>
+                <div style='font-size: 10px; color: var(--text-secondary);'>@ {risk['max_profit_index']:,.0f}</div>
+            </div>
+            <div style='background: var(--glass-bg); padding: 10px; border-radius: 10px; border: 1px solid var(--border-color);'>
+                <div style='font-size: 11px; color: var(--text-secondary); margin-bottom: 4px;'>避險啟動點</div>
+                <div style='font-size: 16px; font-weight: 700; color: var(--text-primary);'>{hedge_trigger_display}</div>
+            </div>
+        </div>
+        <div style='margin-top: 10px; padding: 8px 10px; background-color: #fef3c7; border-radius: 8px; font-size: 12px;'>
+            <span style='font-weight:700; color:#92400e;'>⚠️ 區間外:</span> {tail_display}
+        </div>
+    </div>
+    """, unsafe_allow_html=True)
+
+    # ======== 交易成本明細 ========
+    if costs is not None:
+        with st.expander("💸 交易成本明細 (以現價結算估算)", expanded=False):
+            cost_rows = []
+            active_positions = [pos for pos in book["option_positions"] if pos.get("lots")]
+            leg_costs = calc_leg_cost_grid(active_positions, [center], costs)
+            for i, pos in enumerate(active_positions):
+                fee = float(leg_costs["fee"][i, 0])
+                tax = float(leg_costs["tax"][i, 0])
+                cost_rows.append({
+                    "項目": f"{pos.get('direction', '賣出')} {pos.get('product', '台指')} {pos['type']} {pos['strike']:,.0f}",
+                    "口數/張數": pos["lots"],
+                    "手續費 (來回)": fee,
+                    "交易稅": tax,
+                    "合計": fee + tax,
+                    # 換算成每口點數，便於與權利金比較
+                    "每口成本 (點)": (fee + tax) / (pos["lots"] * position_multiplier(pos)),
+                })
+
+            def sell_cost_row(symbol, lots, total):
+                # 賣出成本依費率比例拆為手續費與證交稅
+                tax_rate = costs["etf_tax_rate"] if symbol in INSTRUMENTS else costs["stock_tax_rate"]
+                rate = costs["etf_fee_rate"] + tax_rate
+                fee = total * costs["etf_fee_rate"] / rate if rate else 0.0
+                return {"項目": f"{symbol} 賣出", "口數/張數": lots, "手續費 (來回)": fee, "交易稅": total - fee, "合計": total, "每口成本 (點)": None}
+
+            if book["etf_lots"] > 0:
+                etf_sell_cost = float(calc_etf_cost_grid([center], center, book["etf_lots"], book["etf_current_price"] or 0.0, costs)[0])
+                cost_rows.append(sell_cost_row("00631L", book["etf_lots"], etf_sell_cost))
+            if book["holdings"]:
+                holding_costs = calc_holdings_cost_grid(book["holdings"], [center], center, costs)[:, 0]
+                for h, cost in zip(book["holdings"], holding_costs):
+                    cost_rows.append(sell_cost_row(h["symbol"], h["lots"], float(cost)))
+            if cost_rows:
+                cost_df = pd.DataFrame(cost_rows)
+                st.dataframe(
+                    cost_df.style.format({
+                        "手續費 (來回)": "{:,.0f}", "交易稅": "{:,.0f}", "合計": "{:,.0f}", "每口成本 (點)": "{:.2f}",
+                    }, na_rep="-"),
+                    use_container_width=True, hide_index=True,
+                )
+                st.caption(f"成本合計 {cost_df['合計'].sum():,.0f} 元；選擇權交易稅含進場權利金與到期結算金額，持股只計賣出成本")
+
+    # ======== 調整模擬 (What-if) ========
+    # 暫存調整以原倉位的 index 記錄，倉位列表變動後即作廢
+    positions_key = portfolio_hash({"option_positions": book["option_positions"]})
+    if st.session_state.get("staged_for") != positions_key:
+        st.session_state.staged_changes = []
+        st.session_state.staged_for = positions_key
+
+    def position_label(pos):
+        if pos.get("type") == "Futures":
+            return f"微台期貨 做空 {pos['strike']:,.0f} ×{pos['lots']} 口"
+        return f"{pos['direction']} {pos['type']} {pos['strike']:,.0f} ×{pos['lots']} 口 @{pos.get('premium', 0):.0f}"
+
+    with st.expander("🔁 調整模擬 (平倉 / 轉倉 What-if)", expanded=bool(st.session_state.staged_changes)):
+        positions = book["option_positions"]
+        col_close, col_open = st.columns(2)
+
+        with col_close:
+            st.markdown("**平倉現有倉位**")
+            if positions:
+                close_index = st.selectbox(
+                    "倉位", range(len(positions)),
+                    format_func=lambda i: f"#{i+1} {position_label(positions[i])}", key="roll_close_index",
+                )
+                already_closed = sum(
+                    c["lots"] for c in st.session_state.staged_changes
+                    if c["op"] == "close" and c["index"] == close_index
+                )
+                max_close = positions[close_index]["lots"] - already_closed
+                if max_close > 0:
+                    close_lots = st.number_input("平倉口數", min_value=1, max_value=max_close, value=max_close, step=1, key="roll_close_lots")
+                    # 期貨以指數價位平倉，預設為目前指數 (預設 0 會算出每口數十萬的假獲利)；選擇權預設權利金歸零
+                    default_close = float(center) if is_futures_position(positions[close_index]) else 0.0
+                    close_price = st.number_input(
+                        "平倉價格 (點)", min_value=0.0, step=1.0, value=default_close,
+                        key=f"roll_close_price_{close_index}",
+                    )
+                    if st.button("暫存平倉", use_container_width=True, key="stage_close"):
+                        st.session_state.staged_changes.append(
+                            {"op": "close", "index": close_index, "lots": int(close_lots), "price": float(close_price)}
+                        )
+                        st.rerun()
+                else:
+                    st.caption("此倉位已全部暫存平倉")
+            else:
+                st.caption("尚無倉位")
+
+        with col_open:
+            st.markdown("**新開倉位**")
+            roll_type = st.selectbox("類型", ["Put", "Call"], key="roll_open_type")
+            roll_direction = st.radio("方向", ["買進", "賣出"], horizontal=True, key="roll_open_direction")
+            roll_strike = st.number_input("履約價", min_value=0.0, step=100.0, value=float(round(center / 100) * 100), key="roll_open_strike")
+            roll_lots = st.number_input("口數", min_value=1, step=1, value=1, key="roll_open_lots")
+            roll_premium = st.number_input("權利金 (點)", min_value=0.0, step=1.0, value=0.0, key="roll_open_premium")
+            if st.button("暫存新倉", use_container_width=True, key="stage_open"):
+                st.session_state.staged_changes.append({"op": "open", "position": {
+                    "product": "台指",
+                    "type": roll_type,
+                    "direction": roll_direction,
+                    "strike": float(roll_strike),
+                    "lots": int(roll_lots),
+                    "premium": float(roll_premium),
+                }})
+                st.rerun()
+
+        staged = st.session_state.staged_changes
+        if staged:
+            st.markdown("**暫存調整**")
+            for k, change in enumerate(staged):
+                col_desc, col_remove = st.columns([6, 0.8])
+                with col_desc:
+                    if change["op"] == "close":
+                        st.markdown(f"➖ 平倉 #{change['index']+1} {change['lots']} 口 @{change['price']:.0f}")
+                    else:
+                        st.markdown(f"➕ 新倉 {position_label(change['position'])}")
+                with col_remove:
+                    if st.button("✖", key=f"unstage_{k}", use_container_width=True):
+                        staged.pop(k)
+                        st.rerun()
+
+            # 在快取的基準網格上加上調整增量，只計算被調整的倉位
+            adjusted_profits = combined_profits + staged_changes_delta(positions, staged, prices, costs)
+            adjusted_book = dict(book, option_positions=apply_staged_changes(positions, staged))
+            # 風險摘要由調整後倉位的分段線性結構計算 (不重算網格)，平倉已實現損益為固定平移，與曲線一致
+            adjusted_profile = offset_profile(
+                build_payoff_profile(
+                    adjusted_book["option_positions"], center,
+                    book["etf_lots"], book["etf_cost"], book["etf_current_price"],
+                    holdings=book["holdings"], costs=costs,
+                ),
+                staged_changes_realized(positions, staged, costs),
+            )
+            adjusted_risk = analyze_risk(adjusted_profile, center, center - PRICE_RANGE, center + PRICE_RANGE)
+
+            compare_df = pd.DataFrame({"調整前": combined_profits, "調整後": adjusted_profits}, index=prices)
+            compare_df.index.name = "結算指數"
+            st.line_chart(compare_df)
+
+            st.dataframe(pd.DataFrame({
+                "項目": ["區間最大虧損", "區間最大獲利", "損益兩平點"],
+                "調整前": [
+                    f"{risk['max_loss']:+,.0f}", f"{risk['max_profit']:+,.0f}",
+                    ", ".join(f"{x:,.0f}" for x in risk["breakevens"]) or "區間內無",
+                ],
+                "調整後": [
+                    f"{adjusted_risk['max_loss']:+,.0f}", f"{adjusted_risk['max_profit']:+,.0f}",
+                    ", ".join(f"{x:,.0f}" for x in adjusted_risk["breakevens"]) or "區間內無",
+                ],
+            }), hide_index=True, use_container_width=True)
+            st.caption("📌 調整後曲線與摘要皆含平倉的已實現損益；套用後倉位列表不保留已實現損益")
+
+            col_apply, col_discard = st.columns(2)
+            with col_apply:
+                if st.button("✅ 套用所有調整", use_container_width=True, key="apply_staged"):
+                    # 儲存成功才更新倉位並清除暫存；衝突或 Firebase 無法寫入時保留暫存調整，可再次套用
+                    if save_data({
+                        "etf_lots": st.session_state.etf_lots,
+                        "etf_cost": st.session_state.etf_cost,
+                        "etf_current_price": st.session_state.etf_current_price,
+                        "hedge_ratio": st.session_state.hedge_ratio,
+                        "cash_cost": st.session_state.cash_cost,
+                        "cash_current": st.session_state.cash_current,
+                        "option_positions": adjusted_book["option_positions"]
+                    }, event={"op": "apply_changes", "changes": list(staged)}):
+                        st.session_state.option_positions = adjusted_book["option_positions"]
+                        st.session_state.staged_changes = []
+                    st.rerun()
+            with col_discard:
+                if st.button("🗑️ 放棄調整", use_container_width=True, key="discard_staged"):
+                    st.session_state.staged_changes = []
+                    st.rerun()
+
+    # ======== 策略範本 ========
+    with st.expander("🧩 策略範本 (依成本 / 保護效果排序)"):
+        template_names = st.multiselect(
+            "範本", list(TEMPLATES), default=list(TEMPLATES),
+            format_func=lambda name: TEMPLATES[name][0], key="strategy_templates",
+        )
+        col_dte, col_vol, col_budget = st.columns(3)
+        with col_dte:
+            strategy_dte = st.number_input("距到期天數", min_value=1, max_value=365, value=30, step=1, key="strategy_dte")
+        with col_vol:
+            strategy_vol = st.number_input("隱含波動率 (%)", min_value=1.0, max_value=150.0, value=20.0, step=1.0, key="strategy_vol")
+        with col_budget:
+            strategy_budget = st.number_input("成本上限 (元，0 = 不限)", min_value=0.0, value=0.0, step=1000.0, key="strategy_budget")
+        st.caption(
+            f"基準口數 {hedge_lots(book['etf_lots'], book['hedge_ratio'])} 口 "
+            f"(00631L {book['etf_lots']:.2f} 張 × 避險比例 {book['hedge_ratio']:.2f})，權利金以 Black-Scholes 理論價估算"
+        )
+
+        if template_names:
+            ranked = compute_strategy_ranking(
+                book, center, PRICE_RANGE, strategy_dte, strategy_vol / 100, tuple(template_names), costs
+            )
+            shown = [r for r in ranked if strategy_budget <= 0 or r["cost"] <= strategy_budget][:STRATEGY_TOP]
+            if shown:
+                strategy_df = pd.DataFrame([{
+                    "前緣": "⭐" if r["pareto"] else "",
+                    "策略": r["label"],
+                    "倉位": describe_legs(r["legs"]),
+                    "成本": r["cost"],
+                    "最差損益改善": r["protection"],
+                    "區間低點改善": r["tail"],
+                    "區間高點變化": -r["upside_drag"],
+                } for r in shown])
+                st.dataframe(
+                    strategy_df.style.format({
+                        "成本": "{:+,.0f}", "最差損益改善": "{:+,.0f}", "區間低點改善": "{:+,.0f}", "區間高點變化": "{:+,.0f}",
+                    }),
+                    use_container_width=True, hide_index=True,
+                )
+                st.caption(f"共評估 {len(ranked)} 個組合；⭐ 為成本 / 保護的柏拉圖前緣 (沒有更便宜且保護更多的組合)")
+                pick = st.selectbox(
+                    "選擇組合", range(len(shown)),
+                    format_func=lambda i: f"#{i+1} {shown[i]['label']} {describe_legs(shown[i]['legs'])}",
+                    key="strategy_pick",
+                )
+                if st.button("➕ 加入調整模擬", use_container_width=True, key="stage_strategy"):
+                    for leg in shown[pick]["legs"]:
+                        st.session_state.staged_changes.append({"op": "open", "position": dict(leg)})
+                    st.rerun()
+            else:
+                st.info("沒有符合成本上限的組合")
+
+    # ======== 壓力測試 ========
+    with st.expander("🧪 壓力測試 (指數 × 波動率 × 天數)"):
+        col_dte, col_vol = st.columns(2)
+        with col_dte:
+            stress_dte = st.number_input("距到期天數", min_value=0, max_value=365, value=30, step=1, key="stress_dte")
+        with col_vol:
+            stress_vol = st.number_input("基準隱含波動率 (%)", min_value=1.0, max_value=150.0, value=20.0, step=1.0, key="stress_vol")
+
+        stress_days = sorted({d for d in STRESS_DAYS if d <= stress_dte} | {0})
+        stress = compute_stress(book, center, stress_dte, stress_vol / 100, costs)
+
+        stress_day = st.select_slider("經過天數", options=stress_days, value=0, key="stress_day")
+        day_i = stress_days.index(stress_day)
+        matrix_df = pd.DataFrame(
+            stress[:, :, day_i],
+            index=[f"{x:+.0%}" for x in STRESS_INDEX_SHOCKS],
+            columns=[f"IV {x * 100:+.0f}" for x in STRESS_VOL_SHIFTS],
+        )
+        matrix_df.index.name = "指數變動"
+        st.dataframe(
+            matrix_df.style.format("{:+,.0f}").map(lambda v: 'color: #10b981' if v > 0 else 'color: #ef4444' if v < 0 else ''),
+            use_container_width=True,
+        )
+
+        # 匯出完整 3 維結果 (長表格)
+        shock_grid, vol_grid, day_grid = np.meshgrid(STRESS_INDEX_SHOCKS, STRESS_VOL_SHIFTS, STRESS_DAYS, indexing="ij")
+        export_df = pd.DataFrame({
+            "指數變動": shock_grid.ravel(),
+            "結算指數": center * (1 + shock_grid.ravel()),
+            "波動率變動": vol_grid.ravel(),
+            "經過天數": day_grid.ravel(),
+            "總損益": stress.ravel(),
+        })
+        export_df = export_df[export_df["經過天數"] <= stress_dte]
+        st.download_button(
+            "⬇️ 匯出壓力測試 CSV", export_df.to_csv(index=False).encode("utf-8-sig"),
+            file_name=f"stress_{date.today():%Y%m%d}.csv", mime="text/csv",
+        )
+
+        scenarios = load_stress_scenarios()
+        if scenarios:
+            st.markdown("**歷史情境**")
+            scenario_pnl = compute_scenarios(book, center, stress_dte, stress_vol / 100, costs)
+            st.dataframe(pd.DataFrame({
+                "情境": [sc["name"] for sc in scenarios],
+                "指數變動": [f"{sc['index_shock']:+.1%}" for sc in scenarios],
+                "波動率變動": [f"{sc['vol_shift'] * 100:+.0f}" for sc in scenarios],
+                "天數": [min(sc["days"], stress_dte) for sc in scenarios],
+                "總損益": [f"{v:+,.0f}" for v in scenario_pnl],
+                "說明": [sc.get("description", "") for sc in scenarios],
+            }), hide_index=True, use_container_width=True)
+
+    # ======== 盤中即時損益 ========
+    if live_enabled:
+        if "live_queue" not in st.session_state:
+            st.session_state.live_queue = get_quote_streamer().subscribe()
+            st.session_state.live_last = None
+        if st.session_state.get("live_costs") != costs_key(costs):
+            # 切換成本設定後重新計算，避免與前一筆 (不同口徑) 比較
+            st.session_state.live_costs = costs_key(costs)
+            st.session_state.live_last = None
+
+
+        @st.fragment(run_every=live_interval)
+        def live_pnl_panel():
+            """只重繪此區塊：取出最新 tick 並重算目前價位的損益"""
+            revaluer = get_live_revaluer(book, center, costs)
+            tick = drain_latest(st.session_state.live_queue)
+            previous = st.session_state.live_last
+            if tick is not None:
+                st.session_state.live_last = revaluer.revalue(tick, center)
+            live = st.session_state.live_last
+
+            st.markdown('<div class="section-title">📡 盤中即時損益</div>', unsafe_allow_html=True)
+            if live is None:
+                st.caption("等待報價中…")
+                return
+            change = live["total_pnl"] - previous["total_pnl"] if previous and tick is not None else None
+            c1, c2, c3, c4 = st.columns(4)
+            c1.metric("即時指數", f"{live['index']:,.0f}", f"{live['index'] - center:+,.0f}")
+            c2.metric("目前總損益", f"{live['total_pnl']:+,.0f} 元", f"{change:+,.0f}" if change is not None else None)
+            c3.metric("倉位組合損益", f"{live['option_pnl']:+,.0f} 元")
+            c4.metric("Delta (元/點)", f"{live['delta']:+,.1f}", f"倉位 {live['option_delta']:+,.0f}", delta_color="off")
+            st.caption(f"最後報價: {datetime.fromtimestamp(live['ts']).strftime('%H:%M:%S')}"
+                       + (" ｜ 已扣除手續費與交易稅" if costs is not None else ""))
+
+        live_pnl_panel()
+    elif "live_queue" in st.session_state:
+        # 關閉即時更新即退訂；所有 session 都退訂後報價執行緒暫停輪詢
+        get_quote_streamer().unsubscribe(st.session_state.live_queue)
+        del st.session_state.live_queue
+
     # ======== 損益試算表 ========
     st.markdown("<div class='card'>", unsafe_allow_html=True)
     st.markdown('<div class="section-title">📊 損益試算表</div>', unsafe_allow_html=True)
@@ -1006,8 +1768,9 @@ if etf_lots > 0 or st.session_state.option_positions:
         "指數變動": [f"{p - center:+,.0f}" for p in prices],
     }
     
-    if etf_lots > 0:
-        table_data["00631L"] = [f"{pnl:+,.0f}" for pnl in etf_profits]
+    etf_column = "00631L + 持股" if holdings else "00631L"
+    if etf_lots > 0 or holdings:
+        table_data[etf_column] = [f"{pnl:+,.0f}" for pnl in etf_profits]
     
     if st.session_state.option_positions:
         table_data["選擇權組合"] = [f"{pnl:+,.0f}" for pnl in option_profits]
@@ -1030,8 +1793,8 @@ if etf_lots > 0 or st.session_state.option_positions:
     
     # 顯示表格
     styled_df = df.style.map(style_pnl, subset=["總損益"])
-    if etf_lots > 0:
-        styled_df = styled_df.map(style_pnl, subset=["00631L"])
+    if etf_lots > 0 or holdings:
+        styled_df = styled_df.map(style_pnl, subset=[etf_column])
     if st.session_state.option_positions:
         styled_df = styled_df.map(style_pnl, subset=["選擇權組合"])
     
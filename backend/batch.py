@@ -0,0 +1,214 @@
+# ======== 批次評估多份倉位檔 ========
+# 以相同情境 (指數中心 / 模擬範圍) 評估多份 hedge_positions.json 格式的倉位檔，
+# 透過 process pool 平行計算，結果逐檔串流寫入 CSV 或 Parquet。
+#
+# 範例 (於 backend 目錄):
+#     python batch.py ../accounts/ --center 27800 --price-range 1500 -o nightly.csv
+#     python batch.py "../accounts/*.json" --scenario scenario.json -o nightly.parquet
+
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from hedge_core import (
+    PRICE_STEP,
+    normalize_portfolio,
+    portfolio_hash,
+    calc_pnl_grid,
+    price_grid,
+)
+from snapshot import load_snapshot
+
+OUTPUT_COLUMNS = [
+    "file", "hash", "settlement_index", "index_change",
+    "etf_pnl", "option_pnl", "total_pnl",
+]
+
+
+def find_portfolio_files(inputs):
+    """展開目錄 / glob 參數為倉位檔路徑列表"""
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths.extend(sorted(
+                glob.glob(os.path.join(item, "*.json")) + glob.glob(os.path.join(item, "*.npz"))
+            ))
+        else:
+            paths.extend(sorted(glob.glob(item)))
+    return paths
+
+
+def load_scenario(args):
+    """合併情境檔與命令列參數 (命令列優先)"""
+    scenario = {"center": None, "price_range": 1500.0, "step": PRICE_STEP, "etf_current_price": None, "costs": None}
+    if args.scenario:
+        with open(args.scenario, encoding="utf-8") as f:
+            scenario.update(json.load(f))
+    for key in scenario:
+        value = getattr(args, key, None)
+        if value is not None:
+            scenario[key] = value
+    return scenario
+
+
+def evaluate_file(path, scenario):
+    """評估單一倉位檔，回傳欄位陣列 (於子行程執行)"""
+    if path.endswith(".npz"):
+        # 二進位快照 (snapshot.py)，以記憶體映射讀取，不需解析 JSON
+        portfolio, _ = load_snapshot(path)
+    else:
+        with open(path, encoding="utf-8") as f:
+            portfolio = normalize_portfolio(json.load(f))
+
+    center = scenario["center"]
+    etf_current = scenario["etf_current_price"] or portfolio["etf_current_price"]
+    if etf_current is None:
+        if portfolio["etf_lots"]:
+            # 以 0 代入會把 ETF 損益算成 -成本 × 股數，寧可讓此檔失敗
+            raise ValueError("倉位檔沒有 00631L 現價 (etf_current_price)，請以 --etf-price 指定")
+        etf_current = 0.0
+    missing = [h["symbol"] for h in portfolio["holdings"] if h["price"] is None and h["lots"]]
+    if missing:
+        raise ValueError(f"倉位檔的持股 {', '.join(map(str, missing))} 沒有現價 (price)")
+    # costs 可為 true (使用預設費率) 或覆寫部分費率的 dict
+    costs = scenario["costs"]
+    costs = (costs if isinstance(costs, dict) else {}) if costs else None
+    prices = price_grid(center, scenario["price_range"], scenario["step"])
+    etf_profits, option_profits, combined_profits = calc_pnl_grid(
+        portfolio["option_positions"], prices, center,
+        portfolio["etf_lots"], portfolio["etf_cost"], etf_current,
+        holdings=portfolio["holdings"], costs=costs,
+    )
+    return {
+        "file": path,
+        "hash": portfolio_hash(portfolio),
+        "settlement_index": prices,
+        "index_change": prices - center,
+        "etf_pnl": etf_profits,
+        "option_pnl": option_profits,
+        "total_pnl": combined_profits,
+    }
+
+
+def iter_results(paths, scenario, workers):
+    """以有限的在途工作數平行評估，完成一檔就回傳一檔 (path, future)"""
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        path_iter = iter(paths)
+        max_in_flight = max(1, workers or os.cpu_count() or 1) * 4
+
+        for path in path_iter:
+            pending[executor.submit(evaluate_file, path, scenario)] = path
+            if len(pending) >= max_in_flight:
+                break
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future
+                next_path = next(path_iter, None)
+                if next_path is not None:
+                    pending[executor.submit(evaluate_file, next_path, scenario)] = next_path
+
+
+class CsvSink:
+    """逐檔附加寫入 CSV"""
+
+    def __init__(self, path):
+        self.f = open(path, "w", newline="", encoding="utf-8") if path != "-" else sys.stdout
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(OUTPUT_COLUMNS)
+
+    def write(self, result):
+        n = len(result["settlement_index"])
+        columns = [result[c] if c not in ("file", "hash") else [result[c]] * n for c in OUTPUT_COLUMNS]
+        self.writer.writerows(zip(*columns))
+
+    def close(self):
+        if self.f is not sys.stdout:
+            self.f.close()
+
+
+class ParquetSink:
+    """每檔寫入一個 row group，避免整批結果留在記憶體"""
+
+    def __init__(self, path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("輸出 Parquet 需要安裝 pyarrow (pip install pyarrow)")
+        self.pa = pa
+        self.schema = pa.schema([
+            ("file", pa.string()),
+            ("hash", pa.string()),
+            ("settlement_index", pa.float64()),
+            ("index_change", pa.float64()),
+            ("etf_pnl", pa.float64()),
+            ("option_pnl", pa.float64()),
+            ("total_pnl", pa.float64()),
+        ])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, result):
+        n = len(result["settlement_index"])
+        columns = {c: result[c] if c not in ("file", "hash") else [result[c]] * n for c in OUTPUT_COLUMNS}
+        self.writer.write_table(self.pa.table(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def open_sink(path):
+    """依副檔名選擇輸出格式"""
+    if path.endswith(".parquet"):
+        return ParquetSink(path)
+    return CsvSink(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批次評估多份倉位檔的到期損益")
+    parser.add_argument("inputs", nargs="+", help="倉位檔目錄或 glob (hedge_positions.json 格式或 .npz 快照)")
+    parser.add_argument("--scenario", help="情境 JSON 檔 (center / price_range / step / etf_current_price / costs)")
+    parser.add_argument("--center", type=float, help="指數中心 (未指定時抓取加權指數現價)")
+    parser.add_argument("--price-range", dest="price_range", type=float, help="模擬範圍 (±點數)")
+    parser.add_argument("--step", type=float, help="價格間距 (點)")
+    parser.add_argument("--etf-price", dest="etf_current_price", type=float, help="00631L 現價 (預設使用檔案內的值)")
+    parser.add_argument("--costs", action="store_true", default=None, help="扣除手續費與交易稅 (預設費率)")
+    parser.add_argument("-o", "--output", default="-", help="輸出檔 (.csv 或 .parquet，預設輸出 CSV 到 stdout)")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="平行行程數 (預設 CPU 數)")
+    args = parser.parse_args(argv)
+
+    paths = find_portfolio_files(args.inputs)
+    if not paths:
+        parser.error("找不到任何倉位檔")
+
+    scenario = load_scenario(args)
+    if scenario["center"] is None:
+        from quotes import fetch_tse_index_price
+        scenario["center"] = fetch_tse_index_price()
+        if scenario["center"] is None:
+            parser.error("無法取得加權指數現價，請以 --center 指定")
+
+    sink = open_sink(args.output)
+    failed = 0
+    try:
+        for path, future in iter_results(paths, scenario, args.workers):
+            try:
+                sink.write(future.result())
+            except Exception as e:
+                failed += 1
+                print(f"評估失敗 {path}: {e}", file=sys.stderr)
+    finally:
+        sink.close()
+
+    print(f"完成 {len(paths) - failed}/{len(paths)} 份倉位檔", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,218 @@
+# ======== 具名快取區域 ========
+# 取代 st.cache_data.clear() 的全域清除：每個區域各自有 TTL、筆數 / 位元組上限與統計，
+# 重新整理價格時只清除 quotes 區域。快取為整個行程共用 (所有 session 共享)。
+#
+# 多個 session 同時開啟相同倉位時，同一個快取鍵只會計算一次 (其他 session 等待結果)，
+# 因此 session state 只需保存倉位與識別碼，網格 / 圖表由所有 session 共用。
+
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+import numpy as np
+
+
+def _sizeof(value, _seen=None):
+    """估計快取值佔用的位元組數 (共用的物件只計算一次)"""
+    if _seen is None:
+        _seen = set()
+    if id(value) in _seen:
+        return 0
+    _seen.add(id(value))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray, str)):
+        return sys.getsizeof(value)
+    if hasattr(value, "memory_usage") and hasattr(value, "columns"):
+        # pandas DataFrame
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_sizeof(k, _seen) + _sizeof(v, _seen) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(_sizeof(v, _seen) for v in value)
+    if hasattr(value, "__dict__") and not isinstance(value, type):
+        return sys.getsizeof(value) + _sizeof(vars(value), _seen)
+    return sys.getsizeof(value)
+
+
+class CacheRegion:
+    """LRU 快取區域，支援 TTL 與筆數 / 位元組上限"""
+
+    def __init__(self, name, ttl=None, max_entries=None, max_bytes=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> (expires_at, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0  # 等待其他 session 計算完成而取得結果的次數
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, size, value = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        """查詢但不更新統計與 LRU 順序"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time.monotonic()):
+                return default
+            return entry[2]
+
+    def set(self, key, value):
+        size = _sizeof(value)
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (expires_at, size, value)
+            self._bytes += size
+            while self._data and (
+                (self.max_entries is not None and len(self._data) > self.max_entries)
+                or (self.max_bytes is not None and self._bytes > self.max_bytes)
+            ):
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "region": self.name,
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "coalesced": self.coalesced,
+                "ttl": self.ttl,
+            }
+
+
+# ======== 區域設定 ========
+REGIONS = {
+    "quotes": CacheRegion("quotes", ttl=300, max_entries=32),  # 報價 (與原 st.cache_data ttl=300 相同)
+    "payoff": CacheRegion("payoff", ttl=3600, max_bytes=64 * 1024 * 1024),  # 損益網格 / 風險摘要
+    "charts": CacheRegion("charts", ttl=3600, max_bytes=32 * 1024 * 1024),  # 已繪製的圖表 PNG
+}
+
+
+def get_region(name):
+    return REGIONS[name]
+
+
+def clear_region(name):
+    """只清除指定區域"""
+    REGIONS[name].clear()
+
+
+def region_stats():
+    """各區域的筆數、位元組、命中與淘汰統計"""
+    return [region.stats() for region in REGIONS.values()]
+
+
+_MISSING = object()
+_inflight = {}  # (區域, 快取鍵) -> 計算中的鎖
+_inflight_lock = threading.Lock()
+
+
+def cached(region_name, key=None):
+    """將函式結果快取在指定區域；key 可自訂快取鍵 (預設為函式名稱 + 參數)
+
+    同一個鍵同時未命中時只有第一個呼叫者計算，其餘等待並共用其結果。
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            region = REGIONS[region_name]
+            cache_key = key(*args, **kwargs) if key else (func.__qualname__, args, tuple(sorted(kwargs.items())))
+            value = region.get(cache_key, _MISSING)
+            if value is not _MISSING:
+                return value
+            inflight_key = (region_name, cache_key)
+            with _inflight_lock:
+                lock = _inflight.setdefault(inflight_key, threading.Lock())
+            try:
+                with lock:
+                    value = region.peek(cache_key, _MISSING)
+                    if value is _MISSING:
+                        value = func(*args, **kwargs)
+                        region.set(cache_key, value)
+                    else:
+                        region.coalesced += 1
+            finally:
+                with _inflight_lock:
+                    if _inflight.get(inflight_key) is lock:
+                        del _inflight[inflight_key]
+            return value
+        return wrapper
+    return decorator
+
+
+# ======== 記憶體報告 ========
+def process_rss(pid=None):
+    """目前行程 (或指定 pid 的行程) 的常駐記憶體 (位元組)；無法取得時回傳 None"""
+    try:
+        with open(f"/proc/{pid or 'self'}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    if pid is not None:
+        # 其他行程只能由 /proc 讀取
+        return None
+    try:
+        import resource
+        # ru_maxrss 為峰值 (Linux 以 KB、macOS 以位元組計)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except (ImportError, OSError):
+        return None
+
+
+def session_memory_report(state):
+    """估計 session state 各鍵佔用的位元組數，由大到小排列
+
+    已存在於共用快取區域的物件 (例如網格陣列) 不計入，只反映此 session 獨有的部分。
+    """
+    shared = set()
+    for region in REGIONS.values():
+        with region._lock:
+            for _, _, value in region._data.values():
+                shared.add(id(value))
+    rows = []
+    for name in list(state.keys()):
+        value = state[name]
+        rows.append({
+            "key": str(name),
+            "type": type(value).__name__,
+            "bytes": 0 if id(value) in shared else _sizeof(value),
+            "shared": id(value) in shared,
+        })
+    return sorted(rows, key=lambda row: row["bytes"], reverse=True)
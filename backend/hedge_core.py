@@ -0,0 +1,681 @@
+# ======== 00631L 避險計算核心 ========
+# 不依賴 Streamlit 的純計算函式，供 app.py 與其他工具共用
+
+import hashlib
+import json
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+from scipy.special import ndtr
+
+# ======== 常數設定 ========
+OPTION_MULTIPLIER = 50.0  # 台指選擇權每點 50 元
+MICRO_OPTION_MULTIPLIER = 10.0  # 微台選擇權每點 10 元
+ETF_SHARES_PER_LOT = 1000  # 1張 = 1000股
+LEVERAGE_00631L = 2.0  # 00631L 為 2 倍槓桿 ETF
+PRICE_STEP = 100.0
+CALENDAR_DAYS_PER_YEAR = 365.0  # 到期前估值以日曆日計算
+
+# 可持有的 ETF / 個股：Yahoo 代號與相對加權指數的槓桿 (beta)
+INSTRUMENTS = {
+    "00631L": {"ticker": "00631L.TW", "beta": LEVERAGE_00631L},
+    "0050": {"ticker": "0050.TW", "beta": 1.0},
+    "006208": {"ticker": "006208.TW", "beta": 1.0},
+    "00632R": {"ticker": "00632R.TW", "beta": -1.0},
+}
+
+# 交易成本與稅率預設值 (手續費為每口單邊，依券商實際費率調整)
+COST_DEFAULTS = {
+    "option_fee": 25.0,  # 台指選擇權手續費 (含期交所費用) 元/口
+    "micro_option_fee": 12.0,  # 微台選擇權手續費 元/口
+    "futures_fee": 15.0,  # 微台期貨手續費 元/口
+    "option_tax_rate": 0.001,  # 選擇權交易稅：權利金 / 到期結算金額 × 千分之一
+    "futures_tax_rate": 0.00002,  # 期貨交易稅：契約價值 × 十萬分之二
+    "etf_fee_rate": 0.001425,  # 證券手續費 (賣出)
+    "etf_tax_rate": 0.001,  # ETF 證券交易稅 (賣出)
+    "stock_tax_rate": 0.003,  # 個股證券交易稅 (賣出)
+}
+
+# 倉位文件 (Firebase hedge_positions) 的欄位預設值
+PORTFOLIO_DEFAULTS = {
+    "etf_lots": 0.0,
+    "etf_cost": 0.0,
+    "etf_current_price": None,
+    "hedge_ratio": 0.2,
+    "cash_cost": 0.0,
+    "cash_current": 0.0,
+    "option_positions": [],
+    "holdings": [],  # 00631L 以外的持股 [{"symbol", "lots", "cost", "price", "beta"}]
+}
+
+
+# ======== 倉位文件 ========
+def normalize_portfolio(data):
+    """補齊倉位文件的預設欄位並轉換數值型別"""
+    data = data or {}
+    portfolio = {}
+    for key, default in PORTFOLIO_DEFAULTS.items():
+        value = data.get(key, default)
+        if key in ("option_positions", "holdings"):
+            # Firebase 可能將稀疏陣列回傳為 {"0": ..., "2": ...}
+            if isinstance(value, dict):
+                value = [value[k] for k in sorted(value, key=int)]
+            items = [item for item in (value or []) if item]
+            normalize_item = _normalize_position if key == "option_positions" else _normalize_holding
+            portfolio[key] = [normalize_item(item) for item in items]
+        elif value is None:
+            portfolio[key] = None
+        else:
+            portfolio[key] = float(value)
+    return portfolio
+
+
+def _normalize_position(pos):
+    """倉位的履約價 / 權利金固定為 float、口數為 int
+
+    Firebase 會將整數值的浮點數回傳為 int (27400.0 → 27400)，
+    統一型別後同一份倉位的雜湊才會一致。
+    """
+    pos = dict(pos)
+    for key in ("strike", "premium"):
+        if pos.get(key) is not None:
+            pos[key] = float(pos[key])
+    if pos.get("lots") is not None:
+        pos["lots"] = int(pos["lots"])
+    return pos
+
+
+def _normalize_holding(holding):
+    """持股的數值欄位固定為 float，未指定 beta 時取 INSTRUMENTS 的預設值 (與 make_holding 相同)
+
+    沒有現價的持股保留 price=None，由損益計算拒絕，不以 0 計價。
+    """
+    holding = {"lots": 0.0, "cost": 0.0, "price": None, **holding}
+    if holding.get("beta") is None:
+        holding["beta"] = INSTRUMENTS.get(holding.get("symbol"), {}).get("beta", 1.0)
+    for key in ("lots", "cost", "price", "beta"):
+        if holding[key] is not None:
+            holding[key] = float(holding[key])
+    return holding
+
+
+def normalize_costs(costs):
+    """補齊交易成本設定的預設值；None 表示不計成本"""
+    if costs is None:
+        return None
+    return {key: float(costs.get(key, default)) for key, default in COST_DEFAULTS.items()}
+
+
+def portfolio_hash(portfolio):
+    """以正規化 JSON 計算倉位文件的雜湊，作為快取鍵"""
+    payload = json.dumps(portfolio, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+# ======== 倉位判斷 ========
+def is_futures_position(pos):
+    """判斷是否為微台期貨倉位 (向下兼容舊資料)"""
+    return pos.get("product", "台指") == "微台期貨" or pos.get("type") == "Futures"
+
+
+def position_multiplier(pos):
+    """取得倉位每點價值"""
+    if is_futures_position(pos):
+        return MICRO_OPTION_MULTIPLIER
+    return MICRO_OPTION_MULTIPLIER if pos.get("product", "台指") == "微台" else OPTION_MULTIPLIER
+
+
+# ======== 損益計算 ========
+def calc_position_pnl(pos, settlement_price):
+    """計算單一倉位的損益（支援選擇權和期貨）"""
+    strike = pos["strike"]
+    lots = pos["lots"]
+    premium = pos.get("premium", 0)
+
+    if is_futures_position(pos):
+        # 微台期貨損益計算（做空）
+        # 做空損益 = (進場價 - 結算價) × 口數 × 10元
+        return (strike - settlement_price) * lots * MICRO_OPTION_MULTIPLIER
+
+    # 選擇權損益計算
+    multiplier = position_multiplier(pos)
+
+    # 計算內含價值
+    if pos["type"] == "Call":
+        intrinsic = max(0.0, settlement_price - strike)
+    else:  # Put
+        intrinsic = max(0.0, strike - settlement_price)
+
+    # 計算損益 = (內含價值 - 權利金) × 口數 × 乘數
+    if pos["direction"] == "買進":
+        return (intrinsic - premium) * lots * multiplier
+    return (premium - intrinsic) * lots * multiplier  # 賣出
+
+
+def etf_pnl_slope(base_index, etf_lots, etf_current, costs=None):
+    """00631L 損益對指數的斜率 (元/點)；計入成本時扣除賣出費稅隨價格的變動"""
+    if etf_lots <= 0 or base_index <= 0:
+        return 0.0
+    shares = etf_lots * ETF_SHARES_PER_LOT
+    if costs is not None:
+        shares *= 1 - _etf_sell_rate(normalize_costs(costs))
+    return etf_current * LEVERAGE_00631L / base_index * shares
+
+
+def calc_etf_pnl(index_price, base_index, etf_lots, etf_cost, etf_current):
+    """計算 00631L 在不同指數價位下的損益"""
+    if etf_lots <= 0 or base_index <= 0:
+        return 0.0
+
+    # 指數變動比例
+    index_change_pct = (index_price - base_index) / base_index
+
+    # 00631L 是 2 倍槓桿，價格變動 = 指數變動 × 2
+    etf_price_change_pct = index_change_pct * LEVERAGE_00631L
+
+    # 新的 ETF 價格
+    new_etf_price = etf_current * (1 + etf_price_change_pct)
+
+    # 計算損益 = (新價格 - 成本) × 股數
+    shares = etf_lots * ETF_SHARES_PER_LOT
+    return (new_etf_price - etf_cost) * shares
+
+
+# ======== 向量化損益計算 ========
+def _leg_arrays(positions):
+    """將倉位列表轉為欄位陣列 (每個元素對應一個倉位)"""
+    n = len(positions)
+    strikes = np.empty(n)
+    lots = np.empty(n)
+    premiums = np.empty(n)
+    multipliers = np.empty(n)
+    signs = np.empty(n)
+    is_call = np.zeros(n, dtype=bool)
+    is_fut = np.zeros(n, dtype=bool)
+    for i, pos in enumerate(positions):
+        strikes[i] = pos["strike"]
+        lots[i] = pos["lots"]
+        premiums[i] = pos.get("premium", 0)
+        multipliers[i] = position_multiplier(pos)
+        is_fut[i] = is_futures_position(pos)
+        is_call[i] = pos.get("type") == "Call"
+        signs[i] = 1.0 if pos.get("direction") == "買進" else -1.0
+    return strikes, lots, premiums, multipliers, signs, is_call, is_fut
+
+
+def calc_leg_pnl_grid(positions, prices):
+    """計算每個倉位在價格網格上的損益，回傳 (倉位數 × 價格數) 陣列"""
+    prices = np.asarray(prices, dtype=float)
+    if not positions:
+        return np.zeros((0, prices.size))
+
+    strikes, lots, premiums, multipliers, signs, is_call, is_fut = _leg_arrays(positions)
+    s = prices[None, :]
+    k = strikes[:, None]
+    intrinsic = np.where(is_call[:, None], np.maximum(s - k, 0.0), np.maximum(k - s, 0.0))
+    option_pnl = signs[:, None] * (intrinsic - premiums[:, None])
+    futures_pnl = k - s  # 微台期貨做空
+    per_point = np.where(is_fut[:, None], futures_pnl, option_pnl)
+    return per_point * (lots * multipliers)[:, None]
+
+
+# ======== 交易成本 ========
+def _leg_fees(positions, costs):
+    """每個倉位每口的單邊手續費"""
+    return np.array([
+        costs["futures_fee"] if is_futures_position(pos)
+        else costs["micro_option_fee"] if pos.get("product", "台指") == "微台"
+        else costs["option_fee"]
+        for pos in positions
+    ], dtype=float)
+
+
+def calc_leg_cost_grid(positions, prices, costs):
+    """計算每個倉位在價格網格上的交易成本 (正值為支出)
+
+    回傳 {"fee": 手續費, "tax": 交易稅}，各為 (倉位數 × 價格數) 陣列：
+    - 手續費以進場 + 到期 (或平倉) 來回計算，與結算價無關
+    - 選擇權交易稅 = (進場權利金 + 到期結算金額) × 稅率，結算金額即內含價值
+    - 期貨交易稅 = (進場契約價值 + 結算契約價值) × 稅率
+    """
+    prices = np.asarray(prices, dtype=float)
+    costs = normalize_costs(costs)
+    if not positions:
+        empty = np.zeros((0, prices.size))
+        return {"fee": empty, "tax": empty}
+
+    strikes, lots, premiums, multipliers, signs, is_call, is_fut = _leg_arrays(positions)
+    s = prices[None, :]
+    k = strikes[:, None]
+    units = (lots * multipliers)[:, None]
+    fee = np.broadcast_to((2 * _leg_fees(positions, costs) * lots)[:, None], (len(positions), prices.size))
+    intrinsic = np.where(is_call[:, None], np.maximum(s - k, 0.0), np.maximum(k - s, 0.0))
+    option_tax = (premiums[:, None] + intrinsic) * costs["option_tax_rate"]
+    futures_tax = (k + s) * costs["futures_tax_rate"]
+    tax = np.where(is_fut[:, None], futures_tax, option_tax) * units
+    return {"fee": fee, "tax": tax}
+
+
+def _etf_sell_rate(costs, symbol="00631L"):
+    """賣出持股的手續費 + 證交稅率 (未登錄於 INSTRUMENTS 者視為個股)"""
+    tax_rate = costs["etf_tax_rate"] if symbol in INSTRUMENTS else costs["stock_tax_rate"]
+    return costs["etf_fee_rate"] + tax_rate
+
+
+def calc_etf_cost_grid(prices, base_index, etf_lots, etf_current, costs):
+    """00631L 依推算賣出價計算的手續費與證交稅"""
+    prices = np.asarray(prices, dtype=float)
+    costs = normalize_costs(costs)
+    if etf_lots <= 0 or base_index <= 0:
+        return np.zeros(prices.shape)
+    new_etf_price = etf_current * (1 + (prices - base_index) / base_index * LEVERAGE_00631L)
+    return new_etf_price * etf_lots * ETF_SHARES_PER_LOT * _etf_sell_rate(costs)
+
+
+def _closing_pnl(pos, close_price):
+    """以指定價格平倉 (每點) 的已實現損益，不隨結算價變動"""
+    if is_futures_position(pos):
+        return (pos["strike"] - close_price) * pos["lots"] * MICRO_OPTION_MULTIPLIER
+    premium = pos.get("premium", 0)
+    sign = 1.0 if pos["direction"] == "買進" else -1.0
+    return sign * (close_price - premium) * pos["lots"] * position_multiplier(pos)
+
+
+def _closing_cost(pos, close_price, costs):
+    """以指定價格平倉的來回手續費與交易稅 (元)，交易稅以平倉價取代到期結算金額"""
+    units = pos["lots"] * position_multiplier(pos)
+    fee = 2 * _leg_fees([pos], costs)[0] * pos["lots"]
+    if is_futures_position(pos):
+        tax = (pos["strike"] + close_price) * costs["futures_tax_rate"] * units
+    else:
+        tax = (pos.get("premium", 0) + close_price) * costs["option_tax_rate"] * units
+    return fee + tax
+
+
+def apply_staged_changes(positions, changes):
+    """將暫存的調整 (平倉 / 新倉) 套用到倉位列表，回傳新列表
+
+    changes 中的 index 皆指向原始 positions；平倉可只平部分口數。
+    只移除因平倉而歸零的倉位，原本就是 0 口 (暫停計算) 的倉位保留。
+    """
+    remaining = [dict(pos) for pos in positions]
+    opened = []
+    closed = set()
+    for change in changes:
+        if change["op"] == "close":
+            pos = remaining[change["index"]]
+            pos["lots"] = max(0, pos["lots"] - change["lots"])
+            closed.add(change["index"])
+        elif change["op"] == "open":
+            opened.append(dict(change["position"]))
+        else:
+            raise ValueError(f"未知的調整: {change['op']}")
+    return [pos for i, pos in enumerate(remaining) if i not in closed or pos["lots"] > 0] + opened
+
+
+def staged_changes_realized(positions, changes, costs=None):
+    """暫存平倉的已實現損益合計 (元，不隨結算價變動)；計入成本時扣除平倉的來回費稅"""
+    costs = normalize_costs(costs)
+    realized = 0.0
+    for change in changes:
+        if change["op"] == "close":
+            leg = dict(positions[change["index"]], lots=change["lots"])
+            realized += _closing_pnl(leg, change.get("price", 0.0))
+            if costs is not None:
+                realized -= _closing_cost(leg, change.get("price", 0.0), costs)
+    return realized
+
+
+def _net_leg_pnl_grid(legs, prices, costs):
+    pnl = calc_leg_pnl_grid(legs, prices)
+    if costs is not None:
+        leg_costs = calc_leg_cost_grid(legs, prices, costs)
+        pnl = pnl - leg_costs["fee"] - leg_costs["tax"]
+    return pnl
+
+
+def staged_changes_delta(positions, changes, prices, costs=None):
+    """暫存調整對損益網格的增量，只計算被調整的倉位 (每筆 O(網格))
+
+    costs 與基準網格相同時 (見 calc_pnl_grid)，基準網格 + 增量即為調整後的淨損益。
+    """
+    prices = np.asarray(prices, dtype=float)
+    costs = normalize_costs(costs)
+    delta = np.zeros(prices.shape)
+    for change in changes:
+        if change["op"] == "close":
+            leg = dict(positions[change["index"]], lots=change["lots"])
+            # 平倉：移除該部分到期損益，改為固定的已實現損益 (加總於下方)
+            delta -= _net_leg_pnl_grid([leg], prices, costs)[0]
+        else:
+            delta += _net_leg_pnl_grid([change["position"]], prices, costs)[0]
+    return delta + staged_changes_realized(positions, changes, costs)
+
+
+def calc_etf_pnl_grid(prices, base_index, etf_lots, etf_cost, etf_current):
+    """向量化計算 00631L 在價格網格上的損益"""
+    prices = np.asarray(prices, dtype=float)
+    if etf_lots <= 0 or base_index <= 0:
+        return np.zeros(prices.shape)
+    new_etf_price = etf_current * (1 + (prices - base_index) / base_index * LEVERAGE_00631L)
+    return (new_etf_price - etf_cost) * etf_lots * ETF_SHARES_PER_LOT
+
+
+def make_holding(symbol, lots, cost, price, beta=None):
+    """建立持股資料；beta 未指定時取 INSTRUMENTS 的預設值"""
+    if beta is None:
+        beta = INSTRUMENTS.get(symbol, {}).get("beta", 1.0)
+    return {"symbol": symbol, "lots": float(lots), "cost": float(cost), "price": float(price), "beta": float(beta)}
+
+
+def holding_ticker(holding):
+    """持股的 Yahoo Finance 代號 (未登錄者視為上市股票 <代號>.TW)"""
+    symbol = holding["symbol"]
+    return INSTRUMENTS.get(symbol, {}).get("ticker", f"{symbol}.TW")
+
+
+def _holding_arrays(holdings):
+    holdings = [_normalize_holding(h) for h in holdings]
+    missing = [h["symbol"] for h in holdings if h["price"] is None and h["lots"]]
+    if missing:
+        # 以 0 代入會把損益算成 -成本 × 股數 (與 00631L 沒有現價時相同處理)
+        raise ValueError(f"持股 {', '.join(map(str, missing))} 沒有現價 (price)")
+    lots = np.array([h["lots"] for h in holdings], dtype=float)
+    cost = np.array([h["cost"] for h in holdings], dtype=float)
+    price = np.array([h["price"] or 0.0 for h in holdings], dtype=float)
+    beta = np.array([h["beta"] for h in holdings], dtype=float)
+    return lots * ETF_SHARES_PER_LOT, cost, price, beta
+
+
+def calc_holdings_pnl_grid(holdings, prices, base_index):
+    """計算每檔持股在價格網格上的損益，回傳 (持股數 × 價格數) 陣列
+
+    持股價格變動 = 指數變動比例 × beta (00631L 為 2、反向 ETF 為負值)。
+    """
+    prices = np.asarray(prices, dtype=float)
+    if not holdings or base_index <= 0:
+        return np.zeros((len(holdings),) + prices.shape)
+    shares, cost, price, beta = _holding_arrays(holdings)
+    change_pct = (prices - base_index) / base_index
+    expand = (slice(None),) + (None,) * prices.ndim
+    new_price = price[expand] * (1 + change_pct[None, ...] * beta[expand])
+    return (new_price - cost[expand]) * shares[expand]
+
+
+def _holding_sell_rates(holdings, costs):
+    return np.array([_etf_sell_rate(costs, h["symbol"]) for h in holdings], dtype=float)
+
+
+def calc_holdings_cost_grid(holdings, prices, base_index, costs):
+    """每檔持股依推算賣出價計算的手續費與證交稅，回傳 (持股數 × 價格數) 陣列"""
+    prices = np.asarray(prices, dtype=float)
+    costs = normalize_costs(costs)
+    if not holdings or base_index <= 0:
+        return np.zeros((len(holdings),) + prices.shape)
+    shares, _, price, beta = _holding_arrays(holdings)
+    change_pct = (prices - base_index) / base_index
+    expand = (slice(None),) + (None,) * prices.ndim
+    new_price = price[expand] * (1 + change_pct[None, ...] * beta[expand])
+    return new_price * (shares * _holding_sell_rates(holdings, costs))[expand]
+
+
+def holdings_pnl_slope(holdings, base_index, costs=None):
+    """持股合計損益對指數的斜率 (元/點)；計入成本時扣除賣出費稅隨價格的變動"""
+    if not holdings or base_index <= 0:
+        return 0.0
+    shares, _, price, beta = _holding_arrays(holdings)
+    if costs is not None:
+        shares = shares * (1 - _holding_sell_rates(holdings, normalize_costs(costs)))
+    return float((price * beta / base_index * shares).sum())
+
+
+def calc_pnl_grid(positions, prices, base_index, etf_lots, etf_cost, etf_current, holdings=(), costs=None):
+    """向量化計算價格網格上的 (ETF 損益, 倉位組合損益, 總損益)
+
+    holdings 為 00631L 以外的持股，損益併入 ETF 欄；
+    costs 為交易成本設定 (見 COST_DEFAULTS)，指定時各欄皆為扣除手續費與稅後的淨損益。
+    """
+    etf_profits = calc_etf_pnl_grid(prices, base_index, etf_lots, etf_cost, etf_current)
+    if holdings:
+        etf_profits = etf_profits + calc_holdings_pnl_grid(holdings, prices, base_index).sum(axis=0)
+    option_profits = calc_leg_pnl_grid(positions, prices).sum(axis=0)
+    if costs is not None:
+        etf_profits = etf_profits - calc_etf_cost_grid(prices, base_index, etf_lots, etf_current, costs)
+        if holdings:
+            etf_profits = etf_profits - calc_holdings_cost_grid(holdings, prices, base_index, costs).sum(axis=0)
+        leg_costs = calc_leg_cost_grid(positions, prices, costs)
+        option_profits = option_profits - (leg_costs["fee"] + leg_costs["tax"]).sum(axis=0)
+    return etf_profits, option_profits, etf_profits + option_profits
+
+
+def price_grid(center, price_range, step=PRICE_STEP):
+    """以現價為中心建立 ±price_range 的結算價網格"""
+    offsets = np.arange(-price_range, price_range + 1e-6, step)
+    return center + offsets
+
+
+# ======== 到期前估值 (Black-Scholes) ========
+def bs_option_value(is_call, spot, strike, years, vol, rate=0.0):
+    """Black-Scholes 選擇權理論價 (可廣播的陣列運算)；years <= 0 時為內含價值"""
+    spot, strike, years, vol = np.broadcast_arrays(
+        np.asarray(spot, dtype=float), np.asarray(strike, dtype=float),
+        np.asarray(years, dtype=float), np.asarray(vol, dtype=float),
+    )
+    expired = (years <= 0) | (vol <= 0)
+    t = np.where(expired, 1.0, years)
+    v = np.where(expired, 1.0, vol)
+    sqrt_t = np.sqrt(t)
+    d1 = (np.log(spot / strike) + (rate + 0.5 * v ** 2) * t) / (v * sqrt_t)
+    d2 = d1 - v * sqrt_t
+    discount = np.exp(-rate * t)
+    call = spot * ndtr(d1) - strike * discount * ndtr(d2)
+    put = strike * discount * ndtr(-d2) - spot * ndtr(-d1)
+    value = np.where(is_call, call, put)
+    intrinsic = np.where(is_call, np.maximum(spot - strike, 0.0), np.maximum(strike - spot, 0.0))
+    return np.where(expired, intrinsic, value)
+
+
+def calc_stress_matrix(portfolio, base_index, index_shocks, vol_shifts, days_elapsed,
+                       days_to_expiry, base_vol, rate=0.0, costs=None):
+    """壓力測試：指數變動 × 波動率變動 × 經過天數 的組合損益
+
+    index_shocks 為比例 (-0.05 = 跌 5%)，vol_shifts 為波動率絕對變動 (0.05 = +5 個百分點)，
+    days_elapsed 為經過的日曆日。回傳形狀 (len(index_shocks), len(vol_shifts), len(days_elapsed))。
+    選擇權以 Black-Scholes 估值，00631L 與其他持股依槓桿倍數 (beta) 線性計算。
+    指定 costs 時扣除以理論價平倉的來回手續費與交易稅。
+    """
+    portfolio = normalize_portfolio(portfolio)
+    costs = normalize_costs(costs)
+    shocks = np.asarray(index_shocks, dtype=float)[:, None, None]
+    vols = np.maximum(base_vol + np.asarray(vol_shifts, dtype=float), 0.0)[None, :, None]
+    days = np.asarray(days_elapsed, dtype=float)[None, None, :]
+
+    spot = base_index * (1 + shocks)
+    years = np.maximum(days_to_expiry - days, 0.0) / CALENDAR_DAYS_PER_YEAR
+    total = calc_etf_pnl_grid(
+        spot, base_index, portfolio["etf_lots"], portfolio["etf_cost"], portfolio["etf_current_price"] or 0.0
+    ) * np.ones((1, vols.shape[1], days.shape[2]))
+    if portfolio["holdings"]:
+        total = total + calc_holdings_pnl_grid(portfolio["holdings"], spot, base_index).sum(axis=0)
+    if costs is not None:
+        total = total - calc_etf_cost_grid(
+            spot, base_index, portfolio["etf_lots"], portfolio["etf_current_price"] or 0.0, costs
+        )
+        if portfolio["holdings"]:
+            total = total - calc_holdings_cost_grid(portfolio["holdings"], spot, base_index, costs).sum(axis=0)
+
+    positions = [pos for pos in portfolio["option_positions"] if pos.get("lots")]
+    if positions:
+        strikes, lots, premiums, multipliers, signs, is_call, is_fut = _leg_arrays(positions)
+        # 最後一維為倉位：(指數, 波動率, 天數, 倉位)
+        leg = lambda a: a[None, None, None, :]
+        value = bs_option_value(leg(is_call), spot[..., None], leg(strikes), years[..., None], vols[..., None], rate)
+        option_pnl = leg(signs) * (value - leg(premiums))
+        futures_pnl = leg(strikes) - spot[..., None]
+        per_point = np.where(leg(is_fut), futures_pnl, option_pnl)
+        if costs is not None:
+            # 平倉時以理論價 (期貨為指數) 計稅，手續費換算為每點
+            option_tax = (value + leg(premiums)) * costs["option_tax_rate"]
+            futures_tax = (leg(strikes) + spot[..., None]) * costs["futures_tax_rate"]
+            per_point = per_point - np.where(leg(is_fut), futures_tax, option_tax)
+            per_point = per_point - leg(2 * _leg_fees(positions, costs) / multipliers)
+        total = total + (per_point * leg(lots * multipliers)).sum(axis=-1)
+    return total
+
+
+# ======== 分段線性損益結構 ========
+def _position_slopes(pos, costs=None):
+    """回傳 (最左段斜率, 履約價轉折的斜率變化)，單位 元/點
+
+    計入成本時，期貨結算價值與選擇權結算金額的交易稅會改變斜率。
+    """
+    lots = pos["lots"]
+    if is_futures_position(pos):
+        tax_rate = costs["futures_tax_rate"] if costs else 0.0
+        return -lots * MICRO_OPTION_MULTIPLIER * (1 + tax_rate), 0.0
+
+    sign = 1.0 if pos["direction"] == "買進" else -1.0
+    tax_rate = costs["option_tax_rate"] if costs else 0.0
+    unit = (sign - tax_rate) * lots * position_multiplier(pos)
+    if pos["type"] == "Call":
+        # 履約價以下斜率 0，以上斜率 +unit
+        return 0.0, unit
+    # Put：履約價以下斜率 -unit，以上斜率 0
+    return -unit, unit
+
+
+def build_payoff_profile(positions, base_index, etf_lots, etf_cost, etf_current, holdings=(), costs=None):
+    """將 ETF / 持股 + 倉位組合的到期損益整理為分段線性結構
+
+    交易成本對結算價皆為線性 (手續費固定、稅額與結算金額成正比)，計入後仍為分段線性。
+
+    回傳 dict：
+        strikes: 由小到大排列的轉折點 (履約價)
+        values:  各轉折點上的組合損益
+        slopes:  各區段斜率，長度為 len(strikes) + 1 (slopes[0] 為最左段)
+        hedge_strikes: 買進 Put 的履約價 (可作為避險啟動點的轉折)
+    """
+    costs = normalize_costs(costs)
+    left_slope = etf_pnl_slope(base_index, etf_lots, etf_current, costs) + holdings_pnl_slope(holdings, base_index, costs)
+    kinks = {}
+    hedge_strikes = set()
+    for pos in positions:
+        if not pos.get("lots"):
+            continue
+        slope, delta = _position_slopes(pos, costs)
+        left_slope += slope
+        if delta:
+            strike = float(pos["strike"])
+            kinks[strike] = kinks.get(strike, 0.0) + delta
+            if pos["type"] == "Put" and pos["direction"] == "買進":
+                hedge_strikes.add(strike)
+
+    strikes = sorted(k for k, d in kinks.items() if d != 0)
+    slopes = [left_slope]
+    for k in strikes:
+        slopes.append(slopes[-1] + kinks[k])
+
+    def total_pnl_at(x):
+        pnl = calc_etf_pnl(x, base_index, etf_lots, etf_cost, etf_current)
+        if holdings:
+            pnl += float(calc_holdings_pnl_grid(holdings, [x], base_index).sum())
+        pnl += sum(calc_position_pnl(pos, x) for pos in positions)
+        if costs is not None:
+            pnl -= float(calc_etf_cost_grid([x], base_index, etf_lots, etf_current, costs)[0])
+            pnl -= float(calc_holdings_cost_grid(holdings, [x], base_index, costs).sum())
+            leg_costs = calc_leg_cost_grid(positions, [x], costs)
+            pnl -= float((leg_costs["fee"] + leg_costs["tax"]).sum())
+        return pnl
+
+    values = []
+    if strikes:
+        first = strikes[0]
+        values.append(total_pnl_at(first))
+        for i in range(1, len(strikes)):
+            values.append(values[-1] + slopes[i] * (strikes[i] - strikes[i - 1]))
+        anchor_x, anchor_y = first, values[0]
+    else:
+        # 沒有轉折點：整體為一條直線，以基準指數為錨點
+        anchor_x = float(base_index)
+        anchor_y = total_pnl_at(anchor_x)
+
+    return {
+        "strikes": strikes,
+        "values": values,
+        "slopes": slopes,
+        "anchor": (anchor_x, anchor_y),
+        "hedge_strikes": sorted(k for k in hedge_strikes if k in kinks and kinks[k] != 0),
+    }
+
+
+def profile_pnl_at(profile, index_price):
+    """以 O(log n) 在分段線性結構上查詢指定指數的組合損益"""
+    strikes = profile["strikes"]
+    slopes = profile["slopes"]
+    if not strikes:
+        anchor_x, anchor_y = profile["anchor"]
+        return anchor_y + slopes[0] * (index_price - anchor_x)
+
+    i = bisect_right(strikes, index_price)
+    if i == 0:
+        return profile["values"][0] + slopes[0] * (index_price - strikes[0])
+    return profile["values"][i - 1] + slopes[i] * (index_price - strikes[i - 1])
+
+
+def offset_profile(profile, amount):
+    """整條損益結構平移固定金額 (例如加上平倉的已實現損益)"""
+    anchor_x, anchor_y = profile["anchor"]
+    return dict(profile, values=[v + amount for v in profile["values"]], anchor=(anchor_x, anchor_y + amount))
+
+
+def profile_slope_at(profile, index_price):
+    """指定指數所在區段的斜率，即到期損益的 Delta (元/點)"""
+    return profile["slopes"][bisect_right(profile["strikes"], index_price)]
+
+
+def analyze_risk(profile, center, low, high):
+    """由分段線性結構精確計算區間內的損益兩平點、最大虧損與避險啟動點"""
+    strikes = profile["strikes"]
+    slopes = profile["slopes"]
+
+    # 區間內只需檢查端點與轉折點
+    xs = [low] + [k for k in strikes if low < k < high] + [high]
+    ys = [profile_pnl_at(profile, x) for x in xs]
+
+    breakevens = []
+    if not any(ys):
+        # 整段損益為 0 (例如尚無任何倉位)，不標示兩平點
+        xs_pairs = []
+    else:
+        xs_pairs = list(zip(zip(xs, ys), zip(xs[1:], ys[1:])))
+    for (x0, y0), (x1, y1) in xs_pairs:
+        if y0 == 0:
+            breakevens.append(x0)
+        elif y0 * y1 < 0:
+            breakevens.append(x0 - y0 * (x1 - x0) / (y1 - y0))
+    if xs_pairs and ys[-1] == 0:
+        breakevens.append(xs[-1])
+
+    min_i = min(range(len(ys)), key=ys.__getitem__)
+    max_i = max(range(len(ys)), key=ys.__getitem__)
+
+    # 避險啟動點：現價以下，買進 Put 使向下跌破後斜率變得更負 (保護開始生效) 的最高轉折點
+    # 買進 Call 在履約價的轉折方向相同，但那是上漲部位，不是下檔保護；期貨空單沒有轉折
+    hedge_trigger = None
+    for k in reversed(profile.get("hedge_strikes", ())):
+        i = bisect_left(strikes, k)
+        if k <= center and slopes[i] < slopes[i + 1]:
+            hedge_trigger = k
+            break
+
+    return {
+        "breakevens": breakevens,
+        "max_loss": ys[min_i],
+        "max_loss_index": xs[min_i],
+        "max_profit": ys[max_i],
+        "max_profit_index": xs[max_i],
+        "hedge_trigger": hedge_trigger,
+        # 區間外的尾端斜率：下跌時斜率為正或上漲時斜率為負 = 虧損無上限
+        "downside_slope": slopes[0],
+        "upside_slope": slopes[-1],
+    }
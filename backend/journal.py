@@ -0,0 +1,293 @@
+# ======== 倉位異動日誌 ========
+# 每次新增 / 調整口數 / 刪除 / 清空都寫入一筆只可附加的事件，
+# 並每 SNAPSHOT_INTERVAL 筆存一份快照：目前狀態 = 最新快照 + 之後的事件，
+# 任一時間點的狀態 = 該時間點前最近的快照 + 期間的事件。
+#
+# 事件 id 為可排序字串 (本地為補零序號、Firebase 為 push key)。
+# 第一筆事件前另存一份起始快照 (id 為 BASE_SNAPSHOT_ID，排在所有事件之前)，
+# 才能還原到第一筆事件之前的狀態。
+
+import copy
+import json
+import os
+import threading
+from datetime import datetime
+
+from hedge_core import PORTFOLIO_DEFAULTS, normalize_portfolio, portfolio_hash, apply_staged_changes
+
+SNAPSHOT_INTERVAL = 50  # 每幾筆事件存一份快照
+
+
+# ======== 事件套用 ========
+def apply_journal_event(portfolio, event):
+    """將一筆事件套用到倉位文件，回傳新文件"""
+    portfolio = copy.deepcopy(normalize_portfolio(portfolio))
+    op = event["op"]
+    positions = portfolio["option_positions"]
+    if "index" in event and not 0 <= event["index"] < len(positions):
+        # 日誌與實際倉位不一致 (例如漏記的異動)，不可繼續重播
+        raise ValueError(f"日誌事件 {event.get('id', '')} 的倉位索引 {event['index']} 超出範圍")
+
+    if op == "add_position":
+        positions.append(dict(event["position"]))
+    elif op == "adjust_lots":
+        pos = positions[event["index"]]
+        pos["lots"] = max(0, pos["lots"] + event["delta"])
+    elif op == "delete_position":
+        positions.pop(event["index"])
+    elif op == "update_settings":
+        portfolio.update(event["fields"])
+    elif op == "apply_changes":
+        portfolio["option_positions"] = apply_staged_changes(positions, event["changes"])
+    elif op == "clear":
+        # 與「清空所有倉位」相同：保留現金與現價
+        portfolio.update({
+            "etf_lots": 0.0,
+            "etf_cost": 0.0,
+            "hedge_ratio": PORTFOLIO_DEFAULTS["hedge_ratio"],
+            "option_positions": [],
+        })
+    elif op in ("restore", "sync"):
+        # sync：其他裝置 / PWA 直接寫入 Firebase 的內容，以整份文件記錄
+        portfolio = normalize_portfolio(event["portfolio"])
+    else:
+        raise ValueError(f"未知的日誌事件: {op}")
+    return normalize_portfolio(portfolio)
+
+
+def replay(portfolio, events):
+    """從快照依序套用事件"""
+    for event in events:
+        portfolio = apply_journal_event(portfolio, event)
+    return portfolio
+
+
+class PositionJournal:
+    """日誌共用邏輯，儲存方式由子類別實作"""
+
+    BASE_SNAPSHOT_ID = None  # 起始快照的 id (排序在所有事件之前)，由子類別指定
+
+    def __init__(self, snapshot_interval=SNAPSHOT_INTERVAL):
+        self.snapshot_interval = snapshot_interval
+        # 可重入：呼叫端可在持有鎖時 (寫入倉位到記錄完成之間) 再呼叫 record / sync
+        self._lock = threading.RLock()
+        self._since_snapshot = None
+        self._last_hash = None  # 最後一筆事件後的倉位雜湊 (sync 用來略過已記錄的內容)
+
+    @property
+    def lock(self):
+        """日誌寫入鎖：儲存倉位與記錄事件之間持有，sync 便不會插在兩者之間重複記錄"""
+        return self._lock
+
+    def record(self, op, portfolio_after, portfolio_before=None, **payload):
+        """附加一筆事件；portfolio_after 為套用後的文件，用於定期快照
+
+        portfolio_before 為套用前的文件；日誌尚無任何快照時存為起始快照。
+        """
+        event = {"op": op, "ts": datetime.now().isoformat(timespec="seconds"), **payload}
+        portfolio_after = normalize_portfolio(portfolio_after)
+        with self._lock:
+            if self._since_snapshot is None:
+                snapshot = self._latest_snapshot()
+                if snapshot is not None:
+                    self._since_snapshot = len(list(self._events_after(snapshot["id"])))
+                elif portfolio_before is not None:
+                    self._save_snapshot(self.BASE_SNAPSHOT_ID, event["ts"], normalize_portfolio(portfolio_before))
+                    self._since_snapshot = 0
+            event["id"] = self._append(event)
+            # 沒有起始快照時第一筆事件即存快照，作為重播的起點
+            if self._since_snapshot is None or self._since_snapshot + 1 >= self.snapshot_interval:
+                self._save_snapshot(event["id"], event["ts"], portfolio_after)
+                self._since_snapshot = 0
+            else:
+                self._since_snapshot += 1
+            self._last_hash = portfolio_hash(portfolio_after)
+        return event
+
+    def sync(self, portfolio, portfolio_before=None):
+        """記錄未經本日誌寫入的外部修改 (PWA / 其他行程)；內容與日誌目前狀態相同時不記錄"""
+        portfolio = normalize_portfolio(portfolio)
+        digest = portfolio_hash(portfolio)
+        # 比對與記錄在同一把鎖內完成，多個 session 同時收到同一次遠端更新時只記錄一次
+        with self._lock:
+            if digest == self._last_hash:
+                return None
+            current = self.current()
+            if current is not None and portfolio_hash(current) == digest:
+                self._last_hash = digest
+                return None
+            return self.record("sync", portfolio, portfolio_before=portfolio_before, portfolio=portfolio)
+
+    def current(self):
+        """目前狀態：最新快照 + 之後的事件"""
+        return self.state_at()
+
+    def state_at(self, ts=None, event_id=None):
+        """重建指定時間 (ISO 字串) 或指定事件之後的倉位文件；無日誌時回傳 None
+
+        日誌與倉位不一致而無法重播時拋出 ValueError。
+        """
+        snapshot = self._latest_snapshot(upto_id=event_id, upto_ts=ts)
+        return self._replay_from(snapshot, lambda e: (
+            (event_id is None or e["id"] <= event_id) and (ts is None or e["ts"] <= ts)
+        ))
+
+    def state_before(self, event_id):
+        """重建指定事件發生前的狀態 (例如復原「清空所有倉位」)；無更早紀錄時回傳 None"""
+        snapshot = self._latest_snapshot(upto_id=event_id, strict=True)
+        return self._replay_from(snapshot, lambda e: e["id"] < event_id)
+
+    def _replay_from(self, snapshot, include):
+        """由快照依序套用 include 為真的事件 (遇到第一筆不符合者即停止)"""
+        if snapshot is None:
+            return None
+        events = []
+        for event in self._events_after(snapshot["id"]):
+            if not include(event):
+                break
+            events.append(event)
+        return replay(snapshot["portfolio"], events)
+
+    # 子類別實作
+    def _append(self, event):
+        raise NotImplementedError
+
+    def _events_after(self, event_id):
+        raise NotImplementedError
+
+    def _latest_snapshot(self, upto_id=None, upto_ts=None, strict=False):
+        """id <= upto_id (strict 時為 <) 且時間 <= upto_ts 的最新快照"""
+        raise NotImplementedError
+
+    def _save_snapshot(self, event_id, ts, portfolio):
+        raise NotImplementedError
+
+    def recent_events(self, n=20):
+        raise NotImplementedError
+
+
+class LocalJournal(PositionJournal):
+    """本地檔案日誌：events.jsonl + snapshots/<id>.json
+
+    快照記錄 events.jsonl 中對應事件之後的位元組位置，載入時直接 seek，
+    不需從頭掃描整份日誌。
+    """
+
+    BASE_SNAPSHOT_ID = f"{0:012d}"
+
+    def __init__(self, directory="journal", **kwargs):
+        super().__init__(**kwargs)
+        self.directory = directory
+        self.events_path = os.path.join(directory, "events.jsonl")
+        self.snapshot_dir = os.path.join(directory, "snapshots")
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        self._next_seq = None
+
+    def _append(self, event):
+        if self._next_seq is None:
+            last = self.recent_events(1)
+            self._next_seq = int(last[0]["id"]) + 1 if last else 1
+        event_id = f"{self._next_seq:012d}"
+        self._next_seq += 1
+        with open(self.events_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({**event, "id": event_id}, ensure_ascii=False) + "\n")
+        return event_id
+
+    def _events_after(self, event_id):
+        if not os.path.exists(self.events_path):
+            return
+        snapshot_path = os.path.join(self.snapshot_dir, f"{event_id}.json")
+        offset = 0
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, encoding="utf-8") as f:
+                offset = json.load(f).get("offset", 0)
+        with open(self.events_path, encoding="utf-8") as f:
+            f.seek(offset)
+            for line in f:
+                event = json.loads(line)
+                if event["id"] > event_id:
+                    yield event
+
+    def _latest_snapshot(self, upto_id=None, upto_ts=None, strict=False):
+        for name in sorted(os.listdir(self.snapshot_dir), reverse=True):
+            if upto_id is not None and (name[:-len(".json")] >= upto_id if strict else name[:-len(".json")] > upto_id):
+                continue
+            with open(os.path.join(self.snapshot_dir, name), encoding="utf-8") as f:
+                snapshot = json.load(f)
+            if upto_ts is not None and snapshot["ts"] > upto_ts:
+                continue
+            return snapshot
+        return None
+
+    def _save_snapshot(self, event_id, ts, portfolio):
+        snapshot = {
+            "id": event_id,
+            "ts": ts,
+            "offset": os.path.getsize(self.events_path) if os.path.exists(self.events_path) else 0,
+            "portfolio": portfolio,
+        }
+        path = os.path.join(self.snapshot_dir, f"{event_id}.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def recent_events(self, n=20):
+        if not os.path.exists(self.events_path):
+            return []
+        # 由檔尾往回讀取最後 n 行
+        with open(self.events_path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            block = b""
+            while end > 0 and block.count(b"\n") <= n:
+                start = max(0, end - 8192)
+                f.seek(start)
+                block = f.read(end - start) + block
+                end = start
+        lines = [line for line in block.decode("utf-8").splitlines() if line.strip()]
+        return [json.loads(line) for line in lines[-n:]] if n else []
+
+
+class FirebaseJournal(PositionJournal):
+    """Firebase 日誌：hedge_journal/events (push) + hedge_journal/snapshots/<id>"""
+
+    BASE_SNAPSHOT_ID = "-"  # push key 皆以 "-" 開頭，依鍵排序時排在所有事件之前
+
+    def __init__(self, path="hedge_journal", **kwargs):
+        super().__init__(**kwargs)
+        from firebase_admin import db
+        self.events_ref = db.reference(f"{path}/events")
+        self.snapshots_ref = db.reference(f"{path}/snapshots")
+
+    def _append(self, event):
+        return self.events_ref.push(event).key
+
+    def _events_after(self, event_id):
+        events = self.events_ref.order_by_key().start_at(event_id).get() or {}
+        for key, event in events.items():
+            if key > event_id:
+                yield {**event, "id": key}
+
+    def _latest_snapshot(self, upto_id=None, upto_ts=None, strict=False):
+        query = self.snapshots_ref.order_by_key()
+        if upto_id is not None:
+            query = query.end_at(upto_id)
+        if upto_ts is None:
+            # 只需最後一份 (strict 時可能要略過 id 等於 upto_id 的那份)
+            query = query.limit_to_last(2 if strict else 1)
+        snapshots = query.get() or {}
+        for key in sorted(snapshots, reverse=True):
+            snapshot = snapshots[key]
+            if strict and key == upto_id:
+                continue
+            if upto_ts is not None and snapshot["ts"] > upto_ts:
+                continue
+            return {**snapshot, "id": key}
+        return None
+
+    def _save_snapshot(self, event_id, ts, portfolio):
+        self.snapshots_ref.child(event_id).set({"ts": ts, "portfolio": portfolio})
+
+    def recent_events(self, n=20):
+        events = self.events_ref.order_by_key().limit_to_last(n).get() or {}
+        return [{**event, "id": key} for key, event in events.items()]
@@ -0,0 +1,172 @@
+# ======== 盤中即時損益 ========
+# 背景執行緒輪詢報價，將 tick 推送到各訂閱者的佇列；
+# 每個 tick 只重算「目前價位」的損益與 Delta (O(log n))，不重算整張損益網格。
+
+import queue
+import threading
+import time
+import weakref
+
+from hedge_core import (
+    ETF_SHARES_PER_LOT,
+    portfolio_hash,
+    normalize_costs,
+    etf_pnl_slope,
+    calc_etf_pnl,
+    calc_etf_cost_grid,
+    calc_holdings_pnl_grid,
+    calc_holdings_cost_grid,
+    holdings_pnl_slope,
+    build_payoff_profile,
+    profile_pnl_at,
+    profile_slope_at,
+)
+from quotes import TSE_INDEX_TICKER, ETF_TICKER, fetch_intraday_price
+
+LIVE_POLL_INTERVAL = 5.0  # 報價輪詢間隔 (秒)
+SUBSCRIBER_QUEUE_SIZE = 100  # 每個訂閱者最多暫存的 tick 數
+
+
+class QuoteStreamer:
+    """背景輪詢加權指數與 00631L 報價，廣播給所有訂閱者
+
+    訂閱者以 WeakSet 保存，Streamlit session 結束後佇列被回收即自動退訂；
+    沒有任何訂閱者時暫停輪詢，有新訂閱者時立即恢復。
+    """
+
+    def __init__(self, poll_interval=LIVE_POLL_INTERVAL, fetch=fetch_intraday_price):
+        self.poll_interval = poll_interval
+        self.fetch = fetch
+        self.latest = None
+        self._subscribers = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="quote-streamer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def subscribe(self):
+        """建立新的 tick 佇列 (已有最新報價時先放入一筆)"""
+        q = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.add(q)
+            if self.latest is not None:
+                q.put_nowait(self.latest)
+        self._wake.set()
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def has_subscribers(self):
+        with self._lock:
+            return len(self._subscribers) > 0
+
+    def publish(self, tick):
+        """廣播 tick；佇列已滿時丟棄最舊的一筆"""
+        with self._lock:
+            self.latest = tick
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            while True:
+                try:
+                    q.put_nowait(tick)
+                    break
+                except queue.Full:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.clear()
+            if self.has_subscribers():
+                index_price = self.fetch(TSE_INDEX_TICKER)
+                etf_price = self.fetch(ETF_TICKER)
+                if index_price:
+                    self.publish({"ts": time.time(), "index": index_price, "etf": etf_price})
+            # 有新訂閱者 (或停止) 時提前醒來；session 被回收不會通知，仍需定期檢查
+            self._wake.wait(self.poll_interval)
+
+
+def drain_latest(q):
+    """取出佇列中所有 tick，只回傳最新一筆 (沒有新 tick 時回傳 None)"""
+    tick = None
+    while True:
+        try:
+            tick = q.get_nowait()
+        except queue.Empty:
+            return tick
+
+
+class LiveRevaluer:
+    """以倉位的分段線性結構增量重算目前價位的損益
+
+    倉位變更 (雜湊不同) 時才重建結構；每個 tick 只做一次二分搜尋。
+    costs 為交易成本設定，指定時與損益圖相同，各項皆為扣除手續費與稅後的淨損益。
+    """
+
+    def __init__(self):
+        self._key = None
+        self._profile = None
+        self._book = None
+        self._costs = None
+
+    def update_book(self, portfolio, base_index, costs=None):
+        costs = normalize_costs(costs)
+        key = (portfolio_hash(portfolio), base_index, None if costs is None else tuple(sorted(costs.items())))
+        if key != self._key:
+            # 只建立倉位組合的結構，ETF 損益改用即時 ETF 報價計算
+            self._profile = build_payoff_profile(portfolio["option_positions"], base_index, 0.0, 0.0, 0.0, costs=costs)
+            self._book = portfolio
+            self._costs = costs
+            self._key = key
+
+    def revalue(self, tick, base_index):
+        """回傳目前價位的 ETF / 倉位 / 總損益與 Delta (元/點)"""
+        book, costs = self._book, self._costs
+        index_price = tick["index"]
+        etf_lots = book["etf_lots"]
+        etf_current = book["etf_current_price"] or 0.0
+
+        option_pnl = profile_pnl_at(self._profile, index_price)
+        if tick.get("etf"):
+            etf_pnl = (tick["etf"] - book["etf_cost"]) * etf_lots * ETF_SHARES_PER_LOT if etf_lots > 0 else 0.0
+            if costs is not None:
+                # 以即時 ETF 報價估算賣出費稅 (網格在基準指數的值即為以 etf_current 賣出)
+                etf_pnl -= float(calc_etf_cost_grid([base_index], base_index, etf_lots, tick["etf"], costs)[0])
+        else:
+            etf_pnl = calc_etf_pnl(index_price, base_index, etf_lots, book["etf_cost"], etf_current)
+            if costs is not None:
+                etf_pnl -= float(calc_etf_cost_grid([index_price], base_index, etf_lots, etf_current, costs)[0])
+        # 其他持股依 beta 由指數推算
+        holdings = book.get("holdings") or []
+        if holdings:
+            etf_pnl += float(calc_holdings_pnl_grid(holdings, [index_price], base_index).sum())
+            if costs is not None:
+                etf_pnl -= float(calc_holdings_cost_grid(holdings, [index_price], base_index, costs).sum())
+
+        option_delta = profile_slope_at(self._profile, index_price)
+        etf_delta = etf_pnl_slope(base_index, etf_lots, etf_current, costs) + holdings_pnl_slope(holdings, base_index, costs)
+        return {
+            "ts": tick["ts"],
+            "index": index_price,
+            "etf_pnl": etf_pnl,
+            "option_pnl": option_pnl,
+            "total_pnl": etf_pnl + option_pnl,
+            "option_delta": option_delta,
+            "delta": etf_delta + option_delta,
+        }
+
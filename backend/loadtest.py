@@ -0,0 +1,548 @@
+# ======== 多 session 負載測試 ========
+# 啟動一個真正的 `streamlit run app.py` 伺服器行程，以 N 條 websocket 連線模擬 N 個同時開啟的瀏覽器分頁
+# (與前端相同的 BackMsg / ForwardMsg 協定)。所有 session 共用同一個伺服器的 GIL、快取區域與記憶體，
+# 量測的是同一伺服器內 rerun 排隊的延遲，以及該伺服器行程的記憶體隨 session 數的變化。
+#
+# 伺服器行程內的報價與 Firebase 以記憶體中的假後端取代 (可設定延遲)，不會連線或寫入正式倉位；
+# 所有 session 寫入同一份假文件 (含 ETag 衝突)，並如瀏覽器般定期執行遠端同步的 fragment。
+# 每個 session 依序點擊 ➕ / ➖、調整模擬範圍、重新整理價格，每個 session 數各啟動一次全新的伺服器。
+#
+#     python loadtest.py --sessions 1,5,10,20 --iterations 12
+#     python loadtest.py --sessions 10 --think 0 --quote-latency 0.3 --storage-latency 0.05 -o loadtest.csv
+
+import argparse
+import asyncio
+import copy
+import csv
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.request
+
+import numpy as np
+
+from cache import process_rss
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+ACTIONS = ["plus", "price_range", "minus", "refresh"]  # 每個 session 依序循環執行
+STATS_INTERVAL = 0.2  # 伺服器行程寫出統計檔的間隔 (秒)
+
+# 未指定 --portfolio 時使用的倉位 (與 hedge_positions.json 相同格式)
+SAMPLE_PORTFOLIO = {
+    "etf_lots": 6.5,
+    "etf_cost": 328.8,
+    "etf_current_price": 339.55,
+    "hedge_ratio": 0.4,
+    "cash_cost": 0.0,
+    "cash_current": 0.0,
+    "option_positions": [
+        {"product": "台指", "type": "Put", "direction": "買進", "strike": 27400.0, "lots": 3, "premium": 33.0},
+        {"product": "台指", "type": "Call", "direction": "賣出", "strike": 28100.0, "lots": 6, "premium": 66.0},
+        {"product": "台指", "type": "Call", "direction": "買進", "strike": 28200.0, "lots": 6, "premium": 43.0},
+    ],
+    "holdings": [],
+}
+
+
+# ======== 假後端 (在伺服器行程內) ========
+class FakeMarket:
+    """隨機漫步的加權指數與 00631L 報價；latency 模擬 Yahoo Finance 的回應時間 (秒)"""
+
+    def __init__(self, index=27800.0, etf=340.0, latency=0.0, seed=None):
+        self.index = index
+        self.etf = etf
+        self.latency = latency
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def _tick(self):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+            move = self._rng.gauss(0, 0.002)
+            self.index *= 1 + move
+            self.etf *= 1 + 2 * move
+            return self.index, self.etf
+
+    def module(self):
+        """建立可取代 quotes 模組的物件"""
+        quotes = types.ModuleType("quotes")
+        quotes.TSE_INDEX_TICKER = "^TWII"
+        quotes.ETF_TICKER = "00631L.TW"
+        quotes.fetch_tse_index_price = lambda ticker=quotes.TSE_INDEX_TICKER: self._tick()[0]
+        quotes.fetch_00631L_price = lambda: self._tick()[1]
+        quotes.fetch_intraday_price = lambda ticker: self._tick()[0 if ticker == quotes.TSE_INDEX_TICKER else 1]
+        quotes.fetch_prices = lambda tickers: {t: self._tick()[1] / 2 for t in tickers}
+        return quotes
+
+
+class FakeStore:
+    """記憶體中的倉位文件，介面與 storage 模組相同 (含 ETag 比對)"""
+
+    def __init__(self, portfolio, latency=0.0):
+        self.doc = copy.deepcopy(portfolio)
+        self.etag = 0
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.writes = 0
+        self.conflicts = 0
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def load_portfolio(self, path=None):
+        self._wait()
+        with self._lock:
+            return copy.deepcopy(self.doc)
+
+    def load_portfolio_with_etag(self, path=None):
+        self._wait()
+        with self._lock:
+            return copy.deepcopy(self.doc), str(self.etag)
+
+    def save_portfolio(self, data, path=None):
+        self._wait()
+        with self._lock:
+            self.doc = copy.deepcopy(data)
+            self.etag += 1
+            self.writes += 1
+
+    def save_portfolio_if_unchanged(self, data, etag, path=None):
+        self._wait()
+        with self._lock:
+            if etag is not None and etag != str(self.etag):
+                self.conflicts += 1
+                return False, copy.deepcopy(self.doc), str(self.etag)
+            self.doc = copy.deepcopy(data)
+            self.etag += 1
+            self.writes += 1
+            return True, copy.deepcopy(data), str(self.etag)
+
+    def version(self):
+        with self._lock:
+            return self.etag
+
+    def snapshot(self):
+        """回傳 (版本, 文件副本)，供假監聽器使用"""
+        with self._lock:
+            return self.etag, copy.deepcopy(self.doc)
+
+    def stats(self):
+        with self._lock:
+            return {"writes": self.writes, "conflicts": self.conflicts}
+
+
+def fake_storage_module(store, key_file):
+    """建立可取代 storage 模組的物件
+
+    key_file 須為存在的檔案：app.py 看到本機憑證檔就不讀 st.secrets，直接呼叫 (假的) init_firebase。
+    """
+    import storage as real_storage
+
+    class FakeListener:
+        def __init__(self, path=None):
+            pass
+
+        def start(self):
+            return self
+
+        @property
+        def version(self):
+            return store.version()
+
+        def snapshot(self):
+            return store.snapshot()
+
+        def close(self):
+            pass
+
+    storage = types.ModuleType("storage")
+    storage.FIREBASE_KEY_FILE = key_file
+    storage.PORTFOLIO_PATH = real_storage.PORTFOLIO_PATH
+    storage.init_firebase = lambda cred_dict=None: None
+    storage.load_portfolio = store.load_portfolio
+    storage.load_portfolio_with_etag = store.load_portfolio_with_etag
+    storage.save_portfolio = store.save_portfolio
+    storage.save_portfolio_if_unchanged = store.save_portfolio_if_unchanged
+    storage.apply_event = real_storage.apply_event
+    storage.PortfolioListener = FakeListener
+    return storage
+
+
+def install_fakes(market, store, workdir):
+    """以假後端取代 quotes / storage，Firebase 日誌與本地快照改寫入暫存目錄"""
+    import journal as real_journal
+    fake_journal = types.ModuleType("journal")
+    fake_journal.__dict__.update({k: v for k, v in vars(real_journal).items() if not k.startswith("__")})
+    fake_journal.FirebaseJournal = lambda **kwargs: real_journal.LocalJournal(os.path.join(workdir, "journal"), **kwargs)
+
+    key_file = os.path.join(workdir, "firebase_key.json")
+    with open(key_file, "w", encoding="utf-8") as f:
+        f.write("{}")
+
+    sys.modules["quotes"] = market.module()
+    sys.modules["storage"] = fake_storage_module(store, key_file)
+    sys.modules["journal"] = fake_journal
+    # live 於匯入時綁定 quotes 的函式，需重新匯入
+    sys.modules.pop("live", None)
+    # 本地快照寫到暫存目錄，不覆蓋正式的 backend/snapshots/
+    os.environ["HEDGE_SNAPSHOT_PATH"] = os.path.join(workdir, "snapshots", "hedge_positions.npz")
+
+
+def serve(args):
+    """伺服器行程進入點：安裝假後端後以 `streamlit run` 啟動 app.py
+
+    另以背景執行緒定期寫出假後端與快取區域的統計，供量測端讀取。
+    """
+    from cache import region_stats
+
+    os.makedirs(args.workdir, exist_ok=True)
+    with open(args.portfolio, encoding="utf-8") as f:
+        portfolio = json.load(f)
+    market = FakeMarket(latency=args.quote_latency, seed=0)
+    store = FakeStore(portfolio, latency=args.storage_latency)
+    install_fakes(market, store, args.workdir)
+
+    stats_path = os.path.join(args.workdir, "server_stats.json")
+
+    def write_stats():
+        while True:
+            stats = {**store.stats(), "quote_calls": market.calls, "regions": region_stats()}
+            with open(stats_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(stats, f)
+            os.replace(stats_path + ".tmp", stats_path)
+            time.sleep(STATS_INTERVAL)
+
+    threading.Thread(target=write_stats, daemon=True).start()
+
+    from streamlit.web import cli
+    sys.argv = [
+        "streamlit", "run", APP_PATH,
+        "--server.port", str(args.port),
+        "--server.address", "127.0.0.1",
+        "--server.headless", "true",
+        "--server.fileWatcherType", "none",
+        "--server.runOnSave", "false",
+        "--browser.gatherUsageStats", "false",
+        "--global.developmentMode", "false",
+        "--logger.level", "warning",
+    ]
+    sys.exit(cli.main())
+
+
+# ======== 瀏覽器 session 模擬 ========
+class BrowserSession:
+    """以 websocket 模擬一個瀏覽器分頁：送出 rerun_script，收到 script_finished 為一次 rerun"""
+
+    def __init__(self, url, timeout):
+        self.url = url
+        self.timeout = timeout
+        self.ws = None
+        self.widgets = {}  # 元件 id -> (類型, 元件 proto)
+        self.values = {}  # 已設定值的元件 id -> WidgetState (每次 rerun 都送出，與前端相同)
+        self.fragment = None  # (fragment_id, 間隔秒數)：app 以 run_every 註冊的自動 rerun
+
+    async def connect(self):
+        from websockets.asyncio.client import connect
+        self.ws = await connect(
+            self.url, subprotocols=["streamlit"], max_size=None, ping_interval=None, open_timeout=self.timeout
+        )
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+
+    def find(self, key=None, label=None):
+        """依 key (元件 id 的結尾) 或標籤尋找元件 id"""
+        for widget_id, (_, widget) in self.widgets.items():
+            if (key is not None and widget_id.endswith(f"-{key}")) or (label is not None and getattr(widget, "label", None) == label):
+                return widget_id
+        return None
+
+    def set_value(self, widget_id, **value):
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+        self.values[widget_id] = WidgetState(id=widget_id, **value)
+
+    async def rerun(self, trigger=None, fragment_id=""):
+        """送出一次 rerun (trigger 為被點擊的按鈕 id)，回傳錯誤訊息 (無錯誤時為 None)"""
+        from streamlit.proto.Alert_pb2 import Alert
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        msg = BackMsg()
+        state = msg.rerun_script
+        state.query_string = ""
+        state.page_script_hash = ""
+        state.fragment_id = fragment_id
+        state.is_auto_rerun = bool(fragment_id)
+        state.widget_states.widgets.extend(self.values.values())
+        if trigger is not None:
+            state.widget_states.widgets.add(id=trigger, trigger_value=True)
+        await self.ws.send(msg.SerializeToString())
+
+        errors = []
+        while True:
+            fmsg = ForwardMsg.FromString(await asyncio.wait_for(self.ws.recv(), self.timeout))
+            kind = fmsg.WhichOneof("type")
+            if kind == "delta" and fmsg.delta.WhichOneof("type") == "new_element":
+                element = fmsg.delta.new_element
+                element_type = element.WhichOneof("type")
+                if element_type == "exception":
+                    errors.append(element.exception.message)
+                elif element_type == "alert" and element.alert.format == Alert.ERROR:
+                    errors.append(element.alert.body)
+                else:
+                    widget = getattr(element, element_type, None) if element_type else None
+                    widget_id = getattr(widget, "id", "")
+                    if widget_id:
+                        self.widgets[widget_id] = (element_type, widget)
+            elif kind == "auto_rerun":
+                self.fragment = (fmsg.auto_rerun.fragment_id, fmsg.auto_rerun.interval)
+            elif kind == "script_finished":
+                # st.rerun() 會先提早結束再重新執行，等到真正完成的那一次
+                if fmsg.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    break
+        return errors[0] if errors else None
+
+
+async def run_session(url, session_id, iterations, think, timeout, start):
+    """執行一個 session：首次載入後循環 ACTIONS，回傳 [(動作, 秒數, 錯誤)]"""
+    rng = random.Random(session_id)
+    session = BrowserSession(url, timeout)
+    timings = []
+
+    async def timed(action, **kwargs):
+        started = time.perf_counter()
+        try:
+            error = await session.rerun(**kwargs)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        timings.append((action, time.perf_counter() - started, error))
+
+    await session.connect()
+    try:
+        await start.wait()
+        await timed("load")
+        last_sync = time.monotonic()
+        for i in range(iterations):
+            if think:
+                await asyncio.sleep(think * rng.uniform(0.5, 1.5))
+            # 瀏覽器依 run_every 定期執行遠端同步的 fragment
+            if session.fragment and time.monotonic() - last_sync >= session.fragment[1]:
+                await timed("sync", fragment_id=session.fragment[0])
+                last_sync = time.monotonic()
+
+            action = ACTIONS[i % len(ACTIONS)]
+            if action == "plus":
+                widget_id = session.find(key="plus_opt_0")
+            elif action == "minus":
+                widget_id = session.find(key="minus_opt_0")
+            elif action == "price_range":
+                widget_id = session.find(label="模擬範圍 (±點數)")
+            else:
+                widget_id = session.find(label="🔄 重新整理價格")
+            if widget_id is None:
+                timings.append((action, 0.0, f"找不到元件: {action}"))
+                continue
+            if action == "price_range":
+                session.set_value(widget_id, int_value=1000 + 100 * rng.randint(0, 20))
+                await timed(action)
+            else:
+                await timed(action, trigger=widget_id)
+    finally:
+        await session.close()
+    return timings
+
+
+async def run_sessions(url, sessions, iterations, think, timeout):
+    """所有 session 連線後同時開始"""
+    start = asyncio.Event()
+    tasks = [
+        asyncio.create_task(run_session(url, i, iterations, think, timeout, start))
+        for i in range(sessions)
+    ]
+    await asyncio.sleep(0.1)
+    started = time.time()
+    start.set()
+    results = await asyncio.gather(*tasks)
+    return results, time.time() - started
+
+
+# ======== 伺服器控制 ========
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args, workdir, portfolio_path):
+    """以子行程啟動伺服器，等待健康檢查通過後回傳 (行程, websocket 位址)"""
+    port = _free_port()
+    log = open(os.path.join(workdir, "server.log"), "wb")
+    server = subprocess.Popen(
+        [
+            sys.executable, os.path.abspath(__file__), "--serve",
+            "--port", str(port), "--workdir", workdir, "--portfolio", portfolio_path,
+            "--quote-latency", str(args.quote_latency), "--storage-latency", str(args.storage_latency),
+        ],
+        stdout=log, stderr=subprocess.STDOUT,
+    )
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            break
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1) as resp:
+                if resp.status == 200:
+                    return server, f"ws://127.0.0.1:{port}/_stcore/stream"
+        except OSError:
+            time.sleep(0.2)
+    stop_server(server)
+    with open(os.path.join(workdir, "server.log"), encoding="utf-8", errors="replace") as f:
+        raise SystemExit(f"伺服器未能啟動:\n{f.read()[-2000:]}")
+
+
+def stop_server(server):
+    server.terminate()
+    try:
+        server.wait(10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def read_server_stats(workdir):
+    # 等待伺服器寫出最新一次的統計
+    time.sleep(STATS_INTERVAL * 2)
+    with open(os.path.join(workdir, "server_stats.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def run_round(sessions, args, portfolio):
+    """啟動全新的伺服器並同時執行 sessions 個 session，回傳此輪的統計"""
+    with tempfile.TemporaryDirectory(prefix="hedge-loadtest-") as workdir:
+        portfolio_path = os.path.join(workdir, "portfolio.json")
+        with open(portfolio_path, "w", encoding="utf-8") as f:
+            json.dump(portfolio, f, ensure_ascii=False)
+
+        server, url = start_server(args, workdir, portfolio_path)
+        try:
+            # 暖機：先以一個 session 載入一次，基準記憶體包含 app.py 的匯入與共用快取
+            asyncio.run(run_sessions(url, 1, 0, 0.0, args.timeout))
+            rss_base = process_rss(server.pid)
+            rss_peak = [rss_base or 0]
+            done = threading.Event()
+
+            def sample_rss():
+                while not done.is_set():
+                    rss = process_rss(server.pid)
+                    if rss:
+                        rss_peak[0] = max(rss_peak[0], rss)
+                    done.wait(0.05)
+
+            sampler = threading.Thread(target=sample_rss, daemon=True)
+            sampler.start()
+            try:
+                results, elapsed = asyncio.run(run_sessions(url, sessions, args.iterations, args.think, args.timeout))
+            finally:
+                done.set()
+                sampler.join()
+            stats = read_server_stats(workdir)
+        finally:
+            stop_server(server)
+
+    timings = [t for result in results for t in result]
+    latencies = np.array([seconds for action, seconds, error in timings if error is None and seconds > 0])
+    errors = [error for _, _, error in timings if error is not None]
+    payoff = next((r for r in stats["regions"] if r["region"] == "payoff"), {})
+    mb = 1024 ** 2
+    return {
+        "sessions": sessions,
+        "reruns": len(latencies),
+        "errors": len(errors),
+        "p50_ms": float(np.percentile(latencies, 50) * 1000) if latencies.size else None,
+        "p95_ms": float(np.percentile(latencies, 95) * 1000) if latencies.size else None,
+        "max_ms": float(latencies.max() * 1000) if latencies.size else None,
+        "reruns_per_s": len(latencies) / elapsed if elapsed else None,
+        "rss_base_mb": rss_base / mb if rss_base else None,
+        "rss_peak_mb": rss_peak[0] / mb if rss_peak[0] else None,
+        "mb_per_session": (rss_peak[0] - rss_base) / mb / sessions if rss_base else None,
+        "payoff_hits": payoff.get("hits"),
+        "payoff_misses": payoff.get("misses"),
+        "payoff_coalesced": payoff.get("coalesced"),
+        "store_writes": stats["writes"],
+        "store_conflicts": stats["conflicts"],
+        "quote_calls": stats["quote_calls"],
+        "first_error": errors[0] if errors else "",
+    }
+
+
+def _fmt(value, spec):
+    return "-" if value is None else format(value, spec)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="以 websocket 模擬多個同時連線的瀏覽器 session，量測單一 Streamlit 伺服器的 rerun 延遲與記憶體")
+    parser.add_argument("--sessions", default="1,5,10", help="同時 session 數，以逗號分隔 (例如 1,5,10,20)")
+    parser.add_argument("--iterations", type=int, default=12, help="每個 session 首次載入後的操作次數")
+    parser.add_argument("--think", type=float, default=1.0, help="每次操作前的平均停頓 (秒)，0 為連續操作")
+    parser.add_argument("--portfolio", help="假後端的初始倉位檔 (預設使用內建範例)")
+    parser.add_argument("--quote-latency", type=float, default=0.0, help="假報價每次呼叫的延遲 (秒)")
+    parser.add_argument("--storage-latency", type=float, default=0.0, help="假 Firebase 每次讀寫的延遲 (秒)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="單次 rerun / 伺服器啟動的逾時 (秒)")
+    parser.add_argument("-o", "--output", help="將結果寫入 CSV")
+    # 伺服器行程 (由量測端啟動，不需手動指定)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        return serve(args)
+
+    try:
+        import websockets  # noqa: F401
+    except ImportError:
+        raise SystemExit("負載測試需要 websockets 套件 (pip install websockets)")
+
+    portfolio = SAMPLE_PORTFOLIO
+    if args.portfolio:
+        with open(args.portfolio, encoding="utf-8") as f:
+            portfolio = json.load(f)
+
+    session_counts = [int(n) for n in args.sessions.split(",") if n.strip()]
+    rows = []
+    print(f"{'sessions':>8} {'reruns':>7} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} "
+          f"{'rerun/s':>8} {'RSS MB':>8} {'MB/sess':>8} {'coalesced':>9}")
+    for n in session_counts:
+        row = run_round(n, args, portfolio)
+        rows.append(row)
+        print(f"{n:>8} {row['reruns']:>7} {row['errors']:>6} {_fmt(row['p50_ms'], '8.0f')} "
+              f"{_fmt(row['p95_ms'], '8.0f')} {_fmt(row['max_ms'], '8.0f')} {_fmt(row['reruns_per_s'], '8.1f')} "
+              f"{_fmt(row['rss_peak_mb'], '8.0f')} {_fmt(row['mb_per_session'], '8.2f')} "
+              f"{_fmt(row['payoff_coalesced'], '9d')}", flush=True)
+        if row["first_error"]:
+            print(f"         第一個錯誤: {row['first_error']}", file=sys.stderr)
+        print(f"         假 Firebase 寫入 {row['store_writes']} 次 (衝突 {row['store_conflicts']} 次)，"
+              f"損益快取命中 {row['payoff_hits']} / 未命中 {row['payoff_misses']}", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    return 1 if any(row["errors"] for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+# ======== 網路資料抓取 (Yahoo Finance) ========
+# 不含快取，由呼叫端 (Streamlit / API) 自行決定快取策略
+
+import yfinance as yf
+
+TSE_INDEX_TICKER = "^TWII"
+ETF_TICKER = "00631L.TW"
+
+
+def fetch_tse_index_price(ticker=TSE_INDEX_TICKER):
+    """從 Yahoo Finance 獲取加權指數的最新價格"""
+    try:
+        tse_ticker = yf.Ticker(ticker)
+        hist = tse_ticker.history(period="5d")
+        if not hist.empty:
+            price = float(hist['Close'].iloc[-1])
+            if price > 1000:
+                return price
+        return None
+    except Exception:
+        return None
+
+
+def fetch_00631L_price():
+    """從 Yahoo Finance 獲取 00631L 的最新價格"""
+    try:
+        etf_ticker = yf.Ticker(ETF_TICKER)
+        hist = etf_ticker.history(period="5d")
+        if not hist.empty:
+            price = float(hist['Close'].iloc[-1])
+            if price > 0:
+                return price
+        return None
+    except Exception:
+        return None
+
+
+def fetch_intraday_price(ticker):
+    """獲取盤中最新一分鐘的成交價 (盤後回傳最後收盤價)"""
+    try:
+        hist = yf.Ticker(ticker).history(period="1d", interval="1m")
+        if not hist.empty:
+            price = float(hist['Close'].iloc[-1])
+            if price > 0:
+                return price
+        return None
+    except Exception:
+        return None
+
+
+def fetch_prices(tickers):
+    """以單次批次請求獲取多檔標的的最新收盤價，回傳 {代號: 價格}"""
+    tickers = sorted(set(tickers))
+    if not tickers:
+        return {}
+    try:
+        data = yf.download(tickers, period="5d", progress=False, group_by="column", auto_adjust=False)
+        closes = data["Close"]
+        if not hasattr(closes, "columns"):
+            # 單一代號時為 Series
+            closes = closes.to_frame(tickers[0])
+        prices = {}
+        for ticker in tickers:
+            if ticker in closes.columns:
+                series = closes[ticker].dropna()
+                if not series.empty and float(series.iloc[-1]) > 0:
+                    prices[ticker] = float(series.iloc[-1])
+        return prices
+    except Exception:
+        return {}
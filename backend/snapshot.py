@@ -0,0 +1,253 @@
+# ======== 倉位快照 (二進位欄位格式) ========
+# 將倉位文件與計算好的損益網格存成未壓縮的 .npz：
+# 倉位列表以欄位陣列保存 (字串欄位轉為代碼 + 詞彙表)，網格直接存 float64 陣列。
+# 載入時以記憶體映射 (np.memmap) 讀取網格，不需解析 JSON 或複製整份資料。
+#
+#     python snapshot.py export ../hedge_positions.json -o positions.npz
+#     python snapshot.py import positions.npz -o restored.json
+#     python snapshot.py verify ../hedge_positions.json ../hedge_positions_backup.json
+
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import zipfile
+
+import numpy as np
+
+from hedge_core import PORTFOLIO_DEFAULTS, normalize_portfolio, portfolio_hash
+
+SNAPSHOT_VERSION = 1
+TABLE_FIELDS = ("option_positions", "holdings")  # 以欄位陣列保存的列表欄位
+
+
+# ======== 列表 <-> 欄位陣列 ========
+def _column_kind(values):
+    """依欄位內容決定保存方式：int / float / bool / category / json
+
+    int 與 float 混用 (如口數 6 與 6.0) 時以 JSON 保存，往返後雜湊才會相同。
+    """
+    for kind, types in (("bool", (bool,)), ("int", (int,)), ("float", (float,)), ("category", (str,))):
+        if all(type(v) in types for v in values):
+            return kind
+    return "json"
+
+
+def _encode_table(name, rows, arrays):
+    """將 dict 列表轉為欄位陣列寫入 arrays，回傳欄位說明 {欄位: 類型}"""
+    keys = []
+    for row in rows:
+        keys.extend(k for k in row if k not in keys)
+    columns = {}
+    for key in keys:
+        mask = np.array([key in row for row in rows], dtype=bool)
+        kind = _column_kind([row[key] for row in rows if key in row])
+        # 沒有此欄位的列以 None 佔位 (由 mask 標記，還原時略過)
+        values = [row.get(key) for row in rows]
+        prefix = f"{name}.{key}"
+        if not mask.all():
+            arrays[f"{prefix}.mask"] = mask
+        if kind == "bool":
+            arrays[prefix] = np.array([bool(v) for v in values], dtype=bool)
+        elif kind == "int":
+            arrays[prefix] = np.array([v or 0 for v in values], dtype=np.int64)
+        elif kind == "float":
+            arrays[prefix] = np.array([0.0 if v is None else v for v in values], dtype=np.float64)
+        elif kind == "category":
+            vocab = sorted({v for v in values if v is not None})
+            lookup = {v: i for i, v in enumerate(vocab)}
+            arrays[f"{prefix}.vocab"] = np.array(vocab, dtype=str)
+            arrays[prefix] = np.array([lookup.get(v, -1) for v in values], dtype=np.int16)
+        else:
+            arrays[prefix] = np.array([json.dumps(v, ensure_ascii=False) for v in values], dtype=str)
+        columns[key] = kind
+    return columns
+
+
+def _decode_table(name, n, columns, arrays):
+    """由欄位陣列還原 dict 列表 (欄位順序與原文件相同)"""
+    rows = [{} for _ in range(n)]
+    for key, kind in columns.items():
+        prefix = f"{name}.{key}"
+        values = arrays[prefix]
+        mask = arrays[f"{prefix}.mask"] if f"{prefix}.mask" in arrays else np.ones(n, dtype=bool)
+        if kind == "category":
+            vocab = arrays[f"{prefix}.vocab"].tolist()
+            decoded = [vocab[code] if code >= 0 else None for code in values.tolist()]
+        elif kind == "json":
+            decoded = [json.loads(v) for v in values.tolist()]
+        else:
+            decoded = values.tolist()
+        for row, present, value in zip(rows, mask.tolist(), decoded):
+            if present:
+                row[key] = value
+    return rows
+
+
+# ======== 寫入 ========
+def snapshot_bytes(portfolio, grids=None):
+    """將倉位文件 (與選用的網格 {名稱: 陣列}) 編碼為 .npz 位元組"""
+    portfolio = normalize_portfolio(portfolio)
+    arrays = {}
+    meta = {
+        "version": SNAPSHOT_VERSION,
+        "hash": portfolio_hash(portfolio),
+        "scalars": {k: v for k, v in portfolio.items() if k not in TABLE_FIELDS},
+        "tables": {},
+        "grids": [],
+    }
+    for name in TABLE_FIELDS:
+        rows = portfolio[name]
+        meta["tables"][name] = {"n": len(rows), "columns": _encode_table(name, rows, arrays)}
+    for name, values in (grids or {}).items():
+        arrays[f"grid.{name}"] = np.ascontiguousarray(values, dtype=np.float64)
+        meta["grids"].append(name)
+    arrays["meta"] = np.array(json.dumps(meta, ensure_ascii=False))
+
+    # 不壓縮，載入時才能直接記憶體映射
+    buf = io.BytesIO()
+    np.savez(buf, **arrays)
+    return buf.getvalue()
+
+
+def save_snapshot(path, portfolio, grids=None):
+    """寫入快照檔 (先寫暫存檔再替換，避免讀到寫到一半的檔案)
+
+    暫存檔名每次不同：多個 session 同時寫入同一份快照時不會互相覆寫暫存檔，
+    最後完成的替換生效。
+    """
+    data = snapshot_bytes(portfolio, grids)
+    directory, name = os.path.split(os.path.abspath(path))
+    tmp = tempfile.NamedTemporaryFile(dir=directory, prefix=name + ".", suffix=".tmp", delete=False)
+    try:
+        with tmp:
+            tmp.write(data)
+        os.replace(tmp.name, path)
+    except BaseException:
+        if os.path.exists(tmp.name):
+            os.unlink(tmp.name)
+        raise
+    return path
+
+
+# ======== 讀取 ========
+def _member_arrays(source, mmap):
+    """讀取 .npz 內各陣列；source 為路徑時，未壓縮的數值陣列以 np.memmap 映射"""
+    arrays = {}
+    mmap = mmap and isinstance(source, (str, os.PathLike))
+    with zipfile.ZipFile(source) as zf, (open(source, "rb") if mmap else io.BytesIO()) as raw:
+        for info in zf.infolist():
+            name = info.filename[:-len(".npy")] if info.filename.endswith(".npy") else info.filename
+            if mmap and info.compress_type == zipfile.ZIP_STORED:
+                # 略過 local file header (30 bytes + 檔名 + extra) 後即為 .npy 內容
+                raw.seek(info.header_offset)
+                header = raw.read(30)
+                name_len = int.from_bytes(header[26:28], "little")
+                extra_len = int.from_bytes(header[28:30], "little")
+                raw.seek(info.header_offset + 30 + name_len + extra_len)
+                version = np.lib.format.read_magic(raw)
+                if version == (1, 0):
+                    shape, fortran, dtype = np.lib.format.read_array_header_1_0(raw)
+                elif version == (2, 0):
+                    shape, fortran, dtype = np.lib.format.read_array_header_2_0(raw)
+                else:
+                    shape, dtype = (), None
+                if dtype is not None and dtype.kind in "biuf" and shape and np.prod(shape) > 0:
+                    arrays[name] = np.memmap(
+                        source, dtype=dtype, mode="r", offset=raw.tell(), shape=shape,
+                        order="F" if fortran else "C",
+                    )
+                    continue
+            with zf.open(info) as f:
+                arrays[name] = np.lib.format.read_array(f, allow_pickle=False)
+    return arrays
+
+
+def load_snapshot(source, mmap=True):
+    """讀取快照 (路徑或檔案物件)，回傳 (倉位文件, {名稱: 網格陣列})
+
+    mmap=True 且 source 為路徑時，網格為唯讀記憶體映射。
+    """
+    arrays = _member_arrays(source, mmap)
+    meta = json.loads(arrays["meta"].item())
+    if meta["version"] > SNAPSHOT_VERSION:
+        raise ValueError(f"不支援的快照版本: {meta['version']}")
+    portfolio = dict(meta["scalars"])
+    for name, table in meta["tables"].items():
+        portfolio[name] = _decode_table(name, table["n"], table["columns"], arrays)
+    grids = {name: arrays[f"grid.{name}"] for name in meta["grids"]}
+    return normalize_portfolio(portfolio), grids
+
+
+def snapshot_hash(path):
+    """只讀取 meta 取得倉位雜湊 (用於判斷快照是否仍與目前倉位相同)"""
+    with zipfile.ZipFile(path) as zf, zf.open("meta.npy") as f:
+        return json.loads(np.lib.format.read_array(f, allow_pickle=False).item())["hash"]
+
+
+# ======== 命令列 ========
+def verify_roundtrip(portfolio):
+    """檢查 JSON 倉位文件經快照往返後內容與雜湊完全相同，回傳差異說明 (無差異時為空列表)"""
+    expected = normalize_portfolio(portfolio)
+    grid = np.linspace(-1.0, 1.0, 7)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = save_snapshot(os.path.join(tmp, "roundtrip.npz"), expected, {"check": grid})
+        restored, grids = load_snapshot(path)
+        problems = []
+        if restored != expected:
+            for key in PORTFOLIO_DEFAULTS:
+                if restored.get(key) != expected.get(key):
+                    problems.append(f"欄位 {key} 不一致")
+        if portfolio_hash(restored) != portfolio_hash(expected):
+            problems.append("倉位雜湊不一致")
+        if snapshot_hash(path) != portfolio_hash(expected):
+            problems.append("meta 雜湊不一致")
+        if not np.array_equal(grids["check"], grid):
+            problems.append("網格內容不一致")
+        del grids  # 釋放記憶體映射後才能刪除暫存檔
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="倉位快照 (.npz) 匯出 / 匯入 / 往返檢查")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_export = sub.add_parser("export", help="JSON 倉位檔 -> 快照")
+    p_export.add_argument("input")
+    p_export.add_argument("-o", "--output", required=True)
+    p_import = sub.add_parser("import", help="快照 -> JSON 倉位檔")
+    p_import.add_argument("input")
+    p_import.add_argument("-o", "--output", default="-")
+    p_verify = sub.add_parser("verify", help="檢查 JSON 倉位檔經快照往返後是否完全相同")
+    p_verify.add_argument("inputs", nargs="+")
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        with open(args.input, encoding="utf-8") as f:
+            save_snapshot(args.output, json.load(f))
+        return 0
+    if args.command == "import":
+        portfolio, _ = load_snapshot(args.input)
+        text = json.dumps(portfolio, ensure_ascii=False, indent=2)
+        if args.output == "-":
+            print(text)
+        else:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+        return 0
+
+    failed = 0
+    for path in args.inputs:
+        with open(path, encoding="utf-8") as f:
+            problems = verify_roundtrip(json.load(f))
+        if problems:
+            failed += 1
+            print(f"{path}: " + "；".join(problems), file=sys.stderr)
+        else:
+            print(f"{path}: OK")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
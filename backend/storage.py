@@ -0,0 +1,148 @@
+# ======== 倉位資料儲存 (Firebase Realtime Database) ========
+# 不依賴 Streamlit，錯誤以例外拋出由呼叫端處理
+
+import copy
+import os
+import threading
+
+import firebase_admin
+from firebase_admin import credentials, db
+
+FIREBASE_DATABASE_URL = "https://l-op-bf09b-default-rtdb.asia-southeast1.firebasedatabase.app/"
+FIREBASE_KEY_FILE = "firebase_key.json"
+PORTFOLIO_PATH = "hedge_positions"
+
+
+def init_firebase(cred_dict=None):
+    """初始化 Firebase (重複呼叫不會重新初始化)"""
+    if firebase_admin._apps:
+        return
+    # 優先嘗試本機開發：使用 JSON 檔案
+    if os.path.exists(FIREBASE_KEY_FILE):
+        cred = credentials.Certificate(FIREBASE_KEY_FILE)
+    # Streamlit Cloud / 其他部署：由呼叫端傳入憑證內容
+    elif cred_dict:
+        cred = credentials.Certificate(dict(cred_dict))
+    else:
+        raise FileNotFoundError("找不到 Firebase 憑證")
+    firebase_admin.initialize_app(cred, {
+        'databaseURL': FIREBASE_DATABASE_URL
+    })
+
+
+def load_portfolio(path=PORTFOLIO_PATH):
+    """從 Firebase 讀取倉位文件"""
+    return db.reference(path).get()
+
+
+def save_portfolio(data, path=PORTFOLIO_PATH):
+    """將整份倉位文件寫入 Firebase"""
+    db.reference(path).set(data)
+
+
+def load_portfolio_with_etag(path=PORTFOLIO_PATH):
+    """讀取倉位文件與其 ETag，回傳 (資料, ETag)"""
+    return db.reference(path).get(etag=True)
+
+
+def save_portfolio_if_unchanged(data, etag, path=PORTFOLIO_PATH):
+    """樂觀並行控制：僅在遠端未被其他裝置修改時寫入
+
+    回傳 (是否成功, 遠端目前資料, 新 ETag)；失敗時資料未寫入
+    """
+    ref = db.reference(path)
+    if etag is None:
+        # 尚未取得 ETag (例如初次載入失敗)：先補取再條件寫入，仍受並行保護
+        _, etag = ref.get(etag=True)
+    return ref.set_if_unchanged(etag, data)
+
+
+# ======== 即時同步 ========
+def apply_event(doc, event_type, path, data):
+    """將 Firebase 監聽事件 (put / patch) 套用到本地文件，回傳新文件"""
+    keys = [k for k in path.split("/") if k]
+    if not keys:
+        if event_type == "patch":
+            # 與巢狀 patch 相同：值為 None 代表刪除該欄位
+            doc = dict(doc or {})
+            for k, v in (data or {}).items():
+                _set_child(doc, k, v)
+            return doc
+        return copy.deepcopy(data)
+
+    doc = copy.deepcopy(doc) if doc is not None else {}
+    node = doc
+    for key, child_key in zip(keys[:-1], keys[1:]):
+        node = _child(node, key, create=True, child_key=child_key)
+    last = keys[-1]
+
+    if event_type == "patch":
+        target = _child(node, last, create=True, child_key=next(iter(data or {}), ""))
+        for k, v in (data or {}).items():
+            _set_child(target, k, v)
+    else:
+        _set_child(node, last, data)
+    return doc
+
+
+def _child(node, key, create=False, child_key=""):
+    # 建立缺少的節點時，下一層為數字鍵則建立陣列 (與 Firebase 回傳陣列的方式一致)
+    empty = [] if str(child_key).isdigit() else {}
+    if isinstance(node, list):
+        i = int(key)
+        while create and len(node) <= i:
+            node.append(None)
+        if node[i] is None and create:
+            node[i] = empty
+        return node[i]
+    if key not in node and create:
+        node[key] = empty
+    return node[key]
+
+
+def _set_child(node, key, value):
+    if isinstance(node, list):
+        i = int(key)
+        while len(node) <= i:
+            node.append(None)
+        node[i] = value
+        while node and node[-1] is None:
+            node.pop()
+    elif value is None:
+        node.pop(key, None)
+    else:
+        node[key] = value
+
+
+class PortfolioListener:
+    """在背景執行緒訂閱 Firebase 倉位文件的變更事件
+
+    每收到一次事件 version 加 1，呼叫端比較 version 即可得知是否有更新，
+    不需要重新讀取整份文件。
+    """
+
+    def __init__(self, path=PORTFOLIO_PATH):
+        self.path = path
+        self.data = None
+        self.version = 0
+        self._lock = threading.Lock()
+        self._registration = None
+
+    def start(self):
+        self._registration = db.reference(self.path).listen(self._on_event)
+        return self
+
+    def _on_event(self, event):
+        with self._lock:
+            self.data = apply_event(self.data, event.event_type, event.path, event.data)
+            self.version += 1
+
+    def snapshot(self):
+        """回傳 (version, 文件副本)"""
+        with self._lock:
+            return self.version, copy.deepcopy(self.data)
+
+    def close(self):
+        if self._registration is not None:
+            self._registration.close()
+            self._registration = None
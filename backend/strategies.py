@@ -0,0 +1,289 @@
+# ======== 避險策略範本 ========
+# 以「相對現價的點數」描述策略，口數由 ETF 張數 × 避險比例決定；
+# 一次產生數百個參數組合，將所有組合的倉位串成單一列表，只呼叫一次向量化損益計算，
+# 再依成本與保護效果排序。
+#
+#     python strategies.py ../hedge_positions.json --center 27800 --vol 18 --dte 30 --top 20
+
+import argparse
+import json
+import sys
+from itertools import product
+
+import numpy as np
+
+from hedge_core import (
+    OPTION_MULTIPLIER,
+    MICRO_OPTION_MULTIPLIER,
+    PRICE_STEP,
+    CALENDAR_DAYS_PER_YEAR,
+    normalize_portfolio,
+    position_multiplier,
+    is_futures_position,
+    calc_leg_pnl_grid,
+    calc_leg_cost_grid,
+    calc_pnl_grid,
+    price_grid,
+    bs_option_value,
+)
+
+STRIKE_STEP = 100.0  # 履約價間距
+
+
+# ======== 倉位產生 ========
+def _strike(center, offset):
+    """現價 + offset，取最接近的履約價"""
+    return float(round((center + offset) / STRIKE_STEP) * STRIKE_STEP)
+
+
+def _option(option_type, direction, strike, lots):
+    return {"product": "台指", "type": option_type, "direction": direction, "strike": strike, "lots": int(lots)}
+
+
+def bear_put_spread(center, lots, long_offset, width):
+    """買進價平附近賣權、賣出更低履約價賣權"""
+    long_strike = _strike(center, -long_offset)
+    return [
+        _option("Put", "買進", long_strike, lots),
+        _option("Put", "賣出", long_strike - width, lots),
+    ]
+
+
+def collar(center, lots, put_offset, call_offset):
+    """買進賣權保護，以賣出價外買權的權利金支應"""
+    return [
+        _option("Put", "買進", _strike(center, -put_offset), lots),
+        _option("Call", "賣出", _strike(center, call_offset), lots),
+    ]
+
+
+def put_ratio(center, lots, long_offset, width, ratio):
+    """買進 1 倍賣權、賣出 ratio 倍更低履約價賣權 (大跌時保護遞減)"""
+    long_strike = _strike(center, -long_offset)
+    return [
+        _option("Put", "買進", long_strike, lots),
+        _option("Put", "賣出", long_strike - width, max(1, round(lots * ratio))),
+    ]
+
+
+def iron_condor(center, lots, put_offset, call_offset, wing):
+    """賣出兩側價外選擇權並買進更外側的保護翼"""
+    short_put = _strike(center, -put_offset)
+    short_call = _strike(center, call_offset)
+    return [
+        _option("Put", "賣出", short_put, lots),
+        _option("Put", "買進", short_put - wing, lots),
+        _option("Call", "賣出", short_call, lots),
+        _option("Call", "買進", short_call + wing, lots),
+    ]
+
+
+def micro_futures_short(center, lots, fraction):
+    """以微台期貨做空避險；口數換算為與台指選擇權相同的每點價值"""
+    futures_lots = max(1, round(lots * fraction * OPTION_MULTIPLIER / MICRO_OPTION_MULTIPLIER))
+    return [{
+        "product": "微台期貨",
+        "type": "Futures",
+        "direction": "做空",
+        "strike": float(round(center)),
+        "lots": int(futures_lots),
+    }]
+
+
+def _points(start, stop, step=STRIKE_STEP):
+    return [float(x) for x in np.arange(start, stop + 1e-6, step)]
+
+
+# 範本名稱 -> (說明, 產生函式, 預設參數網格)
+TEMPLATES = {
+    "bear_put_spread": ("賣權空頭價差", bear_put_spread, {
+        "long_offset": _points(0, 800),
+        "width": _points(200, 1000),
+    }),
+    "collar": ("領口 (買賣權 + 賣買權)", collar, {
+        "put_offset": _points(0, 800),
+        "call_offset": _points(200, 1500),
+    }),
+    "put_ratio": ("賣權比率價差", put_ratio, {
+        "long_offset": _points(0, 600),
+        "width": _points(200, 1000),
+        "ratio": [1.5, 2.0, 3.0],
+    }),
+    "iron_condor": ("鐵兀鷹", iron_condor, {
+        "put_offset": _points(300, 1200),
+        "call_offset": _points(300, 1200),
+        "wing": [200.0, 300.0, 500.0],
+    }),
+    "micro_futures_short": ("微台期貨做空", micro_futures_short, {
+        "fraction": [0.25, 0.5, 0.75, 1.0],
+    }),
+}
+
+
+def hedge_lots(etf_lots, hedge_ratio):
+    """建議避險口數 (至少 1 口)"""
+    return max(1, round(etf_lots * hedge_ratio))
+
+
+def generate_variants(center, lots, templates=None, param_grids=None):
+    """展開各範本的參數網格，回傳 [{"template", "params", "legs"}]
+
+    param_grids 可覆寫部分範本的參數網格 ({範本: {參數: 值列表}})。
+    """
+    variants = []
+    for name in templates or TEMPLATES:
+        _, build, defaults = TEMPLATES[name]
+        grid = {**defaults, **(param_grids or {}).get(name, {})}
+        keys = list(grid)
+        for values in product(*(grid[k] for k in keys)):
+            params = dict(zip(keys, values))
+            variants.append({"template": name, "params": params, "legs": build(center, lots, **params)})
+    return variants
+
+
+def price_variants(variants, center, days_to_expiry, vol, rate=0.0):
+    """以 Black-Scholes 理論價一次填入所有選擇權的權利金 (點，取至小數一位)"""
+    options = [leg for v in variants for leg in v["legs"] if not is_futures_position(leg)]
+    if not options:
+        return variants
+    is_call = np.array([leg["type"] == "Call" for leg in options])
+    strikes = np.array([leg["strike"] for leg in options], dtype=float)
+    values = bs_option_value(is_call, center, strikes, days_to_expiry / CALENDAR_DAYS_PER_YEAR, vol, rate)
+    for leg, value in zip(options, np.round(values, 1)):
+        leg["premium"] = float(value)
+    return variants
+
+
+# ======== 批次評估 ========
+def evaluate_variants(variants, portfolio, center, price_range, step=PRICE_STEP, costs=None):
+    """將所有組合與現有倉位合併後評估到期損益
+
+    所有組合的倉位串成一個列表，只呼叫一次 calc_leg_pnl_grid，
+    再以 np.add.reduceat 依組合加總。回傳 dict：
+        prices:      結算價網格
+        base:        現有倉位 (含 ETF / 持股) 的損益
+        pnl:         (組合數 × 價格數) 加入各組合後的總損益
+        cost:        各組合進場淨權利金支出 (元，負值為淨收入；計入成本時另加以現價結算的手續費與交易稅)
+        protection:  現價以下最差損益的改善 (元)
+        tail:        模擬區間最低點的損益改善 (元)
+        upside_drag: 模擬區間最高點的損益減少 (元)
+    """
+    portfolio = normalize_portfolio(portfolio)
+    prices = price_grid(center, price_range, step)
+    _, _, base = calc_pnl_grid(
+        portfolio["option_positions"], prices, center,
+        portfolio["etf_lots"], portfolio["etf_cost"], portfolio["etf_current_price"] or 0.0,
+        holdings=portfolio["holdings"], costs=costs,
+    )
+
+    legs = [leg for v in variants for leg in v["legs"]]
+    counts = np.array([len(v["legs"]) for v in variants])
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    leg_pnl = calc_leg_pnl_grid(legs, prices)
+    debit = np.array([
+        0.0 if is_futures_position(leg) else
+        (1.0 if leg["direction"] == "買進" else -1.0) * leg.get("premium", 0) * leg["lots"] * position_multiplier(leg)
+        for leg in legs
+    ])
+    if costs is not None:
+        leg_costs = calc_leg_cost_grid(legs, prices, costs)
+        leg_pnl = leg_pnl - leg_costs["fee"] - leg_costs["tax"]
+        # 成本另加以現價結算估算的手續費與交易稅
+        center_i = int(np.argmin(np.abs(prices - center)))
+        debit = debit + leg_costs["fee"][:, center_i] + leg_costs["tax"][:, center_i]
+
+    pnl = base[None, :] + np.add.reduceat(leg_pnl, starts, axis=0)
+    downside = prices <= center
+    return {
+        "prices": prices,
+        "base": base,
+        "pnl": pnl,
+        "cost": np.add.reduceat(debit, starts),
+        "protection": pnl[:, downside].min(axis=1) - base[downside].min(),
+        "tail": pnl[:, 0] - base[0],
+        "upside_drag": base[-1] - pnl[:, -1],
+    }
+
+
+def pareto_front(cost, protection):
+    """成本 / 保護效果的柏拉圖前緣：沒有其他組合更便宜且保護更多 (只考慮有保護效果者)"""
+    order = np.lexsort((-protection, cost))
+    front = np.zeros(cost.shape, dtype=bool)
+    best = 0.0
+    for i in order:
+        if protection[i] > best:
+            front[i] = True
+            best = protection[i]
+    return front
+
+
+def rank_variants(variants, results, budget=None, top=None):
+    """依成本與保護排序：柏拉圖前緣在前 (由便宜到貴)，其餘依每元保護效果、再依保護金額排序
+
+    budget 為進場淨支出上限 (元)。回傳表格列 (dict) 列表。
+    """
+    cost, protection = results["cost"], results["protection"]
+    front = pareto_front(cost, protection)
+    # 淨收入且有保護效果者視為無限效率；淨收入但保護變差者依原公式 (成本以 1 元計) 為負值，排在有保護的組合之後
+    efficiency = np.where((cost <= 0) & (protection > 0), np.inf, protection / np.maximum(cost, 1.0))
+    rows = []
+    for i, variant in enumerate(variants):
+        if budget is not None and cost[i] > budget:
+            continue
+        rows.append({
+            "template": variant["template"],
+            "label": TEMPLATES[variant["template"]][0],
+            "params": variant["params"],
+            "legs": variant["legs"],
+            "cost": float(cost[i]),
+            "protection": float(protection[i]),
+            "tail": float(results["tail"][i]),
+            "upside_drag": float(results["upside_drag"][i]),
+            "efficiency": float(efficiency[i]),
+            "pareto": bool(front[i]),
+        })
+    # 效率相同 (如多個無限效率) 時保護較多者在前
+    rows.sort(key=lambda r: (not r["pareto"], r["cost"] if r["pareto"] else -r["efficiency"], -r["protection"]))
+    return rows[:top] if top else rows
+
+
+def describe_legs(legs):
+    """倉位的簡短文字 (如 買Put 27800×2 / 賣Put 27300×2)"""
+    parts = []
+    for leg in legs:
+        if is_futures_position(leg):
+            parts.append(f"空微台 {leg['strike']:,.0f}×{leg['lots']}")
+        else:
+            side = "買" if leg["direction"] == "買進" else "賣"
+            parts.append(f"{side}{leg['type']} {leg['strike']:,.0f}×{leg['lots']}")
+    return " / ".join(parts)
+
+
+# ======== 命令列 ========
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="產生避險策略組合並依成本 / 保護效果排序")
+    parser.add_argument("portfolio", help="倉位檔 (hedge_positions.json 格式)")
+    parser.add_argument("--center", type=float, required=True, help="指數現價")
+    parser.add_argument("--vol", type=float, default=18.0, help="估算權利金的年化波動率 (%%)")
+    parser.add_argument("--dte", type=int, default=30, help="距到期日曆日")
+    parser.add_argument("--price-range", dest="price_range", type=float, default=3000.0, help="模擬範圍 (±點數)")
+    parser.add_argument("--template", action="append", choices=list(TEMPLATES), help="只評估指定範本，可重複")
+    parser.add_argument("--budget", type=float, help="進場淨支出上限 (元)")
+    parser.add_argument("--top", type=int, default=20, help="列出前幾名")
+    args = parser.parse_args(argv)
+
+    with open(args.portfolio, encoding="utf-8") as f:
+        portfolio = normalize_portfolio(json.load(f))
+    lots = hedge_lots(portfolio["etf_lots"], portfolio["hedge_ratio"])
+    variants = price_variants(generate_variants(args.center, lots, args.template), args.center, args.dte, args.vol / 100)
+    results = evaluate_variants(variants, portfolio, args.center, args.price_range)
+    print(f"共評估 {len(variants)} 個組合 (基準口數 {lots})", file=sys.stderr)
+    for row in rank_variants(variants, results, args.budget, args.top):
+        mark = "*" if row["pareto"] else " "
+        print(f"{mark} {row['label']:<12} 成本 {row['cost']:>+10,.0f}  保護 {row['protection']:>+10,.0f}  "
+              f"尾端 {row['tail']:>+10,.0f}  上檔 {-row['upside_drag']:>+10,.0f}  {describe_legs(row['legs'])}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,8 @@
+# backend 內的模組以頂層名稱互相匯入 (from hedge_core import ...)，測試時加入搜尋路徑
+import os
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
@@ -0,0 +1,65 @@
+from alerts import AlertEngine, anchor_book, build_alert_levels, pnl_crossings
+from hedge_core import build_payoff_profile, profile_pnl_at
+
+CENTER = 27800.0
+
+
+def _short(option_type, strike, lots=1):
+    return {"product": "台指", "type": option_type, "direction": "賣出", "strike": strike, "lots": lots, "premium": 50.0}
+
+
+def _book(positions):
+    return {"etf_lots": 0.0, "option_positions": positions}
+
+
+def test_pnl_crossings_match_profile():
+    positions = [_short("Put", 27000.0, 2), _short("Call", 28500.0)]
+    profile = build_payoff_profile(positions, CENTER, 3.0, 300.0, 330.0)
+    for x in pnl_crossings(profile, -50000.0):
+        assert abs(profile_pnl_at(profile, x) + 50000.0) < 1e-6
+
+
+def test_fires_exactly_at_level():
+    engine = AlertEngine()
+    engine.update_book(_book([_short("Put", 27000.0), _short("Call", 28500.0)]), CENTER)
+    assert engine.check(27001.0) == []
+    assert [n["alert"] for n in engine.check(27000.0)] == ["short_Put_27000"]
+    engine = AlertEngine()
+    engine.update_book(_book([_short("Call", 28500.0)]), CENTER)
+    assert [n["alert"] for n in engine.check(28500.0)] == ["short_Call_28500"]
+
+
+def test_book_change_does_not_refire():
+    engine = AlertEngine()
+    engine.update_book(_book([_short("Put", 27000.0)]), CENTER)
+    assert len(engine.check(26900.0)) == 1
+    # 新增不相關的倉位後，仍成立的警示不再通知；新條件才通知
+    engine.update_book(_book([_short("Call", 29000.0), _short("Put", 27000.0), _short("Put", 26950.0)]), CENTER)
+    assert [n["alert"] for n in engine.check(26900.0)] == ["short_Put_26950"]
+    # 離開後再進入會再次通知
+    assert engine.check(28000.0) == []
+    assert len(engine.check(26900.0)) == 2
+
+
+def test_approach_points_shift_level():
+    levels = build_alert_levels(_book([_short("Put", 27000.0)]), CENTER, approach_points=100.0)
+    assert levels["boundaries"] == [27100.0]
+    assert levels["at_boundary"] == [frozenset({"short_Put_27000"})]
+
+
+def test_anchor_book_reprices_etf_leg():
+    # 倉位中的 ETF 價格是數天前的 (300)，與今日的基準指數搭配會錯估 00631L 損益
+    book = {"etf_lots": 3.0, "etf_cost": 300.0, "etf_current_price": 300.0, "option_positions": []}
+    assert anchor_book(book, None) is book
+    anchored = anchor_book(book, 330.0)
+    assert anchored["etf_current_price"] == 330.0 and book["etf_current_price"] == 300.0
+
+    engine = AlertEngine(pnl_threshold=0.0)
+    engine.update_book(book, CENTER)
+    stale = engine.levels["boundaries"]
+    engine.update_book(anchored, CENTER)
+    # 以同時取得的報價錨定：基準指數處的損益為 (330 - 300) × 3000 股，兩平點低於基準指數
+    profile = build_payoff_profile([], CENTER, 3.0, 300.0, 330.0)
+    assert engine.levels["boundaries"] == pnl_crossings(profile, 0.0)
+    assert engine.levels["boundaries"][0] < CENTER
+    assert stale == [CENTER]
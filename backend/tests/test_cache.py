@@ -0,0 +1,116 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import cache
+from cache import CacheRegion, cached
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """可手動推進的 time.monotonic"""
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def region(monkeypatch):
+    region = CacheRegion("test")
+    monkeypatch.setitem(cache.REGIONS, "test", region)
+    return region
+
+
+def test_ttl_expiry(clock):
+    region = CacheRegion("quotes", ttl=300)
+    region.set("TWII", 23000.0)
+    clock[0] += 299
+    assert region.get("TWII") == 23000.0
+    clock[0] += 2
+    # 過期後 peek / get 皆視為未命中，且過期項目被移除
+    assert region.peek("TWII") is None
+    assert region.get("TWII") is None
+    assert region.stats()["entries"] == 0
+    assert (region.hits, region.misses) == (1, 1)
+
+
+def test_lru_byte_budget_eviction():
+    grid = np.zeros(1000)  # 8000 位元組
+    region = CacheRegion("payoff", max_bytes=3 * grid.nbytes)
+    for key in "abc":
+        region.set(key, grid.copy())
+    # 讀取 a 使其成為最近使用，新增 d 時淘汰最久未使用的 b
+    region.get("a")
+    region.set("d", grid.copy())
+    assert region.peek("b") is None
+    assert all(region.peek(k) is not None for k in "acd")
+    assert region.evictions == 1
+    assert region.stats()["bytes"] == 3 * grid.nbytes
+
+    # 覆寫同一鍵不重複計算位元組
+    region.set("d", grid.copy())
+    assert region.stats()["bytes"] == 3 * grid.nbytes
+    # 單筆超過上限時不保留
+    region.set("big", np.zeros(4000))
+    assert region.stats()["entries"] == 0
+
+
+def test_max_entries_eviction():
+    region = CacheRegion("quotes", max_entries=2)
+    for i in range(3):
+        region.set(i, i)
+    assert region.peek(0) is None
+    assert (region.peek(1), region.peek(2)) == (1, 2)
+
+
+def test_inflight_calls_are_coalesced(region):
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    @cached("test", key=lambda book: book)
+    def compute(book):
+        calls.append(book)
+        started.set()
+        release.wait(5)
+        return {"grid": np.arange(3)}
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(compute("book")))
+    first.start()
+    started.wait(5)
+    # 第一個呼叫仍在計算時，其他 session 以相同鍵呼叫只會等待
+    others = [threading.Thread(target=lambda: results.append(compute("book"))) for _ in range(3)]
+    for t in others:
+        t.start()
+    time.sleep(0.1)
+    assert calls == ["book"]
+    release.set()
+    for t in [first, *others]:
+        t.join(5)
+
+    assert calls == ["book"]
+    assert len(results) == 4
+    assert all(r is results[0] for r in results)
+    assert region.coalesced == 3
+    assert cache._inflight == {}
+
+
+def test_failed_computation_is_not_cached(region):
+    attempts = []
+
+    @cached("test")
+    def flaky(x):
+        attempts.append(x)
+        if len(attempts) == 1:
+            raise RuntimeError("報價來源逾時")
+        return x * 2
+
+    with pytest.raises(RuntimeError):
+        flaky(21)
+    assert flaky(21) == 42
+    assert flaky(21) == 42
+    assert attempts == [21, 21]
+    assert cache._inflight == {}
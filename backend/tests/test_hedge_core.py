@@ -0,0 +1,161 @@
+import numpy as np
+import pytest
+
+from hedge_core import (
+    COST_DEFAULTS,
+    make_holding,
+    normalize_portfolio,
+    calc_pnl_grid,
+    calc_holdings_pnl_grid,
+    price_grid,
+    build_payoff_profile,
+    profile_pnl_at,
+    profile_slope_at,
+    analyze_risk,
+    offset_profile,
+    apply_staged_changes,
+    staged_changes_delta,
+    staged_changes_realized,
+)
+
+CENTER = 23000.0
+
+MIXED_POSITIONS = [
+    {"product": "台指", "type": "Put", "direction": "買進", "strike": 22000.0, "lots": 2, "premium": 33.0},
+    {"product": "微台", "type": "Put", "direction": "賣出", "strike": 21000.0, "lots": 1, "premium": 10.0},
+    {"product": "台指", "type": "Call", "direction": "賣出", "strike": 24000.0, "lots": 1, "premium": 50.0},
+    {"product": "台指", "type": "Call", "direction": "買進", "strike": 24200.0, "lots": 1, "premium": 30.0},
+    {"product": "台指", "type": "Put", "direction": "買進", "strike": 22500.0, "lots": 0, "premium": 40.0},
+    {"product": "微台期貨", "type": "Futures", "direction": "做空", "strike": 23100.0, "lots": 3},
+]
+
+
+def _put(strike, lots, premium, direction="買進"):
+    return {"product": "台指", "type": "Put", "direction": direction, "strike": strike, "lots": lots, "premium": premium}
+
+
+@pytest.mark.parametrize("holdings", [(), (make_holding("0050", 2, 150, 160), make_holding("00632R", 3, 20, 19))])
+@pytest.mark.parametrize("costs", [None, COST_DEFAULTS])
+@pytest.mark.parametrize("etf_lots", [0.0, 6.5])
+def test_profile_matches_grid(etf_lots, costs, holdings):
+    """分段線性結構在每個網格點上都與向量化網格相同"""
+    prices = price_grid(CENTER, 3000, 25)
+    _, _, total = calc_pnl_grid(MIXED_POSITIONS, prices, CENTER, etf_lots, 100.0, 120.0, holdings, costs)
+    profile = build_payoff_profile(MIXED_POSITIONS, CENTER, etf_lots, 100.0, 120.0, holdings, costs)
+    np.testing.assert_allclose([profile_pnl_at(profile, x) for x in prices], total, rtol=0, atol=1e-6)
+
+
+def test_profile_slope_matches_finite_difference():
+    profile = build_payoff_profile(MIXED_POSITIONS, CENTER, 6.5, 100.0, 120.0)
+    for x in (20000.0, 21500.0, 22800.0, 24100.0, 26000.0):
+        expected = (profile_pnl_at(profile, x + 1) - profile_pnl_at(profile, x - 1)) / 2
+        assert profile_slope_at(profile, x) == pytest.approx(expected)
+
+
+def test_long_put_breakeven_and_trigger():
+    # 買進 22000 Put 權利金 100：兩平點 21900，最大虧損為權利金
+    profile = build_payoff_profile([_put(22000.0, 1, 100.0)], CENTER, 0.0, 0.0, 0.0)
+    risk = analyze_risk(profile, CENTER, 20000.0, 24000.0)
+    assert risk["breakevens"] == pytest.approx([21900.0])
+    assert risk["max_loss"] == pytest.approx(-5000.0)
+    assert risk["max_profit"] == pytest.approx(95000.0)
+    assert risk["max_profit_index"] == 20000.0
+    assert risk["hedge_trigger"] == 22000.0
+    assert risk["downside_slope"] == pytest.approx(-50.0)
+    assert risk["upside_slope"] == 0.0
+
+
+def test_etf_with_put_protection():
+    # 00631L 在基準指數時損益為 0，跌破 22000 後由賣權保護
+    etf_lots, etf_cost, etf_current = 2.0, 100.0, 100.0
+    positions = [_put(22000.0, 4, 0.0)]
+    profile = build_payoff_profile(positions, CENTER, etf_lots, etf_cost, etf_current)
+    risk = analyze_risk(profile, CENTER, 21000.0, 25000.0)
+    # ETF 斜率 = 100 × 2 / 23000 × 2000 股；買進 4 口 Put 的斜率為 -200
+    etf_slope = etf_current * 2 / CENTER * etf_lots * 1000
+    # 22000 以下賣權的獲利超過 ETF 虧損，再次回到兩平
+    lower = 22000.0 - 1000 * etf_slope / (200.0 - etf_slope)
+    assert risk["breakevens"] == pytest.approx([lower, CENTER])
+    assert risk["hedge_trigger"] == 22000.0
+    assert risk["downside_slope"] == pytest.approx(etf_slope - 200.0)
+    assert risk["max_loss_index"] == 22000.0
+    assert risk["max_loss"] == pytest.approx(-1000 * etf_slope)
+
+
+def test_hedge_trigger_ignores_strikes_above_center_and_short_puts():
+    positions = [
+        _put(24000.0, 1, 0.0),  # 現價以上
+        _put(22000.0, 1, 0.0, direction="賣出"),  # 賣出的 Put 使下跌斜率變正，不是保護
+    ]
+    profile = build_payoff_profile(positions, CENTER, 0.0, 0.0, 0.0)
+    assert analyze_risk(profile, CENTER, 20000.0, 26000.0)["hedge_trigger"] is None
+
+    # 現價以下的買進 Call / 多頭價差：轉折方向與買進 Put 相同，但不是下檔保護
+    call = dict(_put(22000.0, 1, 0.0), type="Call")
+    for positions in ([call], [call, dict(call, strike=22500.0, direction="賣出")]):
+        profile = build_payoff_profile(positions, CENTER, 0.0, 0.0, 0.0)
+        assert analyze_risk(profile, CENTER, 20000.0, 26000.0)["hedge_trigger"] is None
+
+
+def test_holding_defaults_match_make_holding():
+    # 未指定 beta 的反向 ETF 仍為 -1 倍 (不是預設的 +1)
+    raw = {"symbol": "00632R", "lots": 2, "cost": 20, "price": 20}
+    holding = normalize_portfolio({"holdings": [raw]})["holdings"][0]
+    assert holding == make_holding("00632R", 2, 20, 20)
+    pnl = calc_holdings_pnl_grid([raw], [CENTER * 1.01], CENTER)
+    assert pnl.sum() == pytest.approx(-20 * 0.01 * 2000)
+
+
+def test_holding_without_price_is_rejected():
+    for raw in ({"symbol": "0050", "lots": 1, "cost": 150}, {"symbol": "0050", "lots": 1, "cost": 150, "price": None}):
+        with pytest.raises(ValueError):
+            calc_holdings_pnl_grid(normalize_portfolio({"holdings": [raw]})["holdings"], [CENTER], CENTER)
+
+
+def test_empty_book_has_no_breakevens():
+    profile = build_payoff_profile([], CENTER, 0.0, 0.0, 0.0)
+    risk = analyze_risk(profile, CENTER, 21000.0, 25000.0)
+    assert risk["breakevens"] == []
+    assert risk["max_loss"] == 0.0
+
+
+def test_breakeven_on_grid_boundary():
+    # 兩平點剛好落在區間端點時只回報一次
+    profile = build_payoff_profile([_put(22000.0, 1, 100.0)], CENTER, 0.0, 0.0, 0.0)
+    risk = analyze_risk(profile, CENTER, 21900.0, 23000.0)
+    assert risk["breakevens"] == pytest.approx([21900.0])
+
+
+STAGED = [
+    {"op": "close", "index": 0, "lots": 1, "price": 45.0},
+    {"op": "close", "index": 2, "lots": 1, "price": 120.0},
+    {"op": "close", "index": 5, "lots": 3, "price": 22900.0},
+    {"op": "open", "position": {"product": "台指", "type": "Put", "direction": "買進", "strike": 22300.0, "lots": 2, "premium": 60.0}},
+]
+
+
+def test_apply_staged_changes_keeps_paused_legs():
+    adjusted = apply_staged_changes(MIXED_POSITIONS, STAGED)
+    # 全部平倉的 #3、#6 移除；原本 0 口的 #5 保留
+    assert [(p["strike"], p["lots"]) for p in adjusted] == [
+        (22000.0, 1), (21000.0, 1), (24200.0, 1), (22500.0, 0), (22300.0, 2),
+    ]
+
+
+@pytest.mark.parametrize("costs", [None, COST_DEFAULTS])
+def test_staged_delta_matches_adjusted_book(costs):
+    """基準網格 + 增量 = 調整後倉位的網格 + 已實現損益，且與分段線性結構的風險摘要一致"""
+    prices = price_grid(CENTER, 3000, 50)
+    etf_args = (6.5, 100.0, 120.0)
+    _, _, base = calc_pnl_grid(MIXED_POSITIONS, prices, CENTER, *etf_args, costs=costs)
+    adjusted_profits = base + staged_changes_delta(MIXED_POSITIONS, STAGED, prices, costs)
+
+    adjusted = apply_staged_changes(MIXED_POSITIONS, STAGED)
+    realized = staged_changes_realized(MIXED_POSITIONS, STAGED, costs)
+    _, _, expected = calc_pnl_grid(adjusted, prices, CENTER, *etf_args, costs=costs)
+    np.testing.assert_allclose(adjusted_profits, expected + realized, rtol=0, atol=1e-6)
+
+    profile = offset_profile(build_payoff_profile(adjusted, CENTER, *etf_args, costs=costs), realized)
+    risk = analyze_risk(profile, CENTER, CENTER - 3000, CENTER + 3000)
+    assert risk["max_loss"] == pytest.approx(adjusted_profits.min())
+    assert risk["max_profit"] == pytest.approx(adjusted_profits.max())
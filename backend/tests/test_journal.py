@@ -0,0 +1,89 @@
+import threading
+
+import pytest
+
+from hedge_core import normalize_portfolio
+from journal import LocalJournal
+
+PUT = {"product": "台指", "type": "Put", "direction": "買進", "strike": 22000.0, "lots": 2, "premium": 30.0}
+
+
+def _book(**fields):
+    return normalize_portfolio({"etf_lots": 5.0, "etf_cost": 100.0, "option_positions": [PUT], **fields})
+
+
+def test_undo_first_event(tmp_path):
+    # 新部署的第一個動作就是清空，仍可還原
+    journal = LocalJournal(str(tmp_path / "journal"), snapshot_interval=3)
+    before = _book()
+    after = _book(etf_lots=0.0, etf_cost=0.0, option_positions=[])
+    event = journal.record("clear", after, portfolio_before=before)
+    assert journal.state_before(event["id"]) == before
+    assert journal.current() == normalize_portfolio({**after, "hedge_ratio": 0.2})
+
+
+def test_state_before_across_snapshots(tmp_path):
+    journal = LocalJournal(str(tmp_path / "journal"), snapshot_interval=2)
+    book = _book()
+    journal.record("restore", book, portfolio_before=normalize_portfolio({}), portfolio=book)
+    history = [book]
+    ids = []
+    for delta in (1, 1, -2, 3):
+        positions = [dict(history[-1]["option_positions"][0], lots=history[-1]["option_positions"][0]["lots"] + delta)]
+        history.append(_book(option_positions=positions))
+        ids.append(journal.record("adjust_lots", history[-1], index=0, delta=delta)["id"])
+    for event_id, expected in zip(ids, history):
+        assert journal.state_before(event_id) == expected
+    assert journal.current() == history[-1]
+
+
+def test_replay_with_missing_event_raises(tmp_path):
+    journal = LocalJournal(str(tmp_path / "journal"))
+    journal.record("add_position", _book(), portfolio_before=_book(option_positions=[]), position=PUT)
+    # 模擬漏記的刪除：日誌認為只有 1 筆倉位，卻記錄刪除第 2 筆
+    bad = journal.record("delete_position", _book(option_positions=[]), index=1)
+    journal.record("clear", _book(option_positions=[]))
+    with pytest.raises(ValueError):
+        journal.state_before(journal.recent_events(1)[0]["id"])
+    assert journal.state_before(bad["id"]) == _book()
+
+
+def test_sync_records_external_changes_once(tmp_path):
+    journal = LocalJournal(str(tmp_path / "journal"))
+    journal.record("add_position", _book(), portfolio_before=_book(option_positions=[]), position=PUT)
+    assert journal.sync(_book()) is None
+    remote = _book(etf_lots=7.0)
+    event = journal.sync(remote)
+    assert event["op"] == "sync"
+    assert journal.sync(remote) is None
+    # 另一個行程 (新的日誌物件) 也不會重複記錄
+    assert LocalJournal(str(tmp_path / "journal")).sync(remote) is None
+    assert journal.current() == remote
+    assert journal.state_before(event["id"]) == _book()
+
+
+def test_sync_ignores_firebase_number_types(tmp_path):
+    # Firebase 將整數值的浮點數回傳為 int，同一份倉位不應被當成外部修改
+    journal = LocalJournal(str(tmp_path / "journal"))
+    journal.record("add_position", _book(), portfolio_before=_book(option_positions=[]), position=PUT)
+    from_firebase = {"etf_lots": 5, "etf_cost": 100, "option_positions": [dict(PUT, strike=22000, premium=30, lots=2.0)]}
+    assert journal.sync(from_firebase) is None
+
+
+def test_sync_waits_for_pending_record(tmp_path):
+    # 寫入倉位到記錄事件之間持有日誌鎖，其他 session 的 sync 不會搶先記錄同一份內容
+    journal = LocalJournal(str(tmp_path / "journal"))
+    before = _book(option_positions=[])
+    journal.record("restore", before, portfolio_before=before, portfolio=before)
+    after = _book()
+    results = []
+    with journal.lock:
+        worker = threading.Thread(target=lambda: results.append(journal.sync(after)))
+        worker.start()
+        worker.join(0.2)
+        assert worker.is_alive()
+        journal.record("add_position", after, position=PUT)
+    worker.join()
+    assert results == [None]
+    assert [e["op"] for e in journal.recent_events()] == ["restore", "add_position"]
+    assert journal.current() == after
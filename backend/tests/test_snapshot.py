@@ -0,0 +1,113 @@
+import io
+import json
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from hedge_core import make_holding, normalize_portfolio, portfolio_hash
+from snapshot import load_snapshot, save_snapshot, snapshot_bytes, snapshot_hash, verify_roundtrip
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+CHECKED_IN = ["hedge_positions.json", "hedge_positions_backup.json"]
+
+SPARSE = {
+    "etf_lots": 6,
+    "etf_cost": 328.8,
+    # 缺少 etf_current_price / hedge_ratio / holdings 等欄位
+    "option_positions": {
+        # Firebase 稀疏陣列
+        "0": {"type": "Put", "direction": "買進", "strike": 27000, "lots": 2, "premium": 85.5},
+        "2": {"product": "微台", "type": "Call", "direction": "賣出", "strike": 28500.0, "lots": 1.0},
+        "3": {"product": "微台期貨", "type": "Futures", "direction": "做空", "strike": 27650.0, "lots": 3,
+              "note": "轉倉", "tags": ["roll", 2]},
+    },
+}
+
+
+def _roundtrip(tmp_path, portfolio, grids=None, mmap=True):
+    path = save_snapshot(str(tmp_path / "snap.npz"), portfolio, grids)
+    return path, load_snapshot(path, mmap=mmap)
+
+
+@pytest.mark.parametrize("name", CHECKED_IN)
+def test_checked_in_files_roundtrip(tmp_path, name):
+    with open(os.path.join(REPO_DIR, name), encoding="utf-8") as f:
+        portfolio = json.load(f)
+    assert verify_roundtrip(portfolio) == []
+    path, (restored, grids) = _roundtrip(tmp_path, portfolio)
+    assert restored == normalize_portfolio(portfolio)
+    assert portfolio_hash(restored) == snapshot_hash(path) == portfolio_hash(normalize_portfolio(portfolio))
+    assert grids == {}
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_sparse_and_missing_keys(tmp_path, mmap):
+    _, (restored, _) = _roundtrip(tmp_path, SPARSE, mmap=mmap)
+    expected = normalize_portfolio(SPARSE)
+    assert restored == expected
+    # 各列缺少的欄位不會被補上；口數為 int、履約價為 float (不論 Firebase 回傳的型別)
+    assert [sorted(p) for p in restored["option_positions"]] == [sorted(p) for p in expected["option_positions"]]
+    assert [type(p["lots"]) for p in restored["option_positions"]] == [int, int, int]
+    assert [type(p["strike"]) for p in restored["option_positions"]] == [float, float, float]
+    assert restored["etf_current_price"] is None
+
+
+def test_holdings_roundtrip(tmp_path):
+    portfolio = {"etf_lots": 1.5, "holdings": [make_holding("0050", 2, 150, 160), make_holding("00632R", 3, 20, 19)]}
+    _, (restored, _) = _roundtrip(tmp_path, portfolio)
+    assert restored == normalize_portfolio(portfolio)
+
+
+def test_empty_portfolio(tmp_path):
+    _, (restored, grids) = _roundtrip(tmp_path, {})
+    assert restored == normalize_portfolio({})
+    assert grids == {}
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_grids_roundtrip(tmp_path, mmap):
+    grids = {
+        "prices": np.arange(24000.0, 30001.0, 100.0),
+        "matrix": np.random.default_rng(0).normal(size=(6, 61)),
+        "empty": np.zeros(0),
+    }
+    _, (_, restored) = _roundtrip(tmp_path, SPARSE, grids, mmap=mmap)
+    assert sorted(restored) == sorted(grids)
+    for name, values in grids.items():
+        np.testing.assert_array_equal(restored[name], values)
+    assert isinstance(restored["matrix"], np.memmap) == mmap
+    if mmap:
+        assert not restored["matrix"].flags.writeable
+
+
+def test_load_from_bytes():
+    grid = np.linspace(-1.0, 1.0, 5)
+    restored, grids = load_snapshot(io.BytesIO(snapshot_bytes(SPARSE, {"check": grid})))
+    assert restored == normalize_portfolio(SPARSE)
+    np.testing.assert_array_equal(grids["check"], grid)
+
+
+def test_concurrent_saves_do_not_share_temp_file(tmp_path):
+    # 多個 session 同時更新本地快照：每次寫入使用各自的暫存檔，結果必為其中一份完整快照
+    path = str(tmp_path / "snap.npz")
+    books = [normalize_portfolio({"etf_lots": float(i), "option_positions": [{"type": "Put", "strike": 22000.0 + i, "lots": i}]})
+             for i in range(8)]
+    errors = []
+
+    def save(book):
+        try:
+            for _ in range(10):
+                save_snapshot(path, book)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=save, args=(book,)) for book in books]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert load_snapshot(path)[0] in books
+    assert os.listdir(tmp_path) == ["snap.npz"]
@@ -0,0 +1,50 @@
+import pytest
+
+from storage import apply_event
+
+PUT = {"type": "Put", "strike": 22000.0, "lots": 2}
+DOC = {"etf_lots": 5.0, "option_positions": [PUT, dict(PUT, strike=21500.0)]}
+
+
+def test_put_replaces_root_and_nested_nodes():
+    assert apply_event(DOC, "put", "/", {"etf_lots": 1.0}) == {"etf_lots": 1.0}
+    doc = apply_event(DOC, "put", "/option_positions/1/lots", 4)
+    assert doc["option_positions"][1]["lots"] == 4
+    # 原文件不被修改
+    assert DOC["option_positions"][1]["lots"] == 2
+
+
+def test_put_none_deletes_field_and_trailing_list_item():
+    doc = apply_event(DOC, "put", "/etf_lots", None)
+    assert "etf_lots" not in doc
+    doc = apply_event(DOC, "put", "/option_positions/1", None)
+    assert doc["option_positions"] == [PUT]
+
+
+def test_put_into_sparse_array_pads_with_none():
+    # Firebase 以數字鍵表示陣列，中間缺號時本地補 None
+    doc = apply_event(DOC, "put", "/option_positions/3", PUT)
+    assert doc["option_positions"] == [PUT, dict(PUT, strike=21500.0), None, PUT]
+    # 刪除尾端後，連帶移除前面的空位
+    doc = apply_event(doc, "put", "/option_positions/3", None)
+    assert doc["option_positions"] == [PUT, dict(PUT, strike=21500.0)]
+
+
+def test_patch_merges_into_list_items():
+    doc = apply_event(DOC, "patch", "/option_positions/0", {"lots": 3, "strike": None})
+    assert doc["option_positions"][0] == {"type": "Put", "lots": 3}
+    # 路徑不存在時建立節點
+    doc = apply_event(DOC, "patch", "/option_positions/2", {"lots": 1})
+    assert doc["option_positions"][2] == {"lots": 1}
+
+
+def test_root_patch_merges_and_deletes():
+    doc = apply_event(DOC, "patch", "/", {"etf_lots": None, "hedge_ratio": 0.3})
+    assert doc == {"option_positions": DOC["option_positions"], "hedge_ratio": 0.3}
+    assert apply_event(None, "patch", "/", {"etf_lots": 1.0}) == {"etf_lots": 1.0}
+
+
+@pytest.mark.parametrize("event_type", ["put", "patch"])
+def test_event_on_empty_document(event_type):
+    doc = apply_event(None, event_type, "/option_positions/0", {"lots": 1})
+    assert doc == {"option_positions": [{"lots": 1}]}
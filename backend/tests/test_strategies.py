@@ -0,0 +1,47 @@
+import json
+import os
+
+import numpy as np
+
+from hedge_core import normalize_portfolio
+from strategies import evaluate_variants, generate_variants, hedge_lots, pareto_front, price_variants, rank_variants
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+CENTER = 27800.0
+
+
+def _ranked(**kwargs):
+    with open(os.path.join(REPO_DIR, "hedge_positions.json"), encoding="utf-8") as f:
+        portfolio = normalize_portfolio(json.load(f))
+    lots = hedge_lots(portfolio["etf_lots"], portfolio["hedge_ratio"])
+    variants = price_variants(generate_variants(CENTER, lots), CENTER, 30, 0.18)
+    results = evaluate_variants(variants, portfolio, CENTER, 3000.0, **kwargs)
+    return variants, results, rank_variants(variants, results)
+
+
+def test_pareto_front():
+    cost = np.array([100.0, 50.0, 200.0, -30.0, 80.0])
+    protection = np.array([1000.0, 200.0, 900.0, -500.0, 1000.0])
+    assert pareto_front(cost, protection).tolist() == [False, True, False, False, True]
+
+
+def test_credit_variants_without_protection_rank_last():
+    variants, results, rows = _ranked()
+    assert len(rows) == len(variants)
+    others = [r for r in rows if not r["pareto"]]
+    assert any(r["cost"] <= 0 and r["protection"] <= 0 for r in others)
+    # 有保護效果的組合都排在淨收入卻使最差損益變差的組合之前
+    last_protective = max(i for i, r in enumerate(others) if r["protection"] > 0)
+    first_credit_worse = min(i for i, r in enumerate(others) if r["cost"] <= 0 and r["protection"] <= 0)
+    assert last_protective < first_credit_worse
+    assert all(np.isinf(r["efficiency"]) == (r["cost"] <= 0 and r["protection"] > 0) for r in rows)
+
+
+def test_ranking_order():
+    _, _, rows = _ranked(costs={})
+    front = [r for r in rows if r["pareto"]]
+    assert front and rows[:len(front)] == front
+    assert [r["cost"] for r in front] == sorted(r["cost"] for r in front)
+    others = rows[len(front):]
+    keys = [(-r["efficiency"], -r["protection"]) for r in others]
+    assert keys == sorted(keys)